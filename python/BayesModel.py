@@ -8,94 +8,223 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as TF
 
-class GaussianDistribution():
+def sum_sample(input, weight_dims):
     """
-    Makes use of the torch normal distributions and has the Reparameterizion trick built in
+    Sums the trailing weight dimensions, leaving one value per sample if input holds a stack of samples
+    :param input: tensor to sum
+    :param weight_dims: number of dimensions of a single weight sample
     """
-    def __init__(self, mu, rho, device):
-        self.mu = mu
-        self.rho = rho
-        self.device = device
-        self.normal = torch.distributions.Normal(0, 1, validate_args=True)
+    if input.dim() == weight_dims:
+        return input.sum()
+    return input.sum(dim=tuple(range(input.dim() - weight_dims, input.dim())))
 
-    @property
-    def sigma(self):
-        return torch.log1p(torch.exp(self.rho))
+def sample_size(parameter, samples=None):
+    """
+    :return: size of a single sample of parameter, or of a stack of samples
+    """
+    if samples is None:
+        return parameter.size()
+    return (samples,) + parameter.size()
 
-    def sample_distribution(self):
-        e = self.normal.sample(self.rho.size()).to(self.device)
-        return self.mu + self.sigma * e
+def gaussian_kl(mu, sigma, prior_mu, prior_sigma):
+    """
+    KL divergence between a factorised gaussian and a gaussian prior
+    :param mu: mean of the factorised gaussian
+    :param sigma: standard deviation of the factorised gaussian
+    :param prior_mu: mean of the prior
+    :param prior_sigma: standard deviation of the prior
+    :return: KL divergence summed over every element
+    """
+    return (torch.log(prior_sigma) - torch.log(sigma)
+            + (sigma ** 2 + (mu - prior_mu) ** 2) / (2 * prior_sigma ** 2) - 0.5).sum()
 
-    def log_prob(self, input):
-        """
-        Reparameterization trick
-        :return: Reparameterized Gaussian
-        """
-        return (-math.log(math.sqrt(2 * math.pi))
-                - torch.log(self.sigma)
-                - ((input - self.mu) ** 2) / (2 * self.sigma ** 2)).sum()
-
-class ScaleMixtureGaussian():
-    def __init__(self, pi, sigma1, sigma2, device):
-        self.pi = pi
-        self.sigma1 = sigma1
-        self.sigma2 = sigma2
-        self.device = device
-        self.gaussian1 = torch.distributions.Normal(torch.tensor(0).to(device), sigma1, validate_args=True)
-        self.gaussian2 = torch.distributions.Normal(torch.tensor(0).to(device), sigma2, validate_args=True)
-
-    def log_prob(self, input):
-        """
-        Makes use of our scale and slab prioir
-        :param input: our input vector
-        :return: log probability of prior
-        """
-        prob1 = torch.exp(self.gaussian1.log_prob(input))
-        prob2 = torch.exp(self.gaussian2.log_prob(input))
-        return (torch.log(self.pi * prob1 + (1 - self.pi) * prob2)).sum()
+def rho_to_sigma(rho):
+    """
+    Standard deviation of the weights from their rho parameter, sigma = log(1 + exp(rho)), used by every sampling path
+    """
+    return TF.softplus(rho)
+
+def fused_sample(mu, rho, pi, sigma1, sigma2, samples=None):
+    """
+    Samples weights with the reparameterization trick and finds their log prior and log variational posterior in
+    the same pass. Sigma is computed once, the posterior is found from the noise directly as (w - mu) / sigma is
+    the noise, and the scale mixture prior is combined with a logsumexp rather than exp then log
+    :param mu: mean of the weights
+    :param rho: parameter of the standard deviation of the weights, sigma = log(1 + exp(rho))
+    :param pi: weighting of the first gaussian in the scale mixture prior
+    :param sigma1: standard deviation of the first gaussian in the prior
+    :param sigma2: standard deviation of the second gaussian in the prior
+    :param samples: if given, draw this many samples stacked along a new first dimension
+    :return: the sampled weights, their log prior and their log variational posterior, one of each per sample
+    """
+    weight_dims = mu.dim()
+    n_weights = mu.numel()
+    half_log_2pi = 0.5 * math.log(2 * math.pi)
+
+    sigma = rho_to_sigma(rho)
+    e = torch.randn(sample_size(rho, samples), device=mu.device)
+    weight = mu + sigma * e
+
+    log_variational_posterior = (-0.5 * sum_sample(e ** 2, weight_dims) - torch.log(sigma).sum()
+                                 - n_weights * half_log_2pi)
+
+    weight_squared = weight ** 2
+    log_prob1 = math.log(pi) - math.log(sigma1) - weight_squared / (2 * sigma1 ** 2)
+    log_prob2 = math.log(1 - pi) - math.log(sigma2) - weight_squared / (2 * sigma2 ** 2)
+
+    # log(exp(a) + exp(b)) without underflowing when one of them is very unlikely
+    largest = torch.max(log_prob1, log_prob2)
+    log_prior = largest + torch.log1p(torch.exp(-torch.abs(log_prob1 - log_prob2)))
+    log_prior = sum_sample(log_prior, weight_dims) - n_weights * half_log_2pi
+
+    return weight, log_prior, log_variational_posterior
 
 class BayesianLayer(nn.Module):
 
-    def __init__(self, in_features, out_features, device):
+    def __init__(self, in_features, out_features, device, prior="mixture", prior_sigma=1.0):
         """
         Initialise a bayesian layer
         :param in_features: the number of incoming weights
         :param out_features: the number of outgoing weights
         :param device: device to put weights on
+        :param prior: "mixture" for the scale mixture prior, whose KL divergence is estimated by sampling, or
+        "gaussian" for a fixed zero mean gaussian and "learned" for a gaussian with a learned mean and standard
+        deviation, whose KL divergences are found in closed form
+        :param prior_sigma: standard deviation of the gaussian prior, or its starting value if learned
 
         """
         super().__init__()
+        if prior not in ("mixture", "gaussian", "learned"):
+            raise ValueError(f"Unknown prior {prior}")
+
         self.in_features = in_features
         self.out_features = out_features
+        self.prior = prior
+        self.prior_sigma = prior_sigma
 
         # Weight parameters
         self.weight_mu = nn.Parameter(torch.Tensor(out_features, in_features).uniform_(-0.2, 0.2))
         self.weight_rho = nn.Parameter(torch.Tensor(out_features, in_features).uniform_(-5, -4))
-        self.weight = GaussianDistribution(self.weight_mu, self.weight_rho, device)
 
         # Bias parameters
         self.bias_mu = nn.Parameter(torch.Tensor(out_features).uniform_(-0.2, 0.2))
         self.bias_rho = nn.Parameter(torch.Tensor(out_features).uniform_(-5, -4))
-        self.bias = GaussianDistribution(self.bias_mu, self.bias_rho, device)
 
-        # Prior distributions
-        SIGMA_1 = torch.FloatTensor([math.exp(-0)]).to(device)
-        SIGMA_2 = torch.FloatTensor([math.exp(-6)]).to(device)
-        PI = torch.tensor(0.5).to(device)
-
-        self.weight_prior = ScaleMixtureGaussian(PI, SIGMA_1, SIGMA_2, device)
-        self.bias_prior = ScaleMixtureGaussian(PI, SIGMA_1, SIGMA_2, device)
+        # Scale mixture prior, pi, sigma1 and sigma2 kept as floats for fused_sample
+        self.prior_parameters = (0.5, math.exp(-0), math.exp(-6))
         self.log_prior = 0
 
         self.log_variational_posterior = 0
 
-    def forward(self, input):
+        # A single gaussian prior shared by every weight and bias in the layer
+        if prior == "learned":
+            self.prior_mu = nn.Parameter(torch.zeros(1))
+            self.prior_log_sigma = nn.Parameter(torch.Tensor([math.log(prior_sigma)]))
 
-        weight = self.weight.sample_distribution()
-        bias = self.bias.sample_distribution()
+    @property
+    def closed_form_kl(self):
+        return self.prior != "mixture"
 
-        self.log_prior = self.weight_prior.log_prob(weight) + self.bias_prior.log_prob(bias)
-        self.log_variational_posterior = self.weight.log_prob(weight) + self.bias.log_prob(bias)
+    def kl_divergence(self):
+        """
+        Closed form KL divergence between the factorised gaussian posterior and a gaussian prior
+        :return: KL divergence summed over every weight and bias
+        """
+        if self.prior == "learned":
+            prior_mu = self.prior_mu
+            prior_sigma = torch.exp(self.prior_log_sigma)
+        else:
+            prior_mu = 0
+            prior_sigma = torch.tensor(self.prior_sigma, device=self.weight_mu.device)
+
+        return (gaussian_kl(self.weight_mu, rho_to_sigma(self.weight_rho), prior_mu, prior_sigma) +
+                gaussian_kl(self.bias_mu, rho_to_sigma(self.bias_rho), prior_mu, prior_sigma))
+
+    def forward(self, input, samples=None):
+        """
+        Samples the weights and runs the input through the layer
+        :param input: input batch, or a (samples, batch, in_features) stack of batches if samples is given
+        :param samples: number of weight samples to draw, one for each batch in the stack
+        :return: output of the layer, log_prior and log_variational_posterior hold one value per sample
+        """
+        if self.closed_form_kl:
+            # The KL divergence doesn't need the log probabilities of the samples
+            weight = self.weight_mu + rho_to_sigma(self.weight_rho) * torch.randn(
+                sample_size(self.weight_rho, samples), device=self.weight_mu.device)
+            bias = self.bias_mu + rho_to_sigma(self.bias_rho) * torch.randn(
+                sample_size(self.bias_rho, samples), device=self.bias_mu.device)
 
-        return TF.linear(input, weight, bias)
+            if samples is None:
+                return TF.linear(input, weight, bias)
+            return torch.baddbmm(bias.unsqueeze(1), input, weight.transpose(1, 2))
 
+        weight, weight_log_prior, weight_log_posterior = fused_sample(self.weight_mu, self.weight_rho,
+                                                                      *self.prior_parameters, samples=samples)
+        bias, bias_log_prior, bias_log_posterior = fused_sample(self.bias_mu, self.bias_rho,
+                                                                *self.prior_parameters, samples=samples)
+
+        self.log_prior = weight_log_prior + bias_log_prior
+        self.log_variational_posterior = weight_log_posterior + bias_log_posterior
+
+        if samples is None:
+            return TF.linear(input, weight, bias)
+
+        return torch.baddbmm(bias.unsqueeze(1), input, weight.transpose(1, 2))
+
+    def local_sample(self, input, samples=1):
+        """
+        Local reparameterization, rather than sampling the weights finds the mean and variance of the layer's output
+        with two matmuls, then samples the output directly. Used at inference as no log probabilities are calculated
+        :param input: input batch
+        :param samples: number of output samples to draw
+        :return: (samples, batch, out_features) outputs of the layer
+        """
+        mean = TF.linear(input, self.weight_mu, self.bias_mu)
+        variance = TF.linear(input ** 2, rho_to_sigma(self.weight_rho) ** 2, rho_to_sigma(self.bias_rho) ** 2)
+
+        e = torch.randn((samples,) + tuple(mean.size()), device=mean.device)
+        return mean + torch.sqrt(variance) * e
+
+
+
+class FlipoutLayer(BayesianLayer):
+    """
+    Bayesian layer using Flipout, each example in the batch multiplies a shared weight perturbation by its own
+    random signs, giving every example a pseudo independent weight sample for the cost of a second matmul
+    """
+
+    def forward(self, input, samples=None):
+        """
+        Samples a weight perturbation and runs the input through the layer with a sign flip for each example
+        :param input: input batch, or a (samples, batch, in_features) stack of batches if samples is given
+        :param samples: number of perturbations to draw, one for each batch in the stack
+        :return: output of the layer, log_prior and log_variational_posterior hold one value per sample
+        """
+        if self.closed_form_kl:
+            weight = self.weight_mu + rho_to_sigma(self.weight_rho) * torch.randn(
+                sample_size(self.weight_rho, samples), device=self.weight_mu.device)
+            bias = self.bias_mu + rho_to_sigma(self.bias_rho) * torch.randn(
+                sample_size(self.bias_rho, samples), device=self.bias_mu.device)
+        else:
+            # Log probabilities are of the unflipped sample, whose distribution each flipped sample shares
+            weight, weight_log_prior, weight_log_posterior = fused_sample(self.weight_mu, self.weight_rho,
+                                                                          *self.prior_parameters, samples=samples)
+            bias, bias_log_prior, bias_log_posterior = fused_sample(self.bias_mu, self.bias_rho,
+                                                                    *self.prior_parameters, samples=samples)
+
+            self.log_prior = weight_log_prior + bias_log_prior
+            self.log_variational_posterior = weight_log_posterior + bias_log_posterior
+
+        perturbation = weight - self.weight_mu
+
+        # Random signs for the inputs and outputs of each example
+        sign_in = torch.empty_like(input).bernoulli_(0.5).mul_(2).sub_(1)
+        sign_out = torch.empty(input.size()[:-1] + (self.out_features,),
+                               device=input.device).bernoulli_(0.5).mul_(2).sub_(1)
+
+        if samples is None:
+            mean = TF.linear(input, self.weight_mu, bias)
+            return mean + TF.linear(input * sign_in, perturbation) * sign_out
+
+        mean = torch.baddbmm(bias.unsqueeze(1), input, self.weight_mu.t().expand(samples, -1, -1))
+        return mean + torch.bmm(input * sign_in, perturbation.transpose(1, 2)) * sign_out
@@ -0,0 +1,103 @@
+"""
+calibration.py: Computes the reliability diagrams and calibration errors plotted in data_plotting.py. Every
+probability is put in its bin in one pass with np.digitize and the bins are summed with np.bincount
+"""
+
+import numpy as np
+
+
+def bin_indexes(probabilities, bins):
+    """
+    Finds the bin each probability falls in, bins cover (c/bins - 1/bins, c/bins]
+    :param probabilities: array of probabilities
+    :param bins: number of equally sized bins between 0 and 1
+    :return: bin of each probability, -1 for probabilities of 0 which are in no bin
+    """
+    edges = np.arange(0, bins + 1) / bins
+
+    return np.digitize(probabilities, edges, right=True) - 1
+
+
+def count_bins(probabilities, bins):
+    """
+    Counts how many probabilities fall in each bin, with a separate set of bins for each column
+    :param probabilities: (N, C) array of probabilities
+    :param bins: number of bins
+    :return: (C, bins) array of counts
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+
+    return sum_bins(probabilities, np.zeros_like(probabilities), bins)[0]
+
+
+def sum_bins(probabilities, hits, bins):
+    """
+    Sums the probabilities and hits in each bin, with a separate set of bins for each column
+    :param probabilities: (N, C) array of probabilities
+    :param hits: (N, C) array, 1 where the prediction was correct
+    :param bins: number of bins
+    :return: (C, bins) arrays of the count, summed probability and summed hits in each bin
+    """
+    n_columns = probabilities.shape[1]
+    indexes = bin_indexes(probabilities, bins)
+    in_bin = (indexes >= 0) & (indexes < bins)
+
+    # Give each column its own range of bins so they can all be counted at once
+    flat_indexes = (np.arange(n_columns)[np.newaxis, :] * bins + indexes)[in_bin]
+    size = n_columns * bins
+
+    counts = np.bincount(flat_indexes, minlength=size).reshape(n_columns, bins)
+    sums = np.bincount(flat_indexes, weights=probabilities[in_bin], minlength=size).reshape(n_columns, bins)
+    hit_sums = np.bincount(flat_indexes, weights=hits[in_bin], minlength=size).reshape(n_columns, bins)
+
+    return counts, sums, hit_sums
+
+
+def calibration_errors(confidences, accuracies, counts):
+    """
+    Expected and maximum calibration error over the bins of each row
+    :param confidences: (C, bins) average probability in each bin, nan where the bin is empty
+    :param accuracies: (C, bins) fraction of correct predictions in each bin, nan where the bin is empty
+    :param counts: (C, bins) number of predictions in each bin
+    :return: ECE and MCE of each row
+    """
+    gaps = np.where(counts > 0, np.abs(accuracies - confidences), 0.0)
+    totals = np.maximum(counts.sum(axis=1), 1)
+
+    return (counts * gaps).sum(axis=1) / totals, gaps.max(axis=1)
+
+
+def reliability(probabilities, labels, bins):
+    """
+    Builds reliability diagrams for each class, where a prediction in a class's bin is correct if the image is of
+    that class, and for the top label, where the confidence is the highest probability
+    :param probabilities: (N, C) array of probabilities
+    :param labels: the real answer for each prediction
+    :param bins: number of equally sized bins between 0 and 1
+    :return: dictionary holding the per class confidences, accuracies, counts, ECE and MCE, and the same for the
+    top label under the overall_ keys
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.int64)
+    n_classes = probabilities.shape[1]
+
+    is_class = (labels[:, np.newaxis] == np.arange(n_classes)[np.newaxis, :]).astype(np.float64)
+    counts, sums, hit_sums = sum_bins(probabilities, is_class, bins)
+
+    top_probabilities = probabilities.max(axis=1)[:, np.newaxis]
+    correct = (probabilities.argmax(axis=1) == labels).astype(np.float64)[:, np.newaxis]
+    overall_counts, overall_sums, overall_hit_sums = sum_bins(top_probabilities, correct, bins)
+
+    # Empty bins are left as nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        confidences = sums / counts
+        accuracies = hit_sums / counts
+        overall_confidences = overall_sums / overall_counts
+        overall_accuracies = overall_hit_sums / overall_counts
+
+    ECE, MCE = calibration_errors(confidences, accuracies, counts)
+    overall_ECE, overall_MCE = calibration_errors(overall_confidences, overall_accuracies, overall_counts)
+
+    return {'confidences': confidences, 'accuracies': accuracies, 'counts': counts, 'ECE': ECE, 'MCE': MCE,
+            'overall_confidences': overall_confidences[0], 'overall_accuracies': overall_accuracies[0],
+            'overall_counts': overall_counts[0], 'overall_ECE': overall_ECE[0], 'overall_MCE': overall_MCE[0]}
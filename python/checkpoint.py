@@ -0,0 +1,159 @@
+"""
+checkpoint.py: Background writer for the checkpoints saved by helper.save_network. Each save copies the state
+dicts to cpu memory and returns, a worker thread writes them to disk with an atomic rename. Saves of the same
+directory and epoch that haven't been written yet are merged into one, and the best accuracy and best loss
+checkpoints are kept as hard links to the file written for that epoch. Single files, such as the mid-epoch training
+state, are written the same way with only the latest queued save of a path kept
+"""
+
+import os
+import csv
+import atexit
+import threading
+import torch
+
+
+def to_cpu(state):
+    """
+    Copies every tensor in a (possibly nested) state dict to cpu memory, so training can carry on changing them
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+
+    return state
+
+
+def replace_file(temp_path, path):
+    """
+    Flushes a written temporary file to disk and renames it over path, so path is never left half written
+    """
+    with open(temp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a single worker thread, in the order they were saved
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.condition = threading.Condition()
+        self.writing = False
+        self.error = None
+        self.thread = None
+
+    def save(self, states, metrics, root_dir, epoch, tags=()):
+        """
+        Queues a checkpoint to be written, merging it with a queued checkpoint of the same directory and epoch
+        :param states: dictionary of the network, optimizer and lr_sched state dicts
+        :param metrics: dictionary of CSV filename to the list of values to write to it
+        :param root_dir: directory to save to
+        :param epoch: epoch the checkpoint was saved in
+        :param tags: names of hard links to keep to this checkpoint, i.e. best_acc or best_loss
+        """
+        job = {'states': to_cpu(states), 'metrics': {name: list(values) for name, values in metrics.items()},
+               'root_dir': root_dir, 'epoch': epoch, 'tags': set(tags)}
+
+        with self.condition:
+            for pending in self.pending:
+                if pending.get('root_dir') == root_dir and pending.get('epoch') == epoch:
+                    job['tags'] |= pending['tags']
+                    self.pending.remove(pending)
+                    break
+
+            self.queue(job)
+
+    def save_file(self, states, path):
+        """
+        Queues a single state dictionary to be written to path, replacing any queued save of the same path
+        :param states: dictionary to save with torch.save
+        :param path: location to save to
+        """
+        job = {'states': to_cpu(states), 'path': path}
+
+        with self.condition:
+            self.pending = [pending for pending in self.pending if pending.get('path') != path]
+            self.queue(job)
+
+    def queue(self, job):
+        # Called holding the condition
+        self.raise_error()
+        self.pending.append(job)
+        self.condition.notify_all()
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                job = self.pending.pop(0)
+                self.writing = True
+
+            try:
+                self.write(job)
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def write(self, job):
+        if 'path' in job:
+            torch.save(job['states'], job['path'] + ".tmp")
+            replace_file(job['path'] + ".tmp", job['path'])
+            return
+
+        root_dir = job['root_dir']
+        if not os.path.isdir(root_dir):
+            os.makedirs(root_dir)
+
+        path = root_dir + "model_parameters"
+        torch.save(job['states'], path + ".tmp")
+        replace_file(path + ".tmp", path)
+
+        for tag in sorted(job['tags']):
+            # Link to this epoch's file, later epochs replace model_parameters with a new file and leave it alone
+            tag_path = f"{path}_{tag}"
+            if os.path.exists(tag_path + ".tmp"):
+                os.remove(tag_path + ".tmp")
+            os.link(path, tag_path + ".tmp")
+            os.replace(tag_path + ".tmp", tag_path)
+
+        for filename, values in job['metrics'].items():
+            with open(root_dir + filename + ".tmp", 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(values)
+            replace_file(root_dir + filename + ".tmp", root_dir + filename)
+
+    def flush(self):
+        """
+        Waits until every queued checkpoint has been written
+        """
+        with self.condition:
+            while self.pending or self.writing:
+                self.condition.wait()
+            self.raise_error()
+
+    def raise_error(self):
+        # Pass a failed write on to the training thread
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+
+checkpoint_writer = CheckpointWriter()
+# The worker is a daemon thread, so write out anything still queued before the interpreter exits
+atexit.register(checkpoint_writer.flush)
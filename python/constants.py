@@ -17,4 +17,38 @@ ISIC_pred = False
 TRAIN = True
 NUM_MODELS = 1
 IMAGE_SIZE = 224
+IMAGE_CACHE = False  # Toggle this to decode the images once into a memory mapped cache
+IMAGE_CACHE_DIR = "image_cache"
+IMAGE_CACHE_SIZE = int(IMAGE_SIZE * 1.5)
+HEAD_ONLY = False  # Toggle this to freeze the backbone and train the head from cached features
+FEATURE_DTYPE = "float16"
+COST_MATRIX_PATH = None  # CSV cost matrix to use in place of costs.COST_MATRIX
+CASCADE = False  # Toggle this to only sample images the softmax response is uncertain about
+CASCADE_THRESHOLD = 0.5  # normalised entropy
+CASCADE_COST = False  # escalate on the lowest expected cost rather than the entropy
+CASCADE_COST_THRESHOLD = 1.0
+BBB_PRIOR = "mixture"  # mixture, gaussian or learned, gaussian priors use a closed form KL divergence
+BBB_PRIOR_SIGMA = 1.0
+FLIPOUT = False
+BBB_WARM_START = False  # start BbB from the trained softmax model rather than from scratch
+BBB_WARM_START_SIGMA = 0.01
+BBB_WARM_START_EPOCHS = 5
+MOMENT_PROPAGATION = False
+LAPLACE = False
+LAPLACE_HESSIAN = "kfac"  # kfac or diag
+FEATURE_DENSITY = False
+DENSITY_COVARIANCE = "class"  # class or shared
+SELECTIVE = False
+SELECTIVE_COVERAGE = 0.8
+ENSEMBLE_SIZE = 1  # number of BatchEnsemble members, 1 for a single model
+STEP_CHECKPOINT_INTERVAL = 0  # batches between mid-epoch training state saves, 0 to turn off
+SWAG = False
+SWAG_HEAD_ONLY = True  # collect only the head weights, so cached backbone features can be reused
+SWAG_CYCLES = 2
+SWAG_SNAPSHOTS = 10  # weights collected per learning rate cycle
+SWAG_RANK = 20
+SWAG_BN_UPDATE_SIZE = 2000  # training images the BatchNorm statistics are recomputed over after each weight sample
+DISTIL = False
+DISTIL_EPOCHS = 30
+LOCAL_REPARAMETERIZATION = False  # Toggle this to sample BBB outputs rather than weights at inference
 DEVICE = torch.device("cuda")
\ No newline at end of file
@@ -0,0 +1,116 @@
+"""
+costs.py: Holds the cost matrix used for lowest expected cost (LEC) decisions and the true cost of each
+classification. The matrices are built once and applied to whole arrays of predictions at a time
+"""
+
+import numpy as np
+
+# Rows are the true class, columns the predicted class
+COST_MATRIX = [
+    [0, 150, 10, 10, 150, 150, 10, 1],
+    [10, 0, 10, 10, 1, 1, 10, 10],
+    [10, 30, 0, 1, 30, 30, 1, 10],
+    [10, 20, 1, 0, 20, 20, 1, 10],
+    [10, 1, 10, 10, 0, 1, 10, 10],
+    [10, 1, 10, 10, 1, 0, 10, 10],
+    [10, 20, 1, 1, 20, 20, 0, 10],
+    [1, 150, 10, 10, 150, 150, 10, 0]]
+
+
+def add_uncertain(cost_matrix, cost):
+    """
+    Adds an extra class for classifying as unknown, which costs the same whatever the true class is
+    :param cost_matrix: square numpy cost matrix
+    :param cost: the cost of classifying as unknown, also used as the cost of an unknown true class
+    :return: cost matrix with an extra row and column
+    """
+    n_classes = len(cost_matrix)
+    new_matrix = np.full((n_classes + 1, n_classes + 1), cost, dtype=np.float64)
+    new_matrix[:n_classes, :n_classes] = cost_matrix
+    new_matrix[n_classes, n_classes] = 0
+
+    return new_matrix
+
+
+class CostModel:
+    """
+    Holds a cost matrix along with its variants, with an extra unknown class and with every miss-classification
+    flattened to a cost of 1, and applies them to single predictions or whole (N, C) or (P, N, C) arrays
+    """
+
+    def __init__(self, cost_matrix, uncertain_cost=10):
+        """
+        :param cost_matrix: square cost matrix, rows are the true class and columns the predicted class
+        :param uncertain_cost: cost of classifying as unknown
+        """
+        cost_matrix = np.asarray(cost_matrix, dtype=np.float64)
+        flat_matrix = 1 - np.eye(len(cost_matrix))
+
+        self.matrices = {
+            (False, False): cost_matrix,
+            (True, False): add_uncertain(cost_matrix, uncertain_cost),
+            (False, True): flat_matrix,
+            (True, True): add_uncertain(flat_matrix, 1)
+        }
+
+    def get_matrix(self, uncertain=False, flatten=False):
+        """
+        :param uncertain: include the extra class for classifying as unknown
+        :param flatten: make all costs of miss-classification 1
+        :return: the cost matrix
+        """
+        return self.matrices[(uncertain, flatten)]
+
+    def expected_costs(self, probabilities, uncertain=False):
+        """
+        Finds the expected cost of making each decision
+        :param probabilities: probability distributions, with classes along the last axis
+        :param uncertain: include the extra class for classifying as unknown
+        :return: expected cost of each decision, the same shape as probabilities
+        """
+        return np.matmul(probabilities, self.get_matrix(uncertain))
+
+    def lowest_cost(self, probabilities, uncertain=False):
+        """
+        Selects the lowest expected cost decision for each probability distribution
+        :param probabilities: probability distributions, with classes along the last axis
+        :param uncertain: include the extra class for classifying as unknown
+        :return: the LEC decisions and their expected costs
+        """
+        costs = self.expected_costs(probabilities, uncertain)
+
+        return np.argmin(costs, axis=-1), np.min(costs, axis=-1)
+
+    def true_costs(self, predictions, answers, uncertain=False, flatten=False):
+        """
+        Finds the true cost of classification decisions
+        :param predictions: classification decisions
+        :param answers: real answers, broadcast against predictions
+        :param uncertain: include the extra class for classifying as unknown
+        :param flatten: make all costs of miss-classification 1
+        :return: true cost of each decision
+        """
+        return self.get_matrix(uncertain, flatten)[answers, predictions]
+
+
+def load_cost_model(path, uncertain_cost=10):
+    """
+    Reads a cost matrix from a file of comma separated values
+    :param path: location of the cost matrix
+    :param uncertain_cost: cost of classifying as unknown
+    :return: CostModel for the read matrix
+    """
+    return CostModel(np.loadtxt(path, delimiter=','), uncertain_cost)
+
+
+def use_cost_matrix(path, uncertain_cost=10):
+    """
+    Replaces the matrices of the module level cost_model with the cost matrix read from path. Done in place, so
+    every module that has already imported cost_model uses the new matrix
+    :param path: location of the cost matrix
+    :param uncertain_cost: cost of classifying as unknown
+    """
+    cost_model.matrices = load_cost_model(path, uncertain_cost).matrices
+
+
+cost_model = CostModel(COST_MATRIX)
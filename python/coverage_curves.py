@@ -0,0 +1,119 @@
+"""
+coverage_curves.py: Builds the risk coverage and cost coverage curves plotted in data_plotting.py. Each curve is
+made by sorting the predictions once by their uncertainty or LEC and taking cumulative sums, rather than
+repeatedly finding and deleting the most uncertain prediction
+"""
+
+import numpy as np
+from costs import cost_model
+
+
+def area_under_curve(x, y):
+    """
+    Trapezoidal area under a curve, x may be increasing or decreasing as in sklearn.metrics.auc
+    :return: the area under the curve
+    """
+    x = np.asarray(x, dtype=np.float64)
+    area = np.trapz(y, x)
+
+    if len(x) > 1 and np.all(np.diff(x) <= 0):
+        area = -area
+
+    return area
+
+
+def removal_order(keys, highest_first):
+    """
+    Order predictions are removed in when the highest (or lowest) key is removed one at a time, ties are removed
+    in the order they appear
+    :param keys: uncertainty or LEC of each prediction
+    :param highest_first: remove the highest key first, otherwise the lowest
+    :return: indexes in the order they are removed
+    """
+    keys = np.asarray(keys, dtype=np.float64)
+    if highest_first:
+        keys = -keys
+
+    return np.argsort(keys, kind='stable')
+
+
+def remaining_averages(values, order):
+    """
+    Average of the values still remaining after each removal
+    :param values: value of each prediction, such as its true cost or whether it was correct
+    :param order: order the predictions are removed in
+    :return: N + 1 averages, the first over every prediction and the last 0 once all have been removed
+    """
+    sorted_values = np.asarray(values, dtype=np.float64)[order]
+    # Sum of everything from each position to the end
+    remaining_sums = np.cumsum(sorted_values[::-1])[::-1]
+    remaining_counts = np.arange(len(sorted_values), 0, -1)
+
+    return np.append(remaining_sums / remaining_counts, 0.0)
+
+
+def risk_coverage(probabilities, labels, uncertainties):
+    """
+    Accuracy of the predictions that remain as the most uncertain are removed
+    :param probabilities: (N, C) array of probabilities
+    :param labels: the real answer for each prediction
+    :param uncertainties: uncertainty of each prediction
+    :return: coverage, accuracy and the area under the curve
+    """
+    n_samples = len(labels)
+    correct = np.argmax(probabilities, axis=1) == np.asarray(labels)
+
+    accuracy = remaining_averages(correct, removal_order(uncertainties, highest_first=True))[:n_samples]
+    coverage = np.arange(n_samples - 1, -1, -1) / n_samples
+
+    return coverage, accuracy, area_under_curve(coverage, accuracy)
+
+
+def true_cost_coverage(predictions, labels, costs=True, uncertain=False, flatten=False):
+    """
+    Average test cost of the predictions that remain as the highest LEC or the least probable are removed
+    :param predictions: (N, C) array of expected costs or probabilities
+    :param labels: the real answer for each prediction
+    :param costs: whether predictions holds expected costs, decided with the LEC, or probabilities
+    :param uncertain: use the cost matrix with an extra cost for classifying as unknown
+    :param flatten: use a cost matrix of all 1's
+    :return: coverage from 1 down to 0, the average test cost at each coverage and the area under the curve
+    """
+    predictions = np.asarray(predictions, dtype=np.float64)
+    n_samples = len(predictions)
+
+    if costs:
+        decisions = np.argmin(predictions, axis=1)
+        keys = np.min(predictions, axis=1)
+    else:
+        decisions = np.argmax(predictions, axis=1)
+        keys = np.max(predictions, axis=1)
+
+    values = cost_model.true_costs(decisions, np.asarray(labels, dtype=np.int64), uncertain, flatten)
+    averages = remaining_averages(values, removal_order(keys, highest_first=costs))
+
+    # The area is taken over increasing coverage against the averages in removal order
+    area = area_under_curve(np.arange(0, n_samples + 1) / n_samples, averages)
+    coverage = np.arange(n_samples, -1, -1) / n_samples
+
+    return coverage, averages, area
+
+
+def cost_coverage(costs, uncertainty=False):
+    """
+    Average LEC as the coverage grows, adding the lowest LEC (or least uncertain) prediction first
+    :param costs: (N, C) array of expected costs, with an uncertainty column last if uncertainty is True
+    :param uncertainty: order the predictions by the uncertainty column rather than their LEC
+    :return: coverage and the average LEC at each coverage
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    n_samples = len(costs)
+
+    if uncertainty:
+        lowest_costs = np.delete(costs[np.argsort(costs[:, -1])], -1, axis=1).min(axis=1)
+    else:
+        lowest_costs = np.sort(costs.min(axis=1))
+
+    counts = np.arange(1, n_samples + 1)
+
+    return counts / n_samples, np.cumsum(lowest_costs) / counts
@@ -4,10 +4,12 @@ File used for handling the data set
 
 from __future__ import print_function, division
 import os
+import json
 import pandas as pd
 import numpy as np
+import torch
 from PIL import Image
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import torchvision.transforms.functional as TrsF
 from tqdm import tqdm
 
@@ -16,12 +18,14 @@ class data_set(Dataset):
     """
     class responsible for handling and dynamically retreiving data from the data set
     """
-    def __init__(self, root_dir, labels_path=False, transforms=None, seed=1337):
+    def __init__(self, root_dir, labels_path=False, transforms=None, seed=1337, cache_dir=None, cache_size=None):
         """
         Init responsible for holding the list of filenames from which you can fetch data from
         :param root_dir: path to the images files
         :param labels_path: path to the filenames and labels
         :param transforms: transforms to be applied to the data
+        :param cache_dir: if given, images are decoded once into a memory mapped cache in this directory
+        :param cache_size: length of the shorter side of the cached images
         """
 
         self.train_image_dir = root_dir
@@ -37,9 +41,17 @@ class data_set(Dataset):
             np.random.seed(seed)
             # Shuffle the labels here for stratified sampling
             np.random.shuffle(self.labels)
+
+            # Look every label up once here rather than on each call
+            self.label_indexes = np.argmax(self.labels[:, 1:-1] == 1.0, axis=1).astype(np.int8)
+            self.label_file_names = np.array([name + '.jpg' for name in self.labels[:, 0]])
         else:
             self.labels = False
 
+        self.cache = None
+        if cache_dir:
+            self.build_cache(cache_dir, cache_size)
+
     def __len__(self):
         return len(self.file_names)
 
@@ -54,13 +66,19 @@ class data_set(Dataset):
         if self.labels is False:
             file_name = self.file_names[index]
         else:
-            file_name = self.labels[index][0] + '.jpg'
+            file_name = self.label_file_names[index]
         full_path = os.path.join(self.train_image_dir, file_name)
-        image = Image.open(full_path)
+
+        image = None
+        if self.cache is not None:
+            image = self.cache.get(file_name, full_path)
+        if image is None:
+            image = Image.open(full_path)
+
         if self.labels is False:
             label = False
         else:
-            label = self.get_class_name(self.labels[index][1:-1])
+            label = int(self.label_indexes[index])
 
         if self.transforms:
             image = self.transforms(image)
@@ -69,23 +87,42 @@ class data_set(Dataset):
 
         return data
 
+    def build_cache(self, cache_dir, cache_size):
+        """
+        Decodes every image in the data set once at the given size and stores them in a memory mapped cache,
+        __getitem__ then reads from the cache instead of decoding the jpeg each time
+        :param cache_dir: directory to hold the cache file and its index
+        :param cache_size: length of the shorter side of the cached images, should be larger than the size the
+        transforms crop to so augmentation has room to work with
+        """
+        if self.labels is False:
+            file_names = self.file_names
+        else:
+            file_names = self.label_file_names
+
+        self.cache = ImageCache(cache_dir, cache_size)
+        self.cache.build(self.train_image_dir, file_names)
+
     def get_filename(self, index):
-        return self.labels[index][1:] + '.jpg'
+        return self.label_file_names[index]
 
     def get_label(self, index):
         """
         Returns the label as an integer at the specified index
         """
-        return self.get_class_name(self.labels[index][1:-1])
-
-    def get_all_labels(self, test_indexes):
+        return int(self.label_indexes[index])
 
-        answers = []
-        for i in range(0, len(test_indexes)):
-            answers.append(self.get_class_name(self.labels[test_indexes[i]][1:-1]))
+    def get_labels(self, indexes):
+        """
+        Returns the labels at all the specified indexes in one go
+        :param indexes: list or array of indexes into the data set
+        :return: numpy array of integer labels
+        """
+        return self.label_indexes[np.asarray(indexes, dtype=np.int64)]
 
-        return answers
+    def get_all_labels(self, test_indexes):
 
+        return self.get_labels(test_indexes).tolist()
 
     def count_classes(self):
 
@@ -97,14 +134,9 @@ class data_set(Dataset):
         LABELS = {0: 'MEL', 1: 'NV', 2: 'BCC', 3: 'AK', 4: 'BKL', 5: 'DF', 6: 'VASC', 7: 'SCC', 8: 'UNK'}
         labels_count = {'MEL': 0, 'NV': 0, 'BCC': 0, 'AK': 0, 'BKL': 0, 'DF': 0, 'VASC': 0, 'SCC': 0, 'UNK': 0}
         print("Counting labels")
-        for index in tqdm(range(len(self))):
-
-            label = self.get_class_name(self.labels[index][1:-1])
-            label = LABELS[label]
-            try:
-                labels_count[label] += 1
-            except Exception as e:
-                continue
+        counts = np.bincount(self.label_indexes, minlength=len(LABELS))
+        for label, count in enumerate(counts):
+            labels_count[LABELS[label]] = int(count)
 
         print(labels_count)
 
@@ -163,6 +195,195 @@ class data_set(Dataset):
         self.transforms = transforms
 
 
+class ResumableWeightedSampler(Sampler):
+    """
+    Weighted random sampler with replacement, like WeightedRandomSampler, whose index sequence for the current epoch
+    can be saved and restored, so an epoch stopped part way through carries on with the indices it had left
+    """
+    def __init__(self, weights, num_samples):
+        """
+        :param weights: weight of each sample
+        :param num_samples: number of samples to draw each epoch
+        """
+        self.weights = torch.as_tensor(weights, dtype=torch.double)
+        self.num_samples = num_samples
+        # Sequence and start position restored by load_state_dict, used by the next epoch
+        self.indices = None
+        self.start = 0
+        # Sequence and start position of the epoch being iterated over
+        self.current_indices = None
+        self.current_start = 0
+
+    def __iter__(self):
+        if self.indices is None:
+            self.indices = torch.multinomial(self.weights, self.num_samples, replacement=True)
+
+        self.current_indices, self.current_start = self.indices, self.start
+        self.indices, self.start = None, 0
+
+        return iter(self.current_indices[self.current_start:].tolist())
+
+    def __len__(self):
+        if self.indices is None:
+            return self.num_samples
+        return self.num_samples - self.start
+
+    def state_dict(self, consumed):
+        """
+        :param consumed: number of indices of the current epoch that have been trained on
+        :return: the current epoch's index sequence and the position to carry on from
+        """
+        return {'indices': self.current_indices, 'start': self.current_start + consumed}
+
+    def load_state_dict(self, state):
+        self.indices = state['indices']
+        self.start = state['start']
+
+
+class ImageCache(object):
+    """
+    Holds pre-decoded and pre-resized images in a single memory mapped uint8 file. Each image is stored as a flat
+    (height, width, 3) block, with an index file keyed by filename holding the offset and shape of each block
+    alongside the modification time and size of the source image, so stale entries are re-decoded.
+    """
+
+    def __init__(self, cache_dir, image_size):
+        """
+        :param cache_dir: directory to hold the cache
+        :param image_size: length of the shorter side of the cached images
+        """
+        self.cache_dir = cache_dir
+        self.image_size = image_size
+        self.data_path = os.path.join(cache_dir, "images.bin")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.index = {}
+        self.data = None
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        if os.path.exists(self.index_path) and os.path.exists(self.data_path):
+            with open(self.index_path) as f:
+                saved = json.load(f)
+            # A cache built at a different resolution is no use to us
+            if saved['image_size'] == image_size:
+                self.index = saved['entries']
+
+    def __getstate__(self):
+        # Don't pickle the memory map, each data loader worker opens its own
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def is_valid(self, file_name, full_path):
+        """
+        Checks the cached entry against the source image
+        :return: True if the source image has not changed since it was cached
+        """
+        entry = self.index.get(file_name)
+        if entry is None:
+            return False
+        stat = os.stat(full_path)
+        return entry[3] == stat.st_mtime_ns and entry[4] == stat.st_size
+
+    def decode(self, full_path):
+        """
+        Decodes an image and resizes its shorter side to the cache size, in the same way transforms.Resize does
+        :return: the image as a uint8 array of shape (height, width, 3)
+        """
+        image = Image.open(full_path).convert('RGB')
+        width, height = image.size
+        if width < height:
+            new_width = self.image_size
+            new_height = int(self.image_size * height / width)
+        else:
+            new_height = self.image_size
+            new_width = int(self.image_size * width / height)
+        image = image.resize((new_width, new_height), Image.BILINEAR)
+
+        return np.asarray(image, dtype=np.uint8)
+
+    def build(self, image_dir, file_names):
+        """
+        Decodes any image that is missing from the cache or has changed on disk and appends it to the cache file.
+        If any cached image has changed, the cache file is compacted so the blocks of the old versions are reclaimed
+        :param image_dir: directory holding the source images
+        :param file_names: the filenames of every image that should be cached
+        """
+        stale = [name for name in file_names if not self.is_valid(name, os.path.join(image_dir, name))]
+
+        if stale:
+            print(f"Caching {len(stale)} images at size {self.image_size}")
+            self.data = None
+
+            if any(name in self.index for name in stale):
+                self.compact(set(stale))
+
+            # Start from scratch if the index was thrown away, otherwise append after the existing entries
+            mode = 'ab' if self.index else 'wb'
+            with open(self.data_path, mode) as f:
+                offset = f.tell()
+                for name in tqdm(stale):
+                    full_path = os.path.join(image_dir, name)
+                    stat = os.stat(full_path)
+                    image = self.decode(full_path)
+                    f.write(image.tobytes())
+                    self.index[name] = [offset, image.shape[0], image.shape[1], stat.st_mtime_ns, stat.st_size]
+                    offset += image.nbytes
+
+            # Write the index to a temporary file first so a crash never leaves a half written index behind
+            temp_path = self.index_path + ".tmp"
+            with open(temp_path, 'w') as f:
+                json.dump({'image_size': self.image_size, 'entries': self.index}, f)
+            os.replace(temp_path, self.index_path)
+
+        self.data = None
+
+    def compact(self, dropped):
+        """
+        Copies every entry not in dropped into a new cache file, which then replaces the old one
+        :param dropped: filenames of the entries to leave out
+        """
+        data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        temp_path = self.data_path + ".tmp"
+        index = {}
+
+        with open(temp_path, 'wb') as f:
+            offset = 0
+            for name, entry in self.index.items():
+                if name in dropped:
+                    continue
+                start, height, width = entry[:3]
+                size = height * width * 3
+                f.write(data[start: start + size].tobytes())
+                index[name] = [offset] + entry[1:]
+                offset += size
+        del data
+
+        # Remove the old index first, so a crash before the new one is written rebuilds the cache rather than
+        # reading the new file with the old offsets
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.replace(temp_path, self.data_path)
+        self.index = index
+
+    def get(self, file_name, full_path):
+        """
+        Returns the cached image, reading directly from the memory map
+        :return: PIL image, or None if the image is not cached or has changed on disk
+        """
+        if not self.is_valid(file_name, full_path):
+            return None
+
+        if self.data is None:
+            self.data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+
+        offset, height, width = self.index[file_name][:3]
+        image = self.data[offset: offset + height * width * 3].reshape(height, width, 3)
+
+        return Image.fromarray(image, 'RGB')
+
+
 class RandomCrop(object):
     # Unused
     """
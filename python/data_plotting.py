@@ -5,6 +5,10 @@ File used to plot various data with matplotlib
 from __future__ import print_function, division
 import torch
 import helper
+import prediction_store
+import coverage_curves
+import calibration
+from costs import cost_model
 import matplotlib.pyplot as plt
 from torchvision import transforms
 from tqdm import tqdm
@@ -156,22 +160,11 @@ class DataPlotting:
         :return:
         """
 
-        bin_count = []
-        class_probabilities = np.delete(deepcopy(predictions), -1, axis=1)
+        class_probabilities = np.delete(np.array(predictions), -1, axis=1)
+        bin_count = calibration.count_bins(class_probabilities, bins)
 
-        for i in range(0, 8):
-            current_probabilities = class_probabilities[:, i: i + 1]
-            current_count = []
-
-            for c in range(1, bins + 1):
-                if skip_first and c == 1:
-                    continue
-
-                total = len(current_probabilities[
-                    (current_probabilities <= c / bins) & (current_probabilities > c / bins - 1 / bins)])
-
-                current_count.append(total)
-            bin_count.append(current_count)
+        if skip_first:
+            bin_count = bin_count[:, 1:]
 
         figure, axs = plt.subplots(2, 4, figsize=(20, 10))
         titles = list(self.LABELS.values())
@@ -213,47 +206,19 @@ class DataPlotting:
 
         average_probs = []
         relative_freq = []
+        true_labels = self.data_loader.get_labels(self.test_indexes)
 
         for k in range(0, len(predictions)):
 
-            average_probs.append([])
-            relative_freq.append([])
-
-            prediction = deepcopy(predictions[k])
-            class_probabilities = np.delete(prediction, -1, axis=1)  # delete the uncertainty estimation
-
-            for i in tqdm(range(0, 8)):
-                current_average = []
-                current_freq = []
-                current_probabilities = class_probabilities[:, i: i+1]  # splice out only the class that we're concerned with
-
-                # Calculate how many probabilities appear within range
-                for c in range(1, bins + 1):
-                    average = current_probabilities[
-                                               (current_probabilities <= c/bins) & (current_probabilities > c/bins - 1/bins)].mean()
-
-                    # Catch cases where there is no value in the bin
-                    if np.isnan(average):
-                        continue
-
-                    current_average.append(average)
-                    correct = 0
-                    total = 0
-
-                    # Calculate how many actual correct answers occur within this range
-                    for j in range(0, len(current_probabilities)):
-                        if current_probabilities[j] <= c/bins and current_probabilities[j] > c/bins - 1/bins:
-                            if helper.is_prediction_corect(i, self.test_indexes[j], self.data_loader):
-                                correct += 1
-                            total += 1
+            class_probabilities = np.delete(np.array(predictions[k]), -1, axis=1)  # delete the uncertainty estimation
+            bins_k = calibration.reliability(class_probabilities, true_labels, bins)
 
-                    if correct == 0:
-                        current_freq.append(0)
-                    else:
-                        current_freq.append(correct/total)
+            print(f"{self.labels[k]} ECE: {round(bins_k['overall_ECE'], 4)}, MCE: {round(bins_k['overall_MCE'], 4)}")
 
-                average_probs[k].append(current_average)
-                relative_freq[k].append(current_freq)
+            # Skip the bins with no probabilities in them
+            in_bin = bins_k['counts'] > 0
+            average_probs.append([bins_k['confidences'][i][in_bin[i]] for i in range(0, 8)])
+            relative_freq.append([bins_k['accuracies'][i][in_bin[i]] for i in range(0, 8)])
 
         figure, axs = plt.subplots(2, 4, figsize=(20, 10))
         titles = list(self.LABELS.values())
@@ -291,48 +256,20 @@ class DataPlotting:
         :return:
         """
         accuracy = []
-        uncertainties = []
-        answers = []
-        coverage = []
-        predictions = deepcopy(predictions)
+        AUCs = []
+        answers = self.data_loader.get_labels(self.test_indexes)
 
+        # Remove the highest uncertainty and then remove that prediction from the answers and continually re-get average accuracy
         for i in range(0, len(predictions)):
-            accuracy.append([])
-            uncertainties.append([])
-            # add the uncertainty metrics to a seperate list
-            for pred in predictions[i]:
-                uncertainties[i].append(pred.pop())
-            predictions[i] = np.array(predictions[i])
-            uncertainties[i] = np.array(uncertainties[i])
-            # get all the answers in one list for easy removal later
-            answers.append(self.data_loader.get_all_labels(self.test_indexes))
+            prediction = np.array(predictions[i])
+            coverage, current_accuracy, AUC = coverage_curves.risk_coverage(prediction[:, :-1], answers,
+                                                                            prediction[:, -1])
+            accuracy.append(current_accuracy)
+            AUCs.append(AUC)
 
-        # Remove the highest uncertainty and then remove that prediction from the answers and continually re-get average accuracy
-        for i in tqdm(range(0, len(self.test_indexes))):
-            coverage.append(i/len(self.test_indexes))
-            for c in range(0, len(predictions)):
-                total = 0
-                correct = 0
-                for k in range(0, len(predictions[c])):
-                    predic = predictions[c][k].argmax()
-                    if predictions[c][k].argmax() == answers[c][k]:
-                        total += 1
-                        correct += 1
-                    else:
-                        total += 1
-
-                accuracy[c].append(correct/total)
-
-                max_uncertainty_row = np.unravel_index(uncertainties[c].argmax(), uncertainties[c].shape)[0]
-                predictions[c] = np.delete(predictions[c], max_uncertainty_row, axis=0)
-                uncertainties[c] = np.delete(uncertainties[c], max_uncertainty_row, axis=0)
-                del answers[c][max_uncertainty_row]
-
-        coverage.reverse()
-
-        softmax_AUC = round(metrics.auc(coverage, accuracy[0]), 3)
-        dropout_AUC = round(metrics.auc(coverage, accuracy[1]), 3)
-        BBB_AUC = round(metrics.auc(coverage, accuracy[2]), 3)
+        softmax_AUC = round(AUCs[0], 3)
+        dropout_AUC = round(AUCs[1], 3)
+        BBB_AUC = round(AUCs[2], 3)
 
         print("Softmax AUC: " + str(softmax_AUC))
         print("MC_dropout AUC: " + str(dropout_AUC))
@@ -368,46 +305,10 @@ class DataPlotting:
         """
 
         average_cost = []
-        coverage = []
-        costs_sorted_by_entropy = []
-        costs_sorted = []
-        # set up all the arrays
-        for i in range(0, len(costs)):
-            costs[i] = np.array(costs[i])
-            average_cost.append([])
-            costs_sorted_by_entropy.append([])
-            costs_sorted.append([])
-            if uncertainty:
-                # Sort the arrays by entropy to make removal easier
-                ind = np.argsort(costs[i][:, -1])
-                costs_sorted_by_entropy[i] = costs[i][ind]
-                costs_sorted_by_entropy[i] = np.delete(costs_sorted_by_entropy[i], -1, axis=1)
-
-                # put just the predictions in costs_sorted
-                for c in range(0, len(self.test_indexes)):
-
-                    costs_sorted[i].append(float(costs_sorted_by_entropy[i][c].min()))
-            else:
-                # sort the costs by highest LEC
-                for c in range(0, len(self.test_indexes)):
-                    lowest = np.unravel_index(costs[i].argmin(), costs[i].shape)
-                    costs_sorted[i].append(float(costs[i][lowest]))
-                    costs[i] = np.delete(costs[i], lowest[0], axis=0)
-
-        for i in tqdm(range(0, len(self.test_indexes))):
-            for c in range(0, len(costs)):
-                average_cost[c].append(sum(costs_sorted[c])/len(costs_sorted[c]))
-
-                # Remove highest cost and go again
-                costs_sorted[c].pop()
-
-            coverage.append(1 - i/len(self.test_indexes))
-
-        for c in range(0, len(costs)):
-            average_cost[c].reverse()
-
-        coverage.reverse()
 
+        for i in range(0, len(costs)):
+            coverage, current_average = coverage_curves.cost_coverage(costs[i], uncertainty=uncertainty)
+            average_cost.append(current_average)
 
         #dropout_AUC = round(metrics.auc(coverage, average_cost[0]), 3)
         #softmax_AUC = round(metrics.auc(coverage, average_cost[1]), 3)
@@ -445,80 +346,30 @@ class DataPlotting:
         :return:
         """
 
-        # set up initial arrays
-        values = []
         averages = []
-        new_preds = []
-        preds = []
-
+        AUCs = []
+        true_labels = self.data_loader.get_labels(self.test_indexes)
 
+        # Remove the highest LEC and then remove that cost from the test costs and continually re-get average test cost
         for i in range(0, len(predictions)):
-            preds.append([])
+            preds = np.array(predictions[i])
             if not uncertainty and not costs:
-                new_pred = deepcopy(predictions[i])
-                for p in new_pred:
-                    p.pop()
-                preds[i] = np.array(new_pred)
-            else:
-                preds[i] = np.array(predictions[i])
-            values.append([])
-            averages.append([])
-            new_preds.append([])
-
-
-        coverage = []
-        for i in range(0, len(self.test_indexes)):
-
-            true_label = self.data_loader.get_label(self.test_indexes[i])
-            # Find the costs of our predictions
-            if costs:
-                for c in range(0, len(preds)):
-                    values[c].append(helper.find_true_cost(np.argmin(preds[c][i]), true_label, flatten=flatten, uncertain=uncertainty))
-                    new_preds[c].append(np.min(preds[c][i]))
-
-            else:
-                for c in range(0, len(preds)):
-                    values[c].append(helper.find_true_cost(np.argmax(preds[c][i]), true_label, flatten=flatten, uncertain=uncertainty))
-                    new_preds[c].append(np.max(preds[c][i]))
-
-        # set the LEC to be the only prediction and average the test cost
-        for i in range(0, len(preds)):
-            preds[i] = np.array(new_preds[i])
-            averages[i].append(sum(values[i]) / len(values[i]))
-
-        coverage.append(0.0)
-
-        # Remove the highest LEC and then remove that cost from the test costs and continually re-get average test cost
-        for i in range(0, len(self.test_indexes)):
-            if costs:
-                for c in range(0, len(preds)):
-                    max_row = np.unravel_index(preds[c].argmax(), preds[c].shape)[0]
-                    preds[c] = np.delete(preds[c], max_row, axis=0)
-                    del values[c][max_row]
-
-            else:
-                for c in range(0, len(preds)):
-                    min_row = np.unravel_index(preds[c].argmin(), preds[c].shape)[0]
-                    preds[c] = np.delete(preds[c], min_row, axis=0)
-                    del values[c][min_row]
+                preds = preds[:, :-1]
 
-            coverage.append((i + 1)/len(self.test_indexes))
-            for c in range(0, len(preds)):
+            coverage, current_averages, AUC = coverage_curves.true_cost_coverage(preds, true_labels, costs=costs,
+                                                                                 uncertain=uncertainty,
+                                                                                 flatten=flatten)
+            averages.append(current_averages)
+            AUCs.append(AUC)
 
-                if len(values[c]) == 0:
-                    averages[c].append(0)
-                else:
-                    averages[c].append(sum(values[c]) / len(values[c]))
-
-        softmax_AUC = round(metrics.auc(coverage, averages[0]), 3)
-        dropout_AUC = round(metrics.auc(coverage, averages[1]), 3)
-        BBB_AUC = round(metrics.auc(coverage, averages[2]), 3)
+        softmax_AUC = round(AUCs[0], 3)
+        dropout_AUC = round(AUCs[1], 3)
+        BBB_AUC = round(AUCs[2], 3)
 
         print("Softmax AUC: " + str(softmax_AUC))
         print("MC_dropout AUC: " + str(dropout_AUC))
         print("BBB AUC: " + str(BBB_AUC))
 
-        coverage.reverse()
         plt.plot(coverage, averages[0], label="Softmax Response")
         plt.plot(coverage, averages[1], label="MC Dropout")
         plt.plot(coverage, averages[2], label="BbB")
@@ -544,104 +395,26 @@ class DataPlotting:
         :return:
         """
 
-        # Hold the entropy/uncertainty metrics
-        preds_copy = []
-        preds = []
-
-        for i in range(0, len(predictions)):
-            preds.append([])
-
-        # Remove the uncertainty estimation from the raw probabilities and changes the array to numpy arrays
-        if not costs:
-            for i in range(0, len(predictions)):
-                preds_copy.append(deepcopy(predictions[i]))
-
-                for c in range(0, len(predictions[i])):
-                    preds_copy[i][c].pop()
-
-                preds[i] = np.array(preds_copy[i])
-
-        else:
-
-            for i in range(0, len(predictions)):
-                preds[i] = np.array(predictions[i])
-
-        results = []
-        results_average = []
-        new_preds = []
-
-        # Attach dictionaries for by class classification
-        for i in range(0, len(preds)):
-            results.append({'MEL': [], 'NV': [], 'BCC': [], 'AK': [], 'BKL': [], 'DF': [], 'VASC': [], 'SCC': []})
-            results_average.append({'MEL': [], 'NV': [], 'BCC': [], 'AK': [], 'BKL': [], 'DF': [], 'VASC': [], 'SCC': []})
-            new_preds.append({'MEL': [], 'NV': [], 'BCC': [], 'AK': [], 'BKL': [], 'DF': [], 'VASC': [], 'SCC': []})
-
-        # Gets the indexes for where each specific class occurs in the test data
-        for i in range(0, len(preds)):
-            preds[i], label_indexes = helper.get_label_indexes(preds[i], self.test_indexes, self.data_loader)
-
+        true_labels = self.data_loader.get_labels(self.test_indexes)
         coverage = {}
-        # Creates coverage for x-axis matplotlib plot.
-        for key in results[0]:
-            coverage[key] = [i/len(label_indexes[key]) for i in range(0, len(label_indexes[key]) + 1)]
-            coverage[key].reverse()
-
-        # Cycles over all the predictions and creates a list of just the prediction, to make it easier to remove later
-        for key in label_indexes.keys():
-            indexes = label_indexes[key]
-
-            for i in range(0, len(indexes)):
-                true_label = self.data_loader.get_label(indexes[i])
-
-                for c in range(0, len(preds)):
-
-                    # Add only the current class probability to new_preds
-                    if costs:
-                        results[c][key].append(
-                            helper.find_true_cost(np.argmin(preds[c][key][i]), true_label, flatten=flatten))
-                        new_preds[c][key].append(np.min(preds[c][key][i]))
-
-                    else:
-                        results[c][key].append(
-                            helper.find_true_cost(np.argmax(preds[c][key][i]), true_label, flatten=flatten))
-                        new_preds[c][key].append(np.max(preds[c][key][i]))
-
-        # Set preds to be new_preds, just for ease of wording, also append the first result at coverage = 1
-        for i in range(0, len(preds)):
-
-            for key in new_preds[i]:
-                preds[i][key] = np.array(new_preds[i][key])
-
-            for key in results_average[i].keys():
-                results_average[i][key].append(sum(results[i][key])/len(results[i][key]))
-
-        """Cycles over each key and gets the index of the highest LEC or the lowest probability, removes the prediction
-        at that index and the result at that index, gets average test cost again, then repeats until all predictions 
-        have been removed."""
-        for key in label_indexes.keys():
-            indexes = label_indexes[key]
-
-            for i in range(0, len(indexes)):
-                for c in range(0, len(preds)):
-                    if costs:
-                        max_row = np.unravel_index(preds[c][key].argmax(), preds[c][key].shape)[0]
-                        preds[c][key] = np.delete(preds[c][key], max_row, axis=0)
-                        del results[c][key][max_row]
-
-                    else:
-                        min_row = np.unravel_index(preds[c][key].argmin(), preds[c][key].shape)[0]
-                        preds[c][key] = np.delete(preds[c][key], min_row, axis=0)
-                        del results[c][key][min_row]
+        results_average = []
 
-                    if len(preds[c][key]) == 0:
-                        results_average[c][key].append(0)
+        for i in range(0, len(predictions)):
+            results_average.append({})
+            preds = np.array(predictions[i])
 
-                    else:
-                        results_average[c][key].append(sum(results[c][key]) / len(results[c][key]))
+            # Remove the uncertainty estimation from the raw probabilities
+            if not costs:
+                preds = preds[:, :-1]
 
+            # Only look at the predictions made on images of each class
+            for label, key in self.LABELS.items():
+                in_class = true_labels == label
+                coverage[key], results_average[i][key], AUC = coverage_curves.true_cost_coverage(
+                    preds[in_class], true_labels[in_class], costs=costs, flatten=flatten)
 
         figure, axs = plt.subplots(2, 4, figsize=(20, 10))
-        titles = list(results[0].keys())
+        titles = list(self.LABELS.values())
         figure.suptitle(title)
         # add a big axis, hide frame
         figure.add_subplot(111, frameon=False)
@@ -807,8 +580,8 @@ class DataPlotting:
     def plot_each_mc_pass(self, mc_dir, BBB_dir, predictions_softmax, test_data, save_dir, title, cost_matrix=False):
         """
         plot the accuracy of each forward pass
-        :param mc_dir: directory for the mc predictions
-        :param BBB_dir: directory for the BBB predictions
+        :param mc_dir: directory holding the mc prediction store
+        :param BBB_dir: directory holding the BBB prediction store
         :param predictions_softmax: softmax predictions
         :param test_data: pytorch data loader
         :param save_dir: directory to save the plot
@@ -821,12 +594,13 @@ class DataPlotting:
         neg_avg_entropy = [[], [], []]
 
 
-        for i in tqdm(range(0, 100)):
-            current_mc_predictions = helper.read_rows(mc_dir + f"entropy/mc_forward_pass_{i}_" + "entropy" + ".csv")
-            current_mc_predictions = helper.string_to_float(current_mc_predictions)
+        mc_store = prediction_store.PredictionStore(mc_dir + "mc_forward_passes")
+        BBB_store = prediction_store.PredictionStore(BBB_dir + "BBB_forward_passes")
+        forward_passes = min(mc_store.passes, BBB_store.passes)
 
-            current_BBB_predictions = helper.read_rows(BBB_dir + f"entropy/BBB_forward_pass_{i}_" + "entropy" + ".csv")
-            current_BBB_predictions = helper.string_to_float(current_BBB_predictions)
+        for i in tqdm(range(0, forward_passes)):
+            current_mc_predictions = mc_store.get_pass(i, "entropy").tolist()
+            current_BBB_predictions = BBB_store.get_pass(i, "entropy").tolist()
 
             entropy = [[], [], []]
 
@@ -858,7 +632,7 @@ class DataPlotting:
                     (sum(entropy[c]) / len(entropy[c]) * -1) + (len(correct[c]) / len(self.test_indexes)) * 100)
 
 
-        passes = [i for i in range(0, 100)]
+        passes = [i for i in range(0, forward_passes)]
         for i in range(0, len(accuracy)):
             if i == 0:
                 plt.plot(passes, accuracy[i], '--', color=self.colours[i], label=self.labels[i])
@@ -882,31 +656,26 @@ class DataPlotting:
 
         costs_softmax = deepcopy(costs_softmax)
 
-        total = 0
-        for i in range(0, len(self.test_indexes)):
-            true_label = self.data_loader.get_label(self.test_indexes[i])
-            total += helper.find_true_cost(np.argmin(costs_softmax[i]), true_label)
+        true_labels = self.data_loader.get_labels(self.test_indexes)
+
+        total = cost_model.true_costs(np.argmin(np.array(costs_softmax), axis=1), true_labels).sum()
         sr_avg_cost = total/len(costs_softmax)
 
-        for i in tqdm(range(0, 100)):
-            current_costs = [[], []]
+        mc_store = prediction_store.PredictionStore(mc_dir + "mc_forward_passes")
+        BBB_store = prediction_store.PredictionStore(BBB_dir + "BBB_forward_passes")
 
-            current_costs[0] = helper.read_rows(mc_dir + f"costs/mc_forward_pass_{i}_costs.csv")
-            helper.remove_last_row(current_costs[0])
-            current_costs[0] = helper.string_to_float(current_costs[0])
+        for i in tqdm(range(0, min(mc_store.passes, BBB_store.passes))):
+            current_costs = [[], []]
 
-            current_costs[1] = helper.read_rows(BBB_dir + f"costs/BBB_forward_pass_{i}_costs.csv")
-            helper.remove_last_row(current_costs[1])
-            current_costs[1] = helper.string_to_float(current_costs[1])
+            # Drop the cost of classifying as unknown
+            current_costs[0] = mc_store.get_pass(i, "costs")[:, :-1]
+            current_costs[1] = BBB_store.get_pass(i, "costs")[:, :-1]
 
             passes.append(i)
             avg_costs[0].append(sr_avg_cost)
 
             for c in range(0, len(current_costs)):
-                total = 0
-                for i in range(0, len(self.test_indexes)):
-                    true_label = self.data_loader.get_label(self.test_indexes[i])
-                    total += helper.find_true_cost(np.argmin(current_costs[c][i]), true_label)
+                total = cost_model.true_costs(np.argmin(current_costs[c], axis=1), true_labels).sum()
 
                 avg = total/len(current_costs[c])
                 avg_costs[c + 1].append(avg)
@@ -0,0 +1,124 @@
+"""
+distillation.py: Distils the predictive distribution of an MC Dropout or BbB Classifier into a single pass
+StudentHead. The teacher's mean probabilities, mean entropy and summed variance over its forward passes are recorded
+once on the training set, then the student is trained on the teacher's backbone features to reproduce all three
+"""
+
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset, DataLoader
+from tqdm import tqdm
+import model
+
+
+def sample_entropy(probabilities):
+    """
+    Entropy in bits of each probability distribution, along the last axis
+    """
+    return -(probabilities * torch.log2(probabilities.clamp(min=1e-12))).sum(-1)
+
+
+def record_teacher(data_set, network, device, forward_passes=100, BBB=False, features=False):
+    """
+    Runs the teacher's forward passes over a data set, all passes of a batch at once
+    :param data_set: data loader over the training set
+    :param network: trained MC Dropout or BbB Classifier
+    :param device: device the network is on
+    :param forward_passes: number of times to sample the teacher
+    :param BBB: whether the teacher samples a varational posterior rather than dropout masks
+    :param features: whether data_set holds cached backbone features rather than images
+    :return: backbone features, mean probabilities, mean entropy and summed variance over the forward passes
+    """
+    efficient_net_outputs = []
+    probabilities = []
+    entropies = []
+    variances = []
+
+    network.eval()
+
+    for i_batch, sample_batch in enumerate(tqdm(data_set)):
+        image_batch = sample_batch['image'].to(device)
+
+        with torch.no_grad():
+            if features:
+                efficient_net_output = image_batch.float()
+            else:
+                efficient_net_output = network.extract_efficientNet(image_batch)
+
+            outputs = network.pass_through_layers(efficient_net_output, samples=forward_passes, dropout=not BBB,
+                                                  return_samples=True)[1]
+            samples = torch.softmax(outputs, dim=2)
+
+        efficient_net_outputs.append(efficient_net_output.cpu())
+        probabilities.append(samples.mean(0).cpu())
+        entropies.append(sample_entropy(samples).mean(0).cpu())
+        variances.append(samples.var(0, unbiased=False).sum(1).cpu())
+
+    return (torch.cat(efficient_net_outputs), torch.cat(probabilities), torch.cat(entropies),
+            torch.cat(variances))
+
+
+def train_student(student, teacher_record, device, epochs=30, batch_size=128, learning_rate=0.001):
+    """
+    Trains the student to match the teacher's mean probabilities with a KL divergence, and its entropy and variance
+    with a squared error. Each squared error is divided by the variance of its target over the recorded set, as the
+    entropy is in bits while the summed variance is around a hundred times smaller
+    :param student: StudentHead to train
+    :param teacher_record: output of record_teacher
+    :param device: device to train on
+    :param epochs: number of passes over the recorded training set
+    :param batch_size: batch size
+    :param learning_rate: learning rate of the Adam optimiser
+    :return: the per epoch losses
+    """
+    loader = DataLoader(TensorDataset(*teacher_record), batch_size=batch_size, shuffle=True)
+    optim = torch.optim.Adam(student.parameters(), lr=learning_rate)
+    kl_loss = nn.KLDivLoss(reduction='batchmean')
+    # Scale of each uncertainty target, so both get a similar share of the gradient
+    target_std = torch.stack(teacher_record[2:], dim=1).std(0).clamp(min=1e-8).to(device)
+    losses = []
+
+    student.train()
+
+    for epoch in range(0, epochs):
+        total_loss = torch.zeros(1, device=device)
+
+        for efficient_net_output, probabilities, entropies, variances in loader:
+            efficient_net_output = efficient_net_output.to(device)
+            probabilities = probabilities.to(device)
+            targets = torch.stack((entropies, variances), dim=1).to(device)
+
+            outputs, uncertainties = student(efficient_net_output)
+            uncertainty_loss = (((uncertainties - targets) / target_std) ** 2).mean()
+            loss = kl_loss(torch.log_softmax(outputs, dim=1), probabilities) + uncertainty_loss
+
+            optim.zero_grad()
+            loss.backward()
+            optim.step()
+            total_loss += loss.detach() * len(efficient_net_output)
+
+        losses.append(total_loss.item() / len(loader.dataset))
+        print(f"Student epoch {epoch}: loss {round(losses[-1], 5)}")
+
+    student.eval()
+
+    return losses
+
+
+def distil(data_set, network, device, forward_passes=100, BBB=False, features=False, epochs=30):
+    """
+    Records the teacher on data_set and trains a student head to reproduce it
+    :param data_set: data loader over the training set
+    :param network: trained MC Dropout or BbB Classifier to distil
+    :param device: device the network is on
+    :param forward_passes: number of times to sample the teacher
+    :param BBB: whether the teacher is a BbB Classifier
+    :param features: whether data_set holds cached backbone features rather than images
+    :param epochs: number of epochs to train the student for
+    :return: the trained StudentHead
+    """
+    teacher_record = record_teacher(data_set, network, device, forward_passes, BBB, features)
+    student = model.StudentHead(teacher_record[0].size()[1], network.output_size).to(device)
+    train_student(student, teacher_record, device, epochs)
+
+    return student
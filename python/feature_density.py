@@ -0,0 +1,120 @@
+"""
+feature_density.py: Deterministic uncertainty from the density of the backbone features, as in DDU. A gaussian is
+fitted to the extract_efficientNet features of each class in the training split, and test images are scored by the
+log density of their features under the mixture of those gaussians, so images unlike any seen in training are
+flagged without sampling the network
+"""
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+class FeatureDensity:
+    """
+    Gaussian discriminant analysis over the backbone features, with a covariance matrix for each class or one shared
+    between every class
+    """
+
+    def __init__(self, n_classes=8, covariance="class", jitter=1e-4):
+        """
+        :param n_classes: number of classes
+        :param covariance: "class" for a covariance matrix per class or "shared" for one tied covariance
+        :param jitter: added to the diagonal of each covariance matrix so it can be factorised
+        """
+        if covariance not in ("class", "shared"):
+            raise ValueError(f"Unknown covariance type {covariance}")
+
+        self.n_classes = n_classes
+        self.covariance = covariance
+        self.jitter = jitter
+        self.means = None
+        self.cholesky = None
+        self.log_determinants = None
+        self.log_weights = None
+
+    def fit(self, data_set, network, device, features=False):
+        """
+        Fits the class gaussians in one pass, accumulating the count, sum and sum of outer products of each class's
+        features batch by batch with one hot matrix products
+        :param data_set: data loader over the training set
+        :param network: Classifier whose backbone produces the features
+        :param device: device to hold the statistics on
+        :param features: whether data_set holds cached backbone features rather than images
+        :return: self
+        """
+        counts = None
+        sums = None
+        outer_sums = None
+
+        network.eval()
+
+        for i_batch, sample_batch in enumerate(tqdm(data_set)):
+            image_batch = sample_batch['image'].to(device)
+            label_batch = sample_batch['label'].to(device)
+
+            with torch.no_grad():
+                if features:
+                    efficient_net_output = image_batch
+                else:
+                    efficient_net_output = network.extract_efficientNet(image_batch)
+
+            efficient_net_output = efficient_net_output.double()
+            one_hot = torch.nn.functional.one_hot(label_batch, self.n_classes).double()
+
+            if counts is None:
+                size = efficient_net_output.size()[1]
+                counts = torch.zeros(self.n_classes, dtype=torch.float64, device=device)
+                sums = torch.zeros(self.n_classes, size, dtype=torch.float64, device=device)
+                outer_sums = torch.zeros(self.n_classes, size, size, dtype=torch.float64, device=device)
+
+            counts += one_hot.sum(0)
+            sums += one_hot.t() @ efficient_net_output
+            outer_sums += torch.einsum('nc,nd,ne->cde', one_hot, efficient_net_output, efficient_net_output)
+
+        counts = counts.clamp(min=1)
+        self.means = sums / counts[:, None]
+        # Scatter of each class about its own mean
+        scatter = outer_sums - counts[:, None, None] * self.means[:, :, None] * self.means[:, None, :]
+
+        if self.covariance == "shared":
+            covariances = (scatter.sum(0) / (counts.sum() - self.n_classes)).unsqueeze(0)
+        else:
+            covariances = scatter / (counts - 1).clamp(min=1)[:, None, None]
+
+        covariances = covariances + self.jitter * torch.eye(covariances.size()[1], dtype=torch.float64, device=device)
+        self.cholesky = torch.cholesky(covariances)
+        self.log_determinants = 2 * torch.log(torch.diagonal(self.cholesky, dim1=1, dim2=2)).sum(1)
+        self.log_weights = torch.log(counts / counts.sum())
+
+        return self
+
+    def class_log_densities(self, efficient_net_output):
+        """
+        Log density of each feature vector under each class gaussian, the Mahalanobis distances of the whole batch
+        to every class are found with one batched triangular solve
+        :param efficient_net_output: (batch, features) backbone features
+        :return: (batch, classes) log densities
+        """
+        if self.means is None:
+            raise RuntimeError("Call fit before scoring with the feature density")
+
+        efficient_net_output = efficient_net_output.double()
+        # (classes, features, batch) difference of every feature vector from every class mean
+        differences = (efficient_net_output.unsqueeze(0) - self.means.unsqueeze(1)).transpose(1, 2)
+        cholesky = self.cholesky.expand(self.n_classes, -1, -1)
+
+        whitened = torch.triangular_solve(differences, cholesky, upper=False)[0]
+        mahalanobis = (whitened ** 2).sum(1).t()
+
+        size = self.means.size()[1]
+        log_determinants = self.log_determinants.expand(self.n_classes)
+
+        return -0.5 * (mahalanobis + log_determinants.unsqueeze(0) + size * np.log(2 * np.pi))
+
+    def log_density(self, efficient_net_output):
+        """
+        :param efficient_net_output: (batch, features) backbone features
+        :return: log density of each feature vector under the mixture of the class gaussians
+        """
+        return torch.logsumexp(self.class_log_densities(efficient_net_output) + self.log_weights.unsqueeze(0), dim=1)
@@ -0,0 +1,111 @@
+"""
+features.py: Runs the ResNet50 backbone once over a data set and keeps the pooled features on disk as memory mapped
+arrays, so the classification head can be trained and evaluated many times without running the backbone again
+"""
+
+import os
+import json
+import torch
+import numpy as np
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+
+def backbone_fingerprint(network):
+    """
+    Summarises the backbone weights into a single number, used to tell if cached features are out of date. Buffers
+    are included, as a change to the BatchNorm running statistics changes the features too
+    :param network: the Classifier whose backbone produced the features
+    :return: the sum of every backbone parameter and buffer
+    """
+    with torch.no_grad():
+        total = 0.0
+        for tensor in list(network.model.parameters()) + list(network.model.buffers()):
+            total += tensor.double().sum().item()
+
+    return total
+
+
+def extract_features(data_set, network, device, root_dir, batch_size=16, dtype="float16"):
+    """
+    Runs the backbone over every image in data_set, in order, and saves the pooled features, labels and filenames
+    :param data_set: Pytorch data set to extract features from, should use deterministic transforms
+    :param network: Classifier to run extract_efficientNet with
+    :param device: device to run the backbone on
+    :param root_dir: directory to save the features to
+    :param batch_size: number of images to run through the backbone at once
+    :param dtype: float16 or float32, the type to store the features as
+    :return: FeatureSet reading from the saved features
+    """
+    if not os.path.isdir(root_dir):
+        os.makedirs(root_dir)
+
+    fingerprint = backbone_fingerprint(network)
+    meta_path = os.path.join(root_dir, "meta.json")
+
+    # Reuse the features if they were made by the same backbone
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['fingerprint'] == fingerprint and meta['size'] == len(data_set) and meta['dtype'] == dtype:
+            return FeatureSet(root_dir)
+
+    print(f"Extracting features to {root_dir}")
+    network.eval()
+    loader = DataLoader(data_set, batch_size=batch_size, shuffle=False)
+
+    features = None
+    labels = np.zeros(len(data_set), dtype=np.int64)
+    filenames = []
+    position = 0
+
+    with torch.no_grad():
+        for i_batch, sample_batch in enumerate(tqdm(loader)):
+            output = network.extract_efficientNet(sample_batch['image'].to(device)).cpu().numpy()
+
+            if features is None:
+                features = np.lib.format.open_memmap(os.path.join(root_dir, "features.npy"), mode='w+',
+                                                     dtype=dtype, shape=(len(data_set), output.shape[1]))
+
+            features[position: position + len(output)] = output
+            if torch.is_tensor(sample_batch['label']):
+                labels[position: position + len(output)] = sample_batch['label'].numpy()
+            filenames += list(sample_batch['filename'])
+            position += len(output)
+
+    features.flush()
+    del features
+    np.save(os.path.join(root_dir, "labels.npy"), labels)
+    np.save(os.path.join(root_dir, "filenames.npy"), np.array(filenames))
+
+    # Only write the meta data once everything else is on disk, so a partial extraction is never reused
+    with open(meta_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'size': len(data_set), 'dtype': dtype}, f)
+
+    return FeatureSet(root_dir)
+
+
+class FeatureSet(Dataset):
+    """
+    Data set of cached backbone features, returns items in the same layout as data_loading.data_set with the
+    features in place of the image
+    """
+
+    def __init__(self, root_dir):
+        self.features = np.load(os.path.join(root_dir, "features.npy"), mmap_mode='r')
+        self.labels = np.load(os.path.join(root_dir, "labels.npy"))
+        self.filenames = np.load(os.path.join(root_dir, "filenames.npy"))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        features = torch.from_numpy(self.features[index].astype(np.float32))
+
+        return {'image': features, 'label': int(self.labels[index]), 'filename': str(self.filenames[index])}
+
+    def get_label(self, index):
+        return int(self.labels[index])
+
+    def get_labels(self, indexes):
+        return self.labels[np.asarray(indexes, dtype=np.int64)]
@@ -11,10 +11,109 @@ import torch.optim as optimizer
 from copy import deepcopy
 import numpy as np
 import os
+import random
+from costs import cost_model
+from checkpoint import checkpoint_writer
 
 LABELS = {0: 'MEL', 1: 'NV', 2: 'BCC', 3: 'AK', 4: 'BKL', 5: 'DF', 6: 'VASC', 7: 'SCC'}
 
 
+class RunningMoments:
+    """
+    Keeps a running mean and variance of a stream of equally shaped arrays using Welford's algorithm, so the
+    statistics after each update are available without keeping every array in memory
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, values):
+        """
+        Adds a new array to the running statistics
+        :param values: numpy array, must be the same shape as every previous array
+        """
+        values = np.asarray(values, dtype=np.float64)
+        self.count += 1
+
+        if self.mean is None:
+            self.mean = values.copy()
+            self.m2 = np.zeros_like(values)
+            return
+
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+
+    def variance(self, ddof=0):
+        """
+        :param ddof: delta degrees of freedom, as in np.var
+        :return: the variance of every array seen so far
+        """
+        # Match np.var, which gives nan rather than raising when there are too few samples
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.m2 / (self.count - ddof)
+
+
+class TrainingMetrics:
+    """
+    Accumulates per class correct and incorrect counts and the summed loss as tensors on the training device, so
+    a batch only needs batched tensor operations and nothing is copied to the cpu until results is called
+    """
+
+    def __init__(self, device, n_classes=8):
+        self.n_classes = n_classes
+        self.correct_counts = torch.zeros(n_classes, dtype=torch.long, device=device)
+        self.incorrect_counts = torch.zeros(n_classes, dtype=torch.long, device=device)
+        self.loss_sum = torch.zeros(1, device=device)
+        self.batches = 0
+
+    def update(self, outputs, labels, loss):
+        """
+        Adds a batch, counts are kept by the predicted class
+        :param outputs: the network's classification batch
+        :param labels: the real answer for each image
+        :param loss: loss of the batch
+        """
+        answers = torch.argmax(outputs.detach(), dim=1)
+        correct = answers == labels
+
+        self.correct_counts += torch.bincount(answers[correct], minlength=self.n_classes)
+        self.incorrect_counts += torch.bincount(answers[~correct], minlength=self.n_classes)
+        self.loss_sum += loss.detach()
+        self.batches += 1
+
+    def state_dict(self):
+        return {'correct_counts': self.correct_counts, 'incorrect_counts': self.incorrect_counts,
+                'loss_sum': self.loss_sum, 'batches': self.batches}
+
+    def load_state_dict(self, state):
+        device = self.loss_sum.device
+        self.correct_counts = state['correct_counts'].to(device)
+        self.incorrect_counts = state['incorrect_counts'].to(device)
+        self.loss_sum = state['loss_sum'].to(device)
+        self.batches = state['batches']
+
+    def results(self):
+        """
+        Copies the metrics to the cpu in one transfer
+        :return: dictionary holding the correct, incorrect and total counts, the average loss and the per class
+        correct_count and incorrect_count keyed by label
+        """
+        metrics = torch.cat((self.correct_counts.double(), self.incorrect_counts.double(),
+                             self.loss_sum.double())).cpu().numpy()
+        correct_counts = metrics[:self.n_classes].astype(np.int64)
+        incorrect_counts = metrics[self.n_classes: 2 * self.n_classes].astype(np.int64)
+        correct = int(correct_counts.sum())
+        incorrect = int(incorrect_counts.sum())
+
+        return {'correct': correct, 'incorrect': incorrect, 'total': correct + incorrect,
+                'loss': metrics[-1] / max(self.batches, 1),
+                'correct_count': {LABELS[c]: int(correct_counts[c]) for c in range(0, self.n_classes)},
+                'incorrect_count': {LABELS[c]: int(incorrect_counts[c]) for c in range(0, self.n_classes)}}
+
+
 def plot_image_at_index(data_plot, data_loader, index):
     """
     plots image at a given index
@@ -77,10 +176,17 @@ def read_net(PATH, image_size, output_size, device, class_weights):
     :param class_weights: weights of the classes
     :return:
     """
-    net = model.Classifier(image_size, output_size, device, class_weights)
+    states = torch.load(PATH, map_location=device)
+    selective = 'selective_regression.weight' in states['network']
+    # Checkpoints from before the Bayesian layer's settings were saved can only have had a learned prior inferred
+    bayesian_args = states.get('bayesian', {})
+    if 'hidden_layer.prior_mu' in states['network']:
+        bayesian_args['prior'] = "learned"
+    ensemble_size = len(states['network']['ensemble_r1']) if 'ensemble_r1' in states['network'] else 1
+    net = model.Classifier(image_size, output_size, device, class_weights, selective=selective,
+                           ensemble_size=ensemble_size)
     optim = optimizer.SGD(net.parameters(), lr=0.00001)
     scheduler = optimizer.lr_scheduler.CyclicLR(optim, base_lr=0.0001, max_lr=0.03, step_size_up=(555 * 10))
-    states = torch.load(PATH, map_location=device)
 
     try:
         net.load_state_dict(states['network'])
@@ -88,8 +194,10 @@ def read_net(PATH, image_size, output_size, device, class_weights):
         scheduler.load_state_dict(states['lr_sched'])
     except Exception as e:
         # if an exception occurs, try loading in BbB network
-        net = model.Classifier(image_size, output_size, device, class_weights, BBB=True)
-        BBB_weights = ['hidden_layer.weight_mu', 'hidden_layer.weight_rho', 'hidden_layer.bias_mu', 'hidden_layer.bias_rho']
+        net = model.Classifier(image_size, output_size, device, class_weights, BBB=True, selective=selective,
+                               **bayesian_args)
+        BBB_weights = ['hidden_layer.weight_mu', 'hidden_layer.weight_rho', 'hidden_layer.bias_mu', 'hidden_layer.bias_rho',
+                       'hidden_layer.prior_mu', 'hidden_layer.prior_log_sigma']
         BBB_parameters = list(map(lambda x: x[1],list(filter(lambda kv: kv[0] in BBB_weights, net.named_parameters()))))
         base_parameters = list(map(lambda x: x[1],list(filter(lambda kv: kv[0] not in BBB_weights, net.named_parameters()))))
 
@@ -256,48 +364,18 @@ def find_lowest_cost(probabilities, uncertain=False):
     :param uncertain: include a extra cost of classifying as unknown
     :return: prediction and the expected cost of that classification
     """
-    if uncertain:
-        cost_matrix = np.array([
-                    [0, 150, 10, 10, 150, 150, 10, 1, 10],
-                    [10, 0, 10, 10, 1, 1, 10, 10, 10],
-                    [10, 30, 0, 1, 30, 30, 1, 10, 10],
-                    [10, 20, 1, 0, 20, 20, 1, 10, 10],
-                    [10, 1, 10, 10, 0, 1, 10, 10, 10],
-                    [10, 1, 10, 10, 1, 0, 10, 10, 10],
-                    [10, 20, 1, 1, 20, 20, 0, 10, 10],
-                    [1, 150, 10, 10, 150, 150, 10, 0, 10],
-                    [10, 10, 10, 10, 10, 10, 10, 10, 0]])
-    else:
-        cost_matrix = np.array([
-                   [0, 150, 10, 10, 150, 150, 10, 1],
-                   [10, 0, 10, 10, 1, 1, 10, 10],
-                   [10, 30, 0, 1, 30, 30, 1, 10],
-                   [10, 20, 1, 0, 20, 20, 1, 10],
-                   [10, 1, 10, 10, 0, 1, 10, 10],
-                   [10, 1, 10, 10, 1, 0, 10, 10],
-                   [10, 20, 1, 1, 20, 20, 0, 10],
-                   [1, 150, 10, 10, 150, 150, 10, 0]])
-
-    lowest_cost = -1
-    answer = 0
-    for j in range(len(probabilities)):
-        total = 0
-
-        for k in range(0, len(probabilities)):
-            total += probabilities[k] * cost_matrix[k][j]
-
-        if lowest_cost > total or lowest_cost == -1:
-            answer = j
-            lowest_cost = total
-
-    return answer, lowest_cost
+    answer, lowest_cost = cost_model.lowest_cost(np.asarray(probabilities, dtype=np.float64), uncertain)
+
+    return int(answer), float(lowest_cost)
 
 def get_label_indexes(predictions, test_indexes, data_loader):
     indexes = {'MEL': [], 'NV': [], 'BCC': [], 'AK': [], 'BKL': [], 'DF': [], 'VASC': [], 'SCC': []}
     new_predictions = {'MEL': [], 'NV': [], 'BCC': [], 'AK': [], 'BKL': [], 'DF': [], 'VASC': [], 'SCC': []}
 
+    labels = data_loader.get_labels(test_indexes)
+
     for i in range(0, len(test_indexes)):
-        label = data_loader.get_label(test_indexes[i])
+        label = labels[i]
         indexes[LABELS[label]].append(test_indexes[i])
         new_predictions[LABELS[label]].append(predictions[i])
 
@@ -312,39 +390,7 @@ def find_true_cost(prediction, answer, uncertain=False, flatten=False):
     :param flatten: make all cost of miss-classification 1
     :return: true cost of classification decision
     """
-    if flatten:
-        cost_matrix = [
-            [0, 1, 1, 1, 1, 1, 1, 1],
-            [1, 0, 1, 1, 1, 1, 1, 1],
-            [1, 1, 0, 1, 1, 1, 1, 1],
-            [1, 1, 1, 0, 1, 1, 1, 1],
-            [1, 1, 1, 1, 0, 1, 1, 1],
-            [1, 1, 1, 1, 1, 0, 1, 1],
-            [1, 1, 1, 1, 1, 1, 0, 1],
-            [1, 1, 1, 1, 1, 1, 1, 0]]
-    else:
-        cost_matrix = [
-                   [0, 150, 10, 10, 150, 150, 10, 1],
-                   [10, 0, 10, 10, 1, 1, 10, 10],
-                   [10, 30, 0, 1, 30, 30, 1, 10],
-                   [10, 20, 1, 0, 20, 20, 1, 10],
-                   [10, 1, 10, 10, 0, 1, 10, 10],
-                   [10, 1, 10, 10, 1, 0, 10, 10],
-                   [10, 20, 1, 1, 20, 20, 0, 10],
-                   [1, 150, 10, 10, 150, 150, 10, 0]]
-
-
-    if uncertain:
-        if not flatten:
-            for row in cost_matrix:
-                row.append(10)
-            cost_matrix.append([10, 10, 10, 10, 10, 10, 10, 10, 0])
-        else:
-            for row in cost_matrix:
-                row.append(1)
-            cost_matrix.append([1, 1, 1, 1, 1, 1, 1, 1, 0])
-
-    return cost_matrix[answer][prediction]
+    return float(cost_model.true_costs(prediction, answer, uncertain, flatten))
 
 
 def remove_last_row(arrays):
@@ -358,39 +404,25 @@ def get_each_cost(probabilities, uncertain=False):
     """
     given a probability distribution, returns a cost distribution
     """
-    costs = []
-
-    if uncertain:
-        cost_matrix = np.array([
-            [0, 150, 10, 10, 150, 150, 10, 1, 10],
-            [10, 0, 10, 10, 1, 1, 10, 10, 10],
-            [10, 30, 0, 1, 30, 30, 1, 10, 10],
-            [10, 20, 1, 0, 20, 20, 1, 10, 10],
-            [10, 1, 10, 10, 0, 1, 10, 10, 10],
-            [10, 1, 10, 10, 1, 0, 10, 10, 10],
-            [10, 20, 1, 1, 20, 20, 0, 10, 10],
-            [1, 150, 10, 10, 150, 150, 10, 0, 10],
-            [10, 10, 10, 10, 10, 10, 10, 10, 0]])
-    else:
-        cost_matrix = np.array([
-            [0, 150, 10, 10, 150, 150, 10, 1],
-            [10, 0, 10, 10, 1, 1, 10, 10],
-            [10, 30, 0, 1, 30, 30, 1, 10],
-            [10, 20, 1, 0, 20, 20, 1, 10],
-            [10, 1, 10, 10, 0, 1, 10, 10],
-            [10, 1, 10, 10, 1, 0, 10, 10],
-            [10, 20, 1, 1, 20, 20, 0, 10],
-            [1, 150, 10, 10, 150, 150, 10, 0]])
+    return cost_model.expected_costs(np.asarray(probabilities, dtype=np.float64), uncertain).tolist()
 
-    for j in range(0, len(probabilities)):
-        total = 0
 
-        for k in range(0, len(probabilities)):
-            total += probabilities[k] * cost_matrix[k][j]
+def get_answers(predictions, cost_matrix):
+    """
+    Splits the uncertainty off a list of predictions and finds the decision made for each
+    :param predictions: list of predictions with the uncertainty as the last item
+    :param cost_matrix: whether to make the LEC decision rather than the most probable class
+    :return: arrays of decisions and uncertainties
+    """
+    predictions = np.asarray(predictions, dtype=np.float64)
+    probabilities = predictions[:, :-1]
 
-        costs.append(total)
+    if cost_matrix:
+        answers = cost_model.lowest_cost(probabilities)[0]
+    else:
+        answers = np.argmax(probabilities, axis=1)
 
-    return costs
+    return answers, predictions[:, -1]
 
 
 def get_correct_incorrect(predictions, data_loader, test_indexes, cost_matrix, threshold=-1.0):
@@ -403,21 +435,20 @@ def get_correct_incorrect(predictions, data_loader, test_indexes, cost_matrix, t
     :param threshold: threshold to reject.
     :return: 3 lists containing the predicted answer, real answer and uncertainty
     """
-    predictions = deepcopy(predictions)
-
     correct = []
     incorrect = []
     uncertain = []
     wrong = right = total = 0
+    real_answers = data_loader.get_labels(test_indexes).tolist()
+    answers, uncertainties = get_answers(predictions, cost_matrix)
+    answers = answers.tolist()
+    uncertainties = uncertainties.tolist()
 
     for index in test_indexes:
 
-        uncertainty = predictions[total].pop()
-        if cost_matrix:
-            answer = find_lowest_cost(predictions[total])[0]
-        else:
-            answer = np.argmax(predictions[total])
-        real_answer = data_loader.get_label(index)
+        uncertainty = uncertainties[total]
+        answer = answers[total]
+        real_answer = real_answers[total]
 
 
         if uncertainty <= threshold:
@@ -461,51 +492,155 @@ def make_confusion_matrix(predictions, data_loader, test_indexes, cost_matrix):
     :param cost_matrix: prediction with cost consideration
     :return: confusion matrix
     """
-    predictions = deepcopy(predictions)
-    confusion_matrix = []
-    for i in range(8):
-        confusion_matrix.append([0, 0, 0, 0, 0, 0, 0, 0])
+    real_answers = data_loader.get_labels(test_indexes).astype(np.int64)
+    answers = get_answers(predictions, cost_matrix)[0]
 
-    total = 0
-    for index in test_indexes:
-        predictions[total].pop()
-        if cost_matrix:
-            answer = find_lowest_cost(predictions[total])[0]
-        else:
-            answer = np.argmax(predictions[total])
+    # Count each (real, predicted) pair in one go
+    confusion_matrix = np.bincount(real_answers * 8 + answers, minlength=64).reshape(8, 8)
 
-        real_answer = data_loader.get_label(index)
-        confusion_matrix[real_answer][answer] += 1
-        total += 1
-
-    return confusion_matrix
+    return confusion_matrix.tolist()
 
 
-def save_network(network, optim, scheduler, val_losses, train_losses, val_accuracies, train_accuracies, root_dir):
+def save_network(network, optim, scheduler, val_losses, train_losses, val_accuracies, train_accuracies, root_dir,
+                 tags=()):
     """
-    saves network, optimiser, etc, to the specified directory
+    saves network, optimiser, etc, to the specified directory. The state is copied to cpu memory and written in the
+    background, saves made again in the same epoch before the write are merged into one
+    :param tags: names of hard links to keep to this checkpoint, i.e. best_acc or best_loss
     """
-    if not os.path.isdir(root_dir):
-        os.mkdir(root_dir)
+    states = {'network': network.state_dict(),
+              'optimizer': optim.state_dict(),
+              'lr_sched': scheduler.state_dict()}
+    if network.BBB:
+        states['bayesian'] = bayesian_settings(network)
+    metrics = {"val_losses.csv": val_losses, "train_losses.csv": train_losses,
+               "val_accuracies.csv": val_accuracies, "train_accuracies.csv": train_accuracies}
 
-    save_net(network, optim, scheduler, root_dir + "model_parameters")
-    write_csv(val_losses, root_dir + "val_losses.csv")
-    write_csv(train_losses, root_dir + "train_losses.csv")
-    write_csv(val_accuracies, root_dir + "val_accuracies.csv")
-    write_csv(train_accuracies, root_dir + "train_accuracies.csv")
+    checkpoint_writer.save(states, metrics, root_dir, len(train_losses), tags)
 
 
-def load_net(root_dir, output_size, image_size, device, class_weights):
+def bayesian_settings(network):
+    """
+    :return: the arguments of model.Classifier for the network's Bayesian layer that can't be told from its state dict
+    """
+    return {'prior': network.hidden_layer.prior, 'prior_sigma': network.hidden_layer.prior_sigma,
+            'flipout': network.flipout}
+
+
+def load_net(root_dir, output_size, image_size, device, class_weights, tag=None):
     """
     loads network, optimiser etc. from a specified directory
+    :param tag: load the checkpoint linked by save_network with this tag, i.e. best_acc or best_loss, rather than
+    the latest one. The losses and accuracies are still those of every epoch trained
     """
+    # Make sure any checkpoint still being written is on disk
+    checkpoint_writer.flush()
     val_losses = read_csv(root_dir + "val_losses.csv")
     train_losses = read_csv(root_dir + "train_losses.csv")
     val_accuracies = read_csv(root_dir + "val_accuracies.csv")
     train_accuracies = read_csv(root_dir + "train_accuracies.csv")
-    network, optim, scheduler = read_net(root_dir + "model_parameters", image_size, output_size, device,
-                                                class_weights)
+    path = root_dir + "model_parameters" if tag is None else root_dir + f"model_parameters_{tag}"
+    network, optim, scheduler = read_net(path, image_size, output_size, device, class_weights)
 
     network = network.to(device)
 
-    return network, optim, scheduler, len(train_losses), val_losses, train_losses, val_accuracies, train_accuracies
\ No newline at end of file
+    return network, optim, scheduler, len(train_losses), val_losses, train_losses, val_accuracies, train_accuracies
+
+
+def warm_start_BBB(root_dir, output_size, image_size, device, class_weights, sigma=0.01, **bayesian_args):
+    """
+    Builds a BbB network from a trained softmax network, so only a short fine-tune is needed rather than training
+    the backbone again. The Bayesian layer's means start from the softmax network's hidden layer and its standard
+    deviations from sigma, every other weight is copied over
+    :param root_dir: directory of the softmax network, i.e. saved_models/SM_Classifier_0/
+    :param output_size: number of output classes
+    :param image_size: size of the image
+    :param device: device to put the network on
+    :param class_weights: weights of the classes
+    :param sigma: starting standard deviation of every weight in the Bayesian layer
+    :param bayesian_args: other arguments for the BbB model.Classifier, such as prior or flipout
+    :return: the BbB network
+    """
+    softmax_network = load_net(root_dir, output_size, image_size, device, class_weights)[0]
+    states = softmax_network.state_dict()
+    weight = states.pop('hidden_layer.weight')
+    bias = states.pop('hidden_layer.bias')
+
+    network = model.Classifier(image_size, output_size, class_weights, device, BBB=True, **bayesian_args)
+    incompatible = network.load_state_dict(states, strict=False)
+
+    # Only the Bayesian layer's own parameters should be left, anything else means the networks don't match
+    bayesian_keys = {'hidden_layer.weight_mu', 'hidden_layer.weight_rho', 'hidden_layer.bias_mu',
+                     'hidden_layer.bias_rho', 'hidden_layer.prior_mu', 'hidden_layer.prior_log_sigma'}
+    mismatched = (set(incompatible.missing_keys) - bayesian_keys) | set(incompatible.unexpected_keys)
+    if mismatched:
+        raise RuntimeError(f"Can't warm start BbB from {root_dir}, mismatched keys: {sorted(mismatched)}")
+
+    # softplus(rho) = sigma
+    rho = np.log(np.expm1(sigma))
+
+    with torch.no_grad():
+        network.hidden_layer.weight_mu.copy_(weight)
+        network.hidden_layer.bias_mu.copy_(bias)
+        network.hidden_layer.weight_rho.fill_(rho)
+        network.hidden_layer.bias_rho.fill_(rho)
+
+    return network.to(device)
+
+
+def get_rng_states():
+    """
+    :return: the state of the torch, cuda, numpy and python random number generators
+    """
+    states = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+
+    return states
+
+
+def set_rng_states(states):
+    torch.set_rng_state(states['torch'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['python'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def save_training_state(network, optim, scheduler, sampler_state, metrics, epoch, step, root_dir, swag_posterior=None):
+    """
+    Saves everything needed to carry on training from part way through an epoch to root_dir/training_state, written
+    in the background like save_network
+    :param sampler_state: state of the training set's ResumableWeightedSampler
+    :param metrics: TrainingMetrics of the epoch so far
+    :param epoch: epoch being trained
+    :param step: number of batches of the epoch that have been trained on
+    :param swag_posterior: swag.SWAG posterior being collected, if any
+    """
+    states = {'network': network.state_dict(),
+              'optimizer': optim.state_dict(),
+              'lr_sched': scheduler.state_dict(),
+              'sampler': sampler_state,
+              'metrics': metrics.state_dict(),
+              'epoch': epoch,
+              'step': step,
+              'rng': get_rng_states()}
+    if swag_posterior is not None:
+        states['swag'] = swag_posterior.state_dict()
+
+    checkpoint_writer.save_file(states, root_dir + "training_state")
+
+
+def read_training_state(root_dir):
+    """
+    Reads the state saved by save_training_state
+    :return: the saved state, or None if there isn't one
+    """
+    checkpoint_writer.flush()
+    path = root_dir + "training_state"
+
+    if not os.path.exists(path):
+        return None
+
+    # Kept on the cpu as the random number generator states must be cpu tensors
+    return torch.load(path, map_location="cpu")
@@ -0,0 +1,173 @@
+"""
+laplace.py: Post-hoc Laplace approximation over the output layer of a trained Classifier. The Hessian of the loss
+with respect to output_layer is estimated with a Kronecker factored or diagonal generalised Gauss-Newton in one pass
+over the training set, giving a gaussian posterior over the output layer's weights whose logit mean and variance are
+found in closed form for each input
+"""
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+class LastLayerLaplace:
+    """
+    Gaussian posterior over the weights and bias of Classifier.output_layer, centred on the trained weights
+    """
+
+    def __init__(self, network, hessian="kfac", prior_precision=1.0):
+        """
+        :param network: trained Classifier, its output layer is the one approximated
+        :param hessian: "kfac" for a Kronecker factored Hessian or "diag" for a diagonal Hessian
+        :param prior_precision: precision of the zero mean gaussian prior over the weights
+        """
+        if hessian not in ("kfac", "diag"):
+            raise ValueError(f"Unknown Hessian approximation {hessian}")
+
+        self.network = network
+        self.hessian = hessian
+        self.prior_precision = prior_precision
+        self.n_data = 0
+        self.factors = None
+
+    def fit(self, data_set, device, features=False):
+        """
+        Accumulates the generalised Gauss-Newton of the cross entropy loss over the output layer in one pass. With
+        the output layer's input a (and a 1 for the bias) and the softmax Hessian G = diag(p) - pp^T, KFAC keeps the
+        averages of aa^T and G, the diagonal keeps the sum of a^2 G_cc for each weight
+        :param data_set: data loader over the training set
+        :param device: device the network is on
+        :param features: whether data_set holds cached backbone features rather than images
+        :return: self
+        """
+        n_classes = self.network.output_size
+        hidden_size = self.network.output_layer.in_features + 1
+        self.n_data = 0
+
+        if self.hessian == "kfac":
+            A = torch.zeros(hidden_size, hidden_size, device=device)
+            G = torch.zeros(n_classes, n_classes, device=device)
+        else:
+            diagonal = torch.zeros(n_classes, hidden_size, device=device)
+
+        self.network.eval()
+
+        for i_batch, sample_batch in enumerate(tqdm(data_set)):
+            image_batch = sample_batch['image'].to(device)
+
+            with torch.no_grad():
+                hidden = self.get_hidden(image_batch, features)
+                probabilities = torch.softmax(self.network.output_layer(hidden[:, :-1]), dim=1)
+
+                if self.hessian == "kfac":
+                    A += hidden.t() @ hidden
+                    G += torch.diag(probabilities.sum(0)) - probabilities.t() @ probabilities
+                else:
+                    diagonal += (probabilities - probabilities ** 2).t() @ hidden ** 2
+
+            self.n_data += len(image_batch)
+
+        if self.hessian == "kfac":
+            self.factors = (A / self.n_data, G / self.n_data)
+        else:
+            self.factors = diagonal
+
+        return self
+
+    def get_hidden(self, input, features=False):
+        """
+        :return: the input to the output layer, with a column of ones appended for the bias
+        """
+        if not features:
+            input = self.network.extract_efficientNet(input)
+        hidden = self.network.hidden_features(input)
+
+        return torch.cat((hidden, torch.ones(len(hidden), 1, device=hidden.device)), dim=1)
+
+    def posterior_covariance(self, prior_precision=None):
+        """
+        For KFAC, N (A kron G) + tau I is approximated by (sqrt(N) A + sqrt(tau) I) kron (sqrt(N) G + sqrt(tau) I),
+        whose inverse is the Kronecker product of the factors' inverses
+        :param prior_precision: prior precision to use, defaults to the one given on construction
+        :return: the two inverted Kronecker factors, or the posterior variance of each weight
+        """
+        if self.factors is None:
+            raise RuntimeError("Call fit before predicting with the Laplace approximation")
+
+        if prior_precision is None:
+            prior_precision = self.prior_precision
+
+        if self.hessian == "diag":
+            return 1 / (self.factors + prior_precision)
+
+        A, G = self.factors
+        root_n = np.sqrt(self.n_data)
+        root_prior = np.sqrt(prior_precision)
+        A_inverse = torch.inverse(root_n * A + root_prior * torch.eye(len(A), device=A.device))
+        G_inverse = torch.inverse(root_n * G + root_prior * torch.eye(len(G), device=G.device))
+
+        return A_inverse, G_inverse
+
+    def logit_moments(self, input, features=False, covariance=None):
+        """
+        Mean and variance of each logit under the posterior over the output layer, the mean is the trained network's
+        output and the variance is a^T Sigma_A a diag(Sigma_G) for KFAC, or sum_j a_j^2 var(W_cj) for the diagonal
+        :param input: image batch, or backbone features if features is True
+        :param features: whether input holds cached backbone features rather than images
+        :param covariance: output of posterior_covariance, found from the prior precision if not given
+        :return: mean and variance of each logit
+        """
+        if covariance is None:
+            covariance = self.posterior_covariance()
+
+        hidden = self.get_hidden(input, features)
+        mean = self.network.output_layer(hidden[:, :-1])
+
+        if self.hessian == "diag":
+            variance = hidden ** 2 @ covariance.t()
+        else:
+            A_inverse, G_inverse = covariance
+            variance = ((hidden @ A_inverse) * hidden).sum(1, keepdim=True) * torch.diag(G_inverse).unsqueeze(0)
+
+        return mean, variance
+
+    def optimise_prior_precision(self, data_set, device, features=False, precisions=None):
+        """
+        Picks the prior precision with the lowest negative log likelihood of the probit approximated predictive
+        distribution on a held out set, the features are only run through the network once
+        :param data_set: data loader over a labelled validation set
+        :param device: device the network is on
+        :param features: whether data_set holds cached backbone features rather than images
+        :param precisions: prior precisions to try, defaults to a log spaced grid
+        :return: the chosen prior precision
+        """
+        if precisions is None:
+            precisions = np.logspace(-4, 4, 17)
+
+        efficient_net_outputs = []
+        labels = []
+
+        self.network.eval()
+
+        with torch.no_grad():
+            for i_batch, sample_batch in enumerate(tqdm(data_set)):
+                if features:
+                    efficient_net_outputs.append(sample_batch['image'].to(device))
+                else:
+                    efficient_net_outputs.append(self.network.extract_efficientNet(sample_batch['image'].to(device)))
+                labels.append(sample_batch['label'].to(device))
+
+            efficient_net_outputs = torch.cat(efficient_net_outputs)
+            labels = torch.cat(labels)
+            losses = []
+
+            for precision in precisions:
+                mean, variance = self.logit_moments(efficient_net_outputs, features=True,
+                                                    covariance=self.posterior_covariance(precision))
+                log_probabilities = torch.log_softmax(mean / torch.sqrt(1 + np.pi / 8 * variance), dim=1)
+                losses.append(-log_probabilities.gather(1, labels.unsqueeze(1)).mean().item())
+
+        self.prior_precision = float(precisions[int(np.argmin(losses))])
+        print(f"Laplace prior precision: {self.prior_precision}")
+
+        return self.prior_precision
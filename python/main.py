@@ -15,7 +15,9 @@ import testing
 import training
 import helper
 import model
+import prediction_store
 import constants
+import costs
 
 if torch.cuda.is_available():
     constants.ENABLE_GPU = True
@@ -26,7 +28,7 @@ if __name__ == "__main__":
     print(f"Arguments count: {len(sys.argv)}")
     for i, arg in enumerate(sys.argv):
 
-        if arg[0:2] == "-e":
+        if arg[0:2] == "-e" and arg[2:].isdigit():
             constants.EPOCHS = int(arg[2:])
         if arg[0:3] == "-fp":
             constants.FORWARD_PASSES = int(arg[3:])
@@ -40,31 +42,83 @@ if __name__ == "__main__":
             constants.LOAD = True
         if arg[0:8] == "-predict":
             constants.TRAIN = False
+        if arg[0:6] == "-cache":
+            constants.IMAGE_CACHE = True
+        if arg[0:9] == "-features":
+            constants.HEAD_ONLY = True
+        if arg[0:12] == "-cascadecost":
+            constants.CASCADE = True
+            constants.CASCADE_COST = True
+            if arg[12:]:
+                constants.CASCADE_COST_THRESHOLD = float(arg[12:])
+        elif arg[0:8] == "-cascade":
+            constants.CASCADE = True
+            if arg[8:]:
+                constants.CASCADE_THRESHOLD = float(arg[8:])
+        if arg[0:4] == "-lrt":
+            constants.LOCAL_REPARAMETERIZATION = True
+        if arg[0:6] == "-prior":
+            constants.BBB_PRIOR = arg[6:]
+        if arg[0:8] == "-flipout":
+            constants.FLIPOUT = True
+        if arg[0:7] == "-moment":
+            constants.MOMENT_PROPAGATION = True
+        if arg[0:8] == "-laplace":
+            constants.LAPLACE = True
+            if arg[8:]:
+                constants.LAPLACE_HESSIAN = arg[8:]
+        if arg[0:8] == "-density":
+            constants.FEATURE_DENSITY = True
+            if arg[8:]:
+                constants.DENSITY_COVARIANCE = arg[8:]
+        if arg[0:7] == "-distil":
+            constants.DISTIL = True
+            if arg[7:]:
+                constants.DISTIL_EPOCHS = int(arg[7:])
+        if arg[0:10] == "-selective":
+            constants.SELECTIVE = True
+            if arg[10:]:
+                constants.SELECTIVE_COVERAGE = float(arg[10:])
+        if arg[0:9] == "-ensemble":
+            constants.ENSEMBLE_SIZE = int(arg[9:]) if arg[9:] else 4
+        if arg[0:5] == "-swag":
+            constants.SWAG = True
+            if arg[5:] == "all":
+                constants.SWAG_HEAD_ONLY = False
+        if arg[0:10] == "-warmstart":
+            constants.BBB_WARM_START = True
+            if arg[10:]:
+                constants.BBB_WARM_START_SIGMA = float(arg[10:])
+        if arg[0:9] == "-stepsave":
+            constants.STEP_CHECKPOINT_INTERVAL = int(arg[9:]) if arg[9:] else 500
         if arg[0:2] == "-n":
             constants.NUM_MODELS = int(arg[2:])
+        if arg[0:11] == "-costmatrix":
+            constants.COST_MATRIX_PATH = arg[11:]
 
         print(f"Argument {i:>6}: {arg}")
 
+    if constants.COST_MATRIX_PATH:
+        costs.use_cost_matrix(constants.COST_MATRIX_PATH)
+
 
 def predict():
     constants.SAVE_DIR = "saved_models/SM_Classifier_0/"
-    predictions_mc = helper.read_rows(constants.SAVE_DIR + "mc_entropy_predictions.csv")
-    costs_mc = helper.read_rows(constants.SAVE_DIR + "mc_costs.csv")
+    mc_store = prediction_store.PredictionStore(constants.SAVE_DIR + "mc_forward_passes")
+    predictions_mc = mc_store.get_final("entropy").tolist()
+    costs_mc = mc_store.get_final("costs").tolist()
 
     constants.SAVE_DIR = "saved_models/SM_Classifier_0/"
     predictions_softmax = helper.read_rows(constants.SAVE_DIR + "softmax_entropy.csv")
     costs_sr = helper.read_rows(constants.SAVE_DIR + "softmax_costs.csv")
 
     constants.SAVE_DIR = "saved_models/BBB_Classifier_0/"
-    predictions_BBB = helper.read_rows(constants.SAVE_DIR + "BBB_entropy_predictions.csv")
-    costs_BBB = helper.read_rows(constants.SAVE_DIR + "BBB_costs.csv")
+    BBB_store = prediction_store.PredictionStore(constants.SAVE_DIR + "BBB_forward_passes")
+    predictions_BBB = BBB_store.get_final("entropy").tolist()
+    costs_BBB = BBB_store.get_final("costs").tolist()
 
     predictions_softmax = helper.string_to_float(predictions_softmax)
     costs_sr = helper.string_to_float(costs_sr)
-    predictions_mc = helper.string_to_float(predictions_mc)
-    costs_mc = helper.string_to_float(costs_mc)
-    predictions_BBB = helper.string_to_float(predictions_BBB)
-    costs_BBB = helper.string_to_float(costs_BBB)
 
     constants.SAVE_DIR = "saved_models/images/"
 
@@ -21,7 +21,9 @@ class Classifier(nn.Module):
     """
     Class that holds and runs the efficientnet CNN
     """
-    def __init__(self, image_size, output_size, class_weights, device, hidden_size=512, dropout=0.5, BBB=False):
+    def __init__(self, image_size, output_size, class_weights, device, hidden_size=512, dropout=0.5, BBB=False,
+                 local_reparameterization=False, prior="mixture", prior_sigma=1.0, flipout=False, selective=False,
+                 ensemble_size=1):
         """
         Initialises network parameters
         :param image_size: Input image size, used to calculate output of efficient net layer
@@ -31,14 +33,28 @@ class Classifier(nn.Module):
         :param hidden_size: size of first hidden layer
         :param dropout: Drop rate
         :param BBB: Whether or not to make layers Bayesian
+        :param local_reparameterization: sample the Bayesian layer's outputs rather than its weights at inference,
+        and in training when the prior's KL divergence is found in closed form
+        :param prior: prior of the Bayesian layer, "mixture", "gaussian" or "learned", see BayesModel.BayesianLayer
+        :param prior_sigma: standard deviation of a gaussian prior
+        :param flipout: give each example its own weight perturbation with Flipout, see BayesModel.FlipoutLayer
+        :param selective: add the SelectiveNet selection branch and auxiliary head to the backbone output
+        :param ensemble_size: number of BatchEnsemble members sharing the head, 1 for a single model
         """
         super(Classifier, self).__init__()
+        if BBB and ensemble_size > 1:
+            raise ValueError("BatchEnsemble is not supported with a Bayesian layer")
+
         # self.model = models.from_pretrained("efficientnet-b0")
         self.model = models.resnet50(pretrained=True)
         self.drop_rate = dropout
         self.pool = nn.AdaptiveAvgPool2d(1)
         self.output_size = output_size
         self.BBB = BBB
+        self.local_reparameterization = local_reparameterization
+        self.flipout = flipout
+        self.selective = selective
+        self.ensemble_size = ensemble_size
         self.class_weights = class_weights
         self.device = device
         self.relu = torch.nn.ReLU()
@@ -52,14 +68,31 @@ class Classifier(nn.Module):
 
         # Initialises the classification head for generating predictions.
         if BBB:
-            self.hidden_layer = BayesModel.BayesianLayer(encoder_size, hidden_size, device)
+            bayesian_layer = BayesModel.FlipoutLayer if flipout else BayesModel.BayesianLayer
+            self.hidden_layer = bayesian_layer(encoder_size, hidden_size, device, prior=prior, prior_sigma=prior_sigma)
         else:
             self.hidden_layer = nn.Linear(encoder_size, hidden_size)
 
         self.bn1 = nn.BatchNorm1d(num_features=hidden_size)
         self.output_layer = nn.Linear(hidden_size, output_size)
 
-    def forward(self, input, samples=1, sample=False, drop_rate=None, dropout=False):
+        # BatchEnsemble fast weights, each member scales the inputs and outputs of the shared layers by its own
+        # rank-1 factors, starting from random signs so the members differ
+        if ensemble_size > 1:
+            self.ensemble_r1 = nn.Parameter(torch.randint(0, 2, (ensemble_size, encoder_size)).float() * 2 - 1)
+            self.ensemble_s1 = nn.Parameter(torch.randint(0, 2, (ensemble_size, hidden_size)).float() * 2 - 1)
+            self.ensemble_r2 = nn.Parameter(torch.randint(0, 2, (ensemble_size, hidden_size)).float() * 2 - 1)
+            self.ensemble_s2 = nn.Parameter(torch.randint(0, 2, (ensemble_size, output_size)).float() * 2 - 1)
+
+        # SelectiveNet selection branch, giving a score for whether to accept each prediction, and the auxiliary
+        # head used during training
+        if selective:
+            self.selective_hidden = nn.Linear(encoder_size, 512)
+            self.selective_batch_norm = nn.BatchNorm1d(512)
+            self.selective_regression = nn.Linear(512, 1)
+            self.auxiliary_output = nn.Linear(encoder_size, output_size)
+
+    def forward(self, input, samples=1, sample=False, drop_rate=None, dropout=False, features=False):
         """
         Extracts efficient Net output then passes it through our other layers
         :param input: input Image batch
@@ -67,14 +100,83 @@ class Classifier(nn.Module):
         :param sample: Whether or not to sample the ELBO in BBB
         :param drop_rate: drop rate for dropout
         :param dropout: whether or not to apply dropout
+        :param features: if True, input is a batch of already extracted backbone features
         :return: the output of our network
         """
 
-        output = self.extract_efficientNet(input)
+        if features:
+            output = input
+        else:
+            output = self.extract_efficientNet(input)
+
+        if self.selective:
+            # Kept for selective_loss, as BBB_loss is for the ELBO
+            self.selection, self.auxiliary = self.selective_pass(output)
+
         output = self.pass_through_layers(output, sample=sample,
                                           drop_rate=drop_rate, samples=samples, dropout=dropout)
         return output
 
+    # Methods for BatchEnsemble
+    def ensemble_pass(self, input, drop_rate=None, dropout=False):
+        """
+        Runs every BatchEnsemble member in one batched pass, the weights of member i are the shared weights times
+        the outer product of its fast weights, applied as W(x * r_i) * s_i
+        :param input: batch of backbone features
+        :param drop_rate: drop rate for dropout
+        :param dropout: whether or not to apply dropout
+        :return: the outputs of each member, with shape (members, batch, classes)
+        """
+        if drop_rate is None:
+            drop_rate = self.drop_rate
+
+        batch_size = input.size()[0]
+        output = input.unsqueeze(0) * self.ensemble_r1.unsqueeze(1)
+
+        if dropout:
+            output = TF.dropout(output, drop_rate)
+
+        output = self.hidden_layer(output) * self.ensemble_s1.unsqueeze(1)
+        output = self.relu(self.bn1(output.reshape(self.ensemble_size * batch_size, -1)))
+        output = output.view(self.ensemble_size, batch_size, -1) * self.ensemble_r2.unsqueeze(1)
+
+        if dropout:
+            output = TF.dropout(output, drop_rate)
+
+        return self.output_layer(output) * self.ensemble_s2.unsqueeze(1)
+
+    # Methods for SelectiveNet
+    def selective_pass(self, input):
+        """
+        Runs the backbone output through the selection branch and auxiliary head
+        :param input: batch of backbone features
+        :return: selection score of each image between 0 and 1, and the auxiliary head's output
+        """
+        selection = TF.relu(self.selective_hidden(input))
+        selection = self.selective_batch_norm(selection)
+        selection = torch.sigmoid(self.selective_regression(selection)).squeeze(1)
+
+        return selection, self.auxiliary_output(input)
+
+    def selective_loss(self, outputs, labels, coverage=0.8, lamda=32, alpha=0.5):
+        """
+        SelectiveNet loss, the selective risk with a quadratic penalty for falling below the target coverage mixed
+        with the cross entropy of the auxiliary head. Uses the selection scores from the last forward pass
+        :param outputs: the network's classification batch
+        :param labels: the real answer for each image
+        :param coverage: the target fraction of images to accept
+        :param lamda: weight of the coverage penalty
+        :param alpha: weight of the selective loss against the auxiliary loss
+        :return: the loss
+        """
+        losses = TF.cross_entropy(outputs, labels, weight=self.class_weights, reduction='none')
+        empirical_coverage = self.selection.mean()
+        selective_risk = (losses * self.selection).mean() / empirical_coverage
+        penalty = lamda * torch.clamp(coverage - empirical_coverage, min=0) ** 2
+        auxiliary_loss = TF.cross_entropy(self.auxiliary, labels, weight=self.class_weights)
+
+        return alpha * (selective_risk + penalty) + (1 - alpha) * auxiliary_loss
+
     def extract_efficientNet(self, input):
         output = self.model.extract_features(input)
         output = self.pool(output)
@@ -82,48 +184,139 @@ class Classifier(nn.Module):
 
         return output
 
-    def pass_through_layers(self, input, sample=False, drop_rate=None, samples=1, dropout=False):
+    def pass_through_layers(self, input, sample=False, drop_rate=None, samples=1, dropout=False, return_samples=False):
         """
-        Run the output of efficient net through our layers
+        Run the output of efficient net through our layers. All samples are run as one batch of size
+        samples * batch, with a separate dropout mask or weight sample for each
         :param input: Input image batch
         :param sample: Whether we should calculate BBB loss
         :param drop_rate: drop rate for dropout
         :param samples: number of samples to run
         :param dropout: whether or not to apply dropout
-        :return: the networks classification batch
+        :param return_samples: if True, also return the output of every sample
+        :return: the networks classification batch, averaged over the samples, and the
+        (samples, batch, classes) outputs if return_samples is True
         """
 
         if drop_rate is None:
             drop_rate = self.drop_rate
 
+        if self.ensemble_size > 1:
+            outputs = self.ensemble_pass(input, drop_rate=drop_rate, dropout=dropout)
+            # Kept so each member can be trained on its own output
+            self.ensemble_outputs = outputs
+
+            if return_samples:
+                return outputs.mean(0), outputs
+            return outputs.mean(0)
+
         if self.BBB:
             # Don't bother calculating KL Divergence if we're not training or unless we ask
             if self.training or sample:
-                output = self.sample_elbo(input, samples=samples)
-                return output
+                outputs = self.sample_elbo(input, samples=samples)
             else:
-                output = self.relu(self.bn1(self.hidden_layer(input)))
-                
-                return self.output_layer(output)
-        outputs = torch.zeros(samples, input.size()[0], self.output_size).to(self.device)
-        for i in range(0, samples):
-            if dropout:
-                input = TF.dropout(input, drop_rate)
+                outputs = self.bayesian_sample(input, samples=samples, local=self.local_reparameterization)
 
-            output = self.relu(self.bn1(self.hidden_layer(input)))
+            if return_samples:
+                return outputs.mean(0), outputs
+            return outputs.mean(0)
 
-            if dropout:
-                output = TF.dropout(output, drop_rate)
+        batch_size = input.size()[0]
+        # Stack the samples along the batch dimension so each row gets its own dropout mask
+        input = input.repeat(samples, 1)
 
-            outputs[i] = self.output_layer(output)
+        if dropout:
+            input = TF.dropout(input, drop_rate)
+
+        output = self.relu(self.bn1(self.hidden_layer(input)))
+
+        if dropout:
+            output = TF.dropout(output, drop_rate)
+
+        outputs = self.output_layer(output).view(samples, batch_size, self.output_size)
+
+        if return_samples:
+            return outputs.mean(0), outputs
         return outputs.mean(0)
 
+    def mean_pass(self, input):
+        """
+        Single deterministic pass through the head, without dropout and using the mean weights of a Bayesian layer
+        :param input: batch of backbone features
+        :return: the networks classification batch
+        """
+        return self.output_layer(self.hidden_features(input))
+
+    def hidden_features(self, input):
+        """
+        Deterministic output of the hidden layer, the input to output_layer
+        :param input: batch of backbone features
+        :return: the hidden layer's activations, using the mean weights of a Bayesian layer
+        """
+        if self.BBB:
+            output = TF.linear(input, self.hidden_layer.weight_mu, self.hidden_layer.bias_mu)
+        else:
+            output = self.hidden_layer(input)
+
+        return self.relu(self.bn1(output))
+
+    def moment_pass(self, input, drop_rate=None):
+        """
+        Propagates the mean and variance of the MC dropout head analytically in a single pass, treating each unit as
+        an independent gaussian. Dropout is a Bernoulli scaling, BatchNorm in eval mode is affine and ReLU uses the
+        moments of a rectified gaussian
+        :param input: batch of backbone features
+        :param drop_rate: drop rate for dropout
+        :return: mean and variance of each output logit
+        """
+        if drop_rate is None:
+            drop_rate = self.drop_rate
+        keep_rate = 1 - drop_rate
+
+        # Inverted dropout keeps the mean and scales the second moment by 1 / keep_rate
+        variance = input ** 2 * (drop_rate / keep_rate)
+        mean = self.hidden_layer(input)
+        variance = TF.linear(variance, self.hidden_layer.weight ** 2)
+
+        scale = self.bn1.weight / torch.sqrt(self.bn1.running_var + self.bn1.eps)
+        mean = (mean - self.bn1.running_mean) * scale + self.bn1.bias
+        variance = variance * scale ** 2
+
+        std = torch.sqrt(variance.clamp(min=1e-12))
+        normal = torch.distributions.Normal(0, 1)
+        ratio = mean / std
+        cdf = normal.cdf(ratio)
+        pdf = torch.exp(normal.log_prob(ratio))
+        mean_relu = mean * cdf + std * pdf
+        second_moment = (mean ** 2 + variance) * cdf + mean * std * pdf
+
+        variance = (second_moment / keep_rate - mean_relu ** 2).clamp(min=0)
+        mean = self.output_layer(mean_relu)
+        variance = TF.linear(variance, self.output_layer.weight ** 2)
+
+        return mean, variance
+
     # Methods for BbB
-    def bayesian_sample(self, input):
-        output = self.relu(self.bn1(self.hidden_layer(input)))
+    def bayesian_sample(self, input, samples=1, local=False):
+        """
+        Runs the input through the Bayesian head, drawing a separate weight sample for each of the samples
+        :param input: batch of backbone features
+        :param samples: number of weight samples to draw
+        :param local: use the local reparameterization trick, does not calculate the log probabilities
+        :return: the outputs of each sample, with shape (samples, batch, classes)
+        """
+        batch_size = input.size()[0]
+
+        if local:
+            output = self.hidden_layer.local_sample(input, samples=samples)
+        else:
+            input = input.unsqueeze(0).expand(samples, batch_size, input.size()[1])
+            output = self.hidden_layer(input, samples=samples)
+
+        output = self.relu(self.bn1(output.reshape(samples * batch_size, -1)))
         output = self.output_layer(output)
 
-        return output
+        return output.view(samples, batch_size, self.output_size)
     
     def log_prior(self):
         return self.hidden_layer.log_prior
@@ -137,27 +330,54 @@ class Classifier(nn.Module):
         :param input: Input image batch
         :param samples: number of samples to run across the Bayesian Layers
         :param n_classes: number of output classes
-        :return: the network's classification batch
+        :return: the network's classification batch for each sample, with shape (samples, batch, classes)
         """
         num_batches = 555
-        batch_size = input.size()[0]
-
-        outputs = torch.zeros(samples, batch_size, n_classes).to(self.device)
-        log_priors = torch.zeros(samples).to(self.device)
-        log_variational_posteriors = torch.zeros(samples).to(self.device)
 
-        for i in range(samples):
-            outputs[i] = self.bayesian_sample(input)
-            log_priors[i] = self.log_prior()
-            log_variational_posteriors[i] = self.log_variational_posterior()
+        if self.hidden_layer.closed_form_kl:
+            # The KL divergence doesn't depend on the samples, so they can be drawn however is cheapest
+            outputs = self.bayesian_sample(input, samples=samples, local=self.local_reparameterization)
+            KL_divergence = self.hidden_layer.kl_divergence()
+        else:
+            outputs = self.bayesian_sample(input, samples=samples)
 
-        log_prior = log_priors.mean()
-        log_variational_posterior = log_variational_posteriors.mean()
+            # The layer holds the log probabilities of each weight sample
+            log_prior = self.log_prior().mean()
+            log_variational_posterior = self.log_variational_posterior().mean()
 
-        KL_divergence = (log_variational_posterior - log_prior)
+            KL_divergence = (log_variational_posterior - log_prior)
         loss = KL_divergence / num_batches
 
         self.BBB_loss = loss
-        return outputs.mean(0)
+        return outputs
+
 
 
+
+class StudentHead(nn.Module):
+    """
+    Deterministic classification head distilled from an MC Dropout or BbB Classifier, run on the teacher's backbone
+    features. Alongside the class logits it predicts the teacher's mean entropy and summed variance
+    """
+    def __init__(self, encoder_size, output_size, hidden_size=512):
+        """
+        :param encoder_size: size of the backbone features
+        :param output_size: number of classes to classify
+        :param hidden_size: size of the hidden layer
+        """
+        super(StudentHead, self).__init__()
+        self.output_size = output_size
+        self.hidden_layer = nn.Linear(encoder_size, hidden_size)
+        self.bn1 = nn.BatchNorm1d(num_features=hidden_size)
+        self.relu = torch.nn.ReLU()
+        self.output_layer = nn.Linear(hidden_size, output_size)
+        self.uncertainty_layer = nn.Linear(hidden_size, 2)
+
+    def forward(self, input):
+        """
+        :param input: batch of backbone features
+        :return: class logits, and the predicted entropy and variance, both kept positive with a softplus
+        """
+        output = self.relu(self.bn1(self.hidden_layer(input)))
+
+        return self.output_layer(output), TF.softplus(self.uncertainty_layer(output))
@@ -0,0 +1,163 @@
+"""
+prediction_store.py: Binary store for the per forward pass predictions made in testing.monte_carlo. Holds every
+pass in a single appendable file of shape passes x kinds x samples x (classes + uncertainty), with a JSON header
+describing the layout, in place of three CSV files per forward pass. The final predictions after every pass are kept
+alongside in the same layout
+"""
+
+import os
+import json
+import numpy as np
+import helper
+
+KINDS = ["entropy", "variance", "costs"]
+
+
+class PredictionStore:
+    """
+    Appendable store of forward pass predictions, read back through a memory map so any pass, sample or class can
+    be sliced out without reading the rest of the file
+    """
+
+    def __init__(self, path, n_samples=None, n_columns=None, filenames=None, dtype="float64"):
+        """
+        Opens an existing store, or creates a new one if n_samples and n_columns are given
+        :param path: location of the store, without an extension
+        :param n_samples: number of samples predicted on in each pass
+        :param n_columns: number of classes plus the uncertainty column
+        :param filenames: filename of each sample, saved in the header
+        :param dtype: type to store the predictions as
+        """
+        self.header_path = path + ".json"
+        self.data_path = path + ".bin"
+        self.final_path = path + "_final.bin"
+        self.data = None
+
+        if n_samples is None:
+            with open(self.header_path) as f:
+                self.header = json.load(f)
+        else:
+            if filenames is not None:
+                filenames = list(filenames)
+            self.header = {'kinds': KINDS, 'samples': n_samples, 'columns': n_columns, 'dtype': dtype,
+                           'filenames': filenames}
+            # Start with an empty data file, then write the header to mark the store as valid
+            open(self.data_path, 'wb').close()
+            if os.path.exists(self.final_path):
+                os.remove(self.final_path)
+            self.write_header()
+
+    @property
+    def pass_shape(self):
+        return len(KINDS), self.header['samples'], self.header['columns']
+
+    @property
+    def passes(self):
+        """
+        Number of complete passes in the data file, the header is only written once so this is found from its size
+        """
+        pass_size = np.prod(self.pass_shape) * np.dtype(self.header['dtype']).itemsize
+        return os.path.getsize(self.data_path) // int(pass_size)
+
+    def write_header(self):
+        # Write to a temporary file first so a crash never leaves a half written header
+        temp_path = self.header_path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.header, f)
+        os.replace(temp_path, self.header_path)
+
+    def append(self, entropy, variance, costs):
+        """
+        Adds a forward pass to the end of the store
+        :param entropy: (samples, columns) predictions with the normalised entropy as the last column
+        :param variance: (samples, columns) predictions with the summed variance as the last column
+        :param costs: (samples, columns) expected cost of each decision
+        """
+        forward_pass = np.stack([entropy, variance, costs]).astype(self.header['dtype'])
+
+        with open(self.data_path, 'ab') as f:
+            f.write(forward_pass.tobytes())
+
+        self.data = None
+
+    def set_final(self, entropy, variance, costs):
+        """
+        Saves the final predictions, in the same layout as a forward pass
+        :param entropy: (samples, columns) predictions with the normalised entropy as the last column
+        :param variance: (samples, columns) predictions with the summed variance as the last column
+        :param costs: (samples, columns) expected cost of each decision
+        """
+        final = np.stack([entropy, variance, costs]).astype(self.header['dtype'])
+
+        temp_path = self.final_path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(final.tobytes())
+        os.replace(temp_path, self.final_path)
+
+    def get_final(self, kind="entropy"):
+        """
+        :return: (samples, columns) final predictions
+        """
+        final = np.memmap(self.final_path, dtype=self.header['dtype'], mode='r', shape=self.pass_shape)
+
+        return final[KINDS.index(kind)]
+
+    def get_data(self):
+        """
+        :return: memory map over the whole store with shape (passes, kinds, samples, columns)
+        """
+        if self.data is None:
+            shape = (self.passes,) + self.pass_shape
+            self.data = np.memmap(self.data_path, dtype=self.header['dtype'], mode='r', shape=shape)
+
+        return self.data
+
+    def get_pass(self, forward_pass, kind="entropy"):
+        """
+        :return: (samples, columns) predictions made after the given forward pass
+        """
+        return self.get_data()[forward_pass, KINDS.index(kind)]
+
+    def get_sample(self, sample, kind="entropy"):
+        """
+        :return: (passes, columns) predictions for the given sample after each forward pass
+        """
+        return self.get_data()[:, KINDS.index(kind), sample]
+
+    def get_class(self, column, kind="entropy"):
+        """
+        :return: (passes, samples) values of a single class, or the uncertainty column, after each forward pass
+        """
+        return self.get_data()[:, KINDS.index(kind), :, column]
+
+    def export_csv(self, root_dir, prefix, passes=True, ISIC=False):
+        """
+        Writes the store out in the old layout of one CSV per forward pass and kind,
+        i.e. root_dir/entropy/mc_forward_pass_0_entropy.csv, and the final predictions to
+        root_dir/mc_entropy_predictions.csv, root_dir/mc_variance_predictions.csv and root_dir/mc_costs.csv
+        :param root_dir: directory holding the entropy, variance and costs directories
+        :param prefix: mc or BBB
+        :param passes: write the CSVs of each forward pass, otherwise only the final predictions
+        :param ISIC: write the final entropy predictions in the ISIC2019 submission style
+        """
+        final_paths = {"entropy": f"{prefix}_entropy_predictions.csv", "variance": f"{prefix}_variance_predictions.csv",
+                       "costs": f"{prefix}_costs.csv"}
+
+        for kind in KINDS:
+            rows = [helper.float_to_string(row) for row in self.get_final(kind).tolist()]
+            if ISIC and kind == "entropy":
+                for i in range(0, len(rows)):
+                    rows[i].insert(0, self.header['filenames'][i][:-4])
+                rows.insert(0, ["image", "MEL", "NV", "BCC", "AK", "BKL", "DF", "VASC", "SCC", "UNK"])
+            helper.write_rows(rows, root_dir + final_paths[kind])
+
+        if not passes:
+            return
+
+        for kind in KINDS:
+            if not os.path.isdir(root_dir + kind):
+                os.mkdir(root_dir + kind)
+
+            for i in range(0, self.passes):
+                rows = [helper.float_to_string(row) for row in self.get_pass(i, kind).tolist()]
+                helper.write_rows(rows, root_dir + f"{kind}/{prefix}_forward_pass_{i}_{kind}.csv")
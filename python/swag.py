@@ -0,0 +1,157 @@
+"""
+swag.py: Stochastic weight averaging gaussian (SWAG). The weights of the network are collected as it trains over the
+last cycles of the cyclic learning rate, keeping their running first and second moments and the most recent
+deviations from the mean, then a gaussian with a diagonal plus low rank covariance is sampled from at test time
+"""
+
+import math
+import torch
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+
+
+class SWAG:
+    """
+    SWAG posterior over the classification head, or over every weight of the network
+    """
+
+    def __init__(self, network, max_rank=20, head_only=True):
+        """
+        :param network: Classifier to collect the weights of
+        :param max_rank: number of deviations kept for the low rank part of the covariance
+        :param head_only: only collect the weights of the classification head, not the backbone
+        """
+        self.network = network
+        self.max_rank = max_rank
+        self.head_only = head_only
+        self.parameters = [parameter for name, parameter in network.named_parameters()
+                           if not (head_only and name.startswith("model."))]
+
+        weights = parameters_to_vector(self.parameters).detach()
+        # The deviations of every weight of the network are too large to keep on the GPU
+        self.storage_device = weights.device if head_only else torch.device("cpu")
+        self.mean = torch.zeros_like(weights, device=self.storage_device)
+        self.sq_mean = torch.zeros_like(weights, device=self.storage_device)
+        self.deviations = []
+        self.n_models = 0
+
+    def collect(self):
+        """
+        Adds the network's current weights to the running moments and the deviation buffer
+        """
+        weights = parameters_to_vector(self.parameters).detach().to(self.storage_device)
+
+        self.mean = (self.mean * self.n_models + weights) / (self.n_models + 1)
+        self.sq_mean = (self.sq_mean * self.n_models + weights ** 2) / (self.n_models + 1)
+        self.n_models += 1
+
+        self.deviations.append(weights - self.mean)
+        if len(self.deviations) > self.max_rank:
+            self.deviations.pop(0)
+
+    def get_weights(self):
+        """
+        :return: the network's current collected weights, used to put them back after sampling
+        """
+        return parameters_to_vector(self.parameters).detach().clone()
+
+    def set_weights(self, weights):
+        vector_to_parameters(weights.to(self.parameters[0].device), self.parameters)
+
+    def sample(self, scale=1.0, low_rank=True):
+        """
+        Loads a sample into the network, mean + sqrt(scale) (diag^1/2 z1 / sqrt(2) + D z2 / sqrt(2 (K - 1)))
+        :param scale: scale of the covariance
+        :param low_rank: include the low rank part of the covariance, otherwise sample the diagonal only
+        """
+        if self.n_models == 0:
+            raise RuntimeError("No weights have been collected for SWAG")
+
+        variance = (self.sq_mean - self.mean ** 2).clamp(min=1e-30)
+        rank = len(self.deviations)
+
+        if low_rank and rank > 1:
+            deviations = torch.stack(self.deviations, dim=1)
+            z = torch.randn(rank, device=self.storage_device)
+            noise = torch.sqrt(variance) * torch.randn_like(variance) / math.sqrt(2)
+            noise += deviations @ z / math.sqrt(2 * (rank - 1))
+        else:
+            noise = torch.sqrt(variance) * torch.randn_like(variance)
+
+        self.set_weights(self.mean + math.sqrt(scale) * noise)
+
+    def batch_norms(self):
+        """
+        :return: the BatchNorm layers whose inputs change with the sampled weights, every one when the whole network is
+        sampled, otherwise only those in the head
+        """
+        return [module for name, module in self.network.named_modules()
+                if isinstance(module, torch.nn.modules.batchnorm._BatchNorm)
+                and not (self.head_only and name.startswith("model."))]
+
+    def get_batch_norm_state(self):
+        """
+        :return: copies of the running statistics of batch_norms, used to put them back after sampling
+        """
+        return [{name: buffer.clone() for name, buffer in batch_norm.named_buffers()}
+                for batch_norm in self.batch_norms()]
+
+    def set_batch_norm_state(self, state):
+        for batch_norm, buffers in zip(self.batch_norms(), state):
+            for name, buffer in batch_norm.named_buffers():
+                buffer.copy_(buffers[name])
+
+    def bn_update(self, data_set, device, features=False):
+        """
+        Recomputes the running statistics of batch_norms for the weights loaded by sample, as the statistics kept from
+        training belong to the last collected weights rather than the sample. The statistics are reset then averaged
+        over one train mode pass through data_set
+        :param data_set: training images, or backbone features when features is set
+        :param device: device to run the pass on
+        :param features: whether data_set holds backbone features rather than images
+        """
+        batch_norms = self.batch_norms()
+        momenta = [batch_norm.momentum for batch_norm in batch_norms]
+
+        for batch_norm in batch_norms:
+            batch_norm.reset_running_stats()
+            batch_norm.momentum = None  # Cumulative average over the whole pass
+            batch_norm.train()
+
+        with torch.no_grad():
+            for sample_batch in data_set:
+                input = sample_batch['image'].to(device)
+                if not features:
+                    input = self.network.extract_efficientNet(input)
+                # The head's BatchNorm is in hidden_features, the output layer has none
+                self.network.hidden_features(input)
+
+        for batch_norm, momentum in zip(batch_norms, momenta):
+            batch_norm.momentum = momentum
+            batch_norm.eval()
+
+    def state_dict(self):
+        return {'mean': self.mean, 'sq_mean': self.sq_mean, 'deviations': self.deviations,
+                'n_models': self.n_models, 'max_rank': self.max_rank, 'head_only': self.head_only}
+
+    def load_state_dict(self, state):
+        self.mean = state['mean'].to(self.storage_device)
+        self.sq_mean = state['sq_mean'].to(self.storage_device)
+        self.deviations = [deviation.to(self.storage_device) for deviation in state['deviations']]
+        self.n_models = state['n_models']
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+
+    @staticmethod
+    def load(path, network):
+        """
+        Reads a SWAG posterior saved with save
+        :param path: location of the saved posterior
+        :param network: Classifier the weights were collected from
+        :return: the SWAG posterior
+        """
+        states = torch.load(path, map_location="cpu")
+        swag = SWAG(network, max_rank=states['max_rank'], head_only=states['head_only'])
+        swag.load_state_dict(states)
+
+        return swag
@@ -3,13 +3,32 @@ testing.py: The file responsible for holding the methods relating to testing net
 for the ISIC2019 Challenge and also predictions on already known images
 """
 
+import time
 import torch
 import torch.nn as nn
 import numpy as np
 from tqdm import tqdm
 import helper
+import prediction_store
+import coverage_curves
+from costs import cost_model
 
-def softmax_pred(data_set, network, n_classes, device, ISIC):
+def get_entropy(probabilities):
+    """
+    Finds the entropy of each probability distribution, treating near certain predictions as having no entropy
+    :param probabilities: (n_samples, n_classes) array of probabilities
+    :return: entropy of each sample
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -np.sum(probabilities * np.log2(probabilities), axis=1)
+
+    # avoid log(0) errors
+    entropy[np.max(probabilities, axis=1) > 0.9999] = 0.0
+
+    return entropy
+
+
+def softmax_pred(data_set, network, n_classes, device, ISIC, features=False):
     """
     Gets the basic softmax output of a network and writes those to a file
     :param data_set: data set to draw images and labels from
@@ -17,6 +36,7 @@ def softmax_pred(data_set, network, n_classes, device, ISIC):
     :param n_classes: number of expected output classes
     :param device: device to hold predictions on
     :param ISIC: whether or not to write predictions in the ISIC2019 requested style:
+    :param features: whether data_set holds cached backbone features rather than images
     :return: predictions using 1 - maximum softmax response, predictions using entropy and the cost of each classification
     """
     costs = []
@@ -31,7 +51,7 @@ def softmax_pred(data_set, network, n_classes, device, ISIC):
         image_batch = sample_batch['image'].to(device)
         filename_batch = sample_batch['filename']
         with torch.no_grad():
-            outputs = soft_max(network(image_batch, dropout=False))
+            outputs = soft_max(network(image_batch, dropout=False, features=features))
 
         for output in outputs:
             predictions = np.vstack((predictions, output.cpu().numpy()))
@@ -60,8 +80,7 @@ def softmax_pred(data_set, network, n_classes, device, ISIC):
     for i in range(0, len(predictions_e)):
         predictions_e[i].append(entropies[i])
 
-    for i in range(0, len(predictions_e)):
-        current_costs = helper.get_each_cost(predictions_e[i], uncertain=True)
+    for current_costs in cost_model.expected_costs(np.array(predictions_e), uncertain=True).tolist():
         for c in range(0, len(current_costs)):
             current_costs[c] = '{:.17f}'.format(current_costs[c])
         costs.append(current_costs)
@@ -77,7 +96,8 @@ def softmax_pred(data_set, network, n_classes, device, ISIC):
     return predictions, predictions_e, costs
 
 
-def monte_carlo(data_set, forward_passes, network, n_samples, n_classes, root_dir, device, BBB, ISIC):
+def monte_carlo(data_set, forward_passes, network, n_samples, n_classes, root_dir, device, BBB, ISIC, features=False,
+                ensemble=False, swag=None, sample_chunk=10, prefix=None, bn_update_set=None):
     """
     monte carlo samples from either the varational posterioir or approximate posterioir
     :param data_set: data set to draw images and labels from
@@ -85,10 +105,18 @@ def monte_carlo(data_set, forward_passes, network, n_samples, n_classes, root_di
     :param network: network to run predictions with
     :param n_samples: number of samples
     :param n_classes: number of expected output classes
-    :param root_dir: location to save the various forward pass predictions
+    :param root_dir: location to save the prediction store holding the predictions after each forward pass
     :param device: device to hold predictions on
     :param BBB: whether to sample varational or approximate posterior
     :param ISIC: whether or not to write predictions in the ISIC2019 requested style:
+    :param features: whether data_set holds cached backbone features rather than images
+    :param ensemble: treat each BatchEnsemble member as a forward pass, all members are run together
+    :param swag: swag.SWAG posterior to sample the weights from before each deterministic forward pass
+    :param sample_chunk: most dropout masks or BBB weight samples to draw at once, unless the network uses local
+    reparameterization
+    :param prefix: name of the prediction store, defaults to one named after the method
+    :param bn_update_set: training data to recompute the BatchNorm statistics over after each SWAG sample, holding
+    backbone features when features is set
     :return: predictions using 1 - maximum softmax response, predictions using entropy and the cost of each classification
     """
 
@@ -96,8 +124,9 @@ def monte_carlo(data_set, forward_passes, network, n_samples, n_classes, root_di
     n_classes = n_classes + 1
     filenames = []
     soft_max = nn.Softmax(dim=1)
-    drop_predictions = np.empty((0, n_samples, n_classes))
-    costs = np.empty((0, n_samples, n_classes))
+    # Running statistics over the forward passes, so we never hold every pass in memory
+    prediction_moments = helper.RunningMoments()
+    cost_moments = helper.RunningMoments()
     efficient_net_outputs = []
 
     network.eval()
@@ -110,118 +139,581 @@ def monte_carlo(data_set, forward_passes, network, n_samples, n_classes, root_di
         for filename in filename_batch:
             filenames.append(filename)
 
-        with torch.no_grad():
-            efficient_net_output = network.extract_efficientNet(image_batch)
+        if features:
+            efficient_net_output = image_batch
+        else:
+            with torch.no_grad():
+                efficient_net_output = network.extract_efficientNet(image_batch)
         efficient_net_outputs.append(efficient_net_output)
 
+    # Each pass is saved to a binary store, call store.export_csv for the old CSV per pass layout
+    store = None
+    method = "BBB" if BBB else "mc"
+
+    # Softmax outputs of every forward pass, for when all passes of a batch are run together
+    sampled_outputs = None
+
+    if ensemble:
+        method = "ensemble"
+        forward_passes = network.ensemble_size
+        sampled_outputs = []
+        for efficient_net_output in efficient_net_outputs:
+            with torch.no_grad():
+                sampled_outputs.append(torch.softmax(network.ensemble_pass(efficient_net_output), dim=2))
+
+    elif swag is None:
+        # All the dropout masks or weight samples of a batch are drawn together. With local reparameterization the
+        # output mean and variance are then only found once per batch
+        if BBB and network.local_reparameterization:
+            sample_chunk = forward_passes
+        else:
+            sample_chunk = min(sample_chunk, forward_passes)
+
+        sampled_outputs = []
+        for efficient_net_output in efficient_net_outputs:
+            with torch.no_grad():
+                outputs = torch.cat([network.pass_through_layers(efficient_net_output,
+                                                                 samples=min(sample_chunk, forward_passes - s),
+                                                                 dropout=not BBB, return_samples=True)[1]
+                                     for s in range(0, forward_passes, sample_chunk)])
+            sampled_outputs.append(torch.softmax(outputs, dim=2))
+
+    if swag is not None:
+        method = "swag"
+        trained_weights = swag.get_weights()
+        trained_batch_norms = swag.get_batch_norm_state()
+
+        # The backbone isn't sampled when only the head is, so its outputs for the BatchNorm update are found once
+        bn_features = features
+        if bn_update_set is not None and swag.head_only and not features:
+            with torch.no_grad():
+                bn_update_set = [{'image': network.extract_efficientNet(sample_batch['image'].to(device))}
+                                 for sample_batch in bn_update_set]
+            bn_features = True
+
+    if prefix is None:
+        prefix = method
+
     for i in tqdm(range(0, forward_passes)):
 
-        predictions = np.empty((0, n_classes))
-        current_costs = np.empty((0, n_classes))
+        predictions = []
+
+        if swag is not None:
+            swag.sample()
+            if bn_update_set is not None:
+                swag.bn_update(bn_update_set, device, features=bn_features)
+            # The backbone outputs can only be reused when the backbone weights aren't sampled
+            if not swag.head_only:
+                with torch.no_grad():
+                    efficient_net_outputs = [network.extract_efficientNet(sample_batch['image'].to(device))
+                                             for sample_batch in data_set]
 
         for c in range(0, len(efficient_net_outputs)):
             with torch.no_grad():
-                if BBB:
-                    outputs = soft_max(network.pass_through_layers(efficient_net_outputs[c]))
+                if sampled_outputs is not None:
+                    outputs = sampled_outputs[c][i]
 
                 else:
-                    outputs = soft_max(network.pass_through_layers(efficient_net_outputs[c], dropout=True))
+                    outputs = soft_max(network.mean_pass(efficient_net_outputs[c]))
 
-            for output in outputs:
-                answers = output.cpu().numpy()
-                # avoid log(0) errors
-                if np.max(answers) > 0.9999:
-                    entropy = 0.0
-                else:
-                    entropy = -np.sum(answers * np.log2(answers), axis=0)  # shape (n_samples, n_classes)
+            answers = outputs.cpu().numpy().astype(np.float64)
+            predictions.append(np.hstack((answers, get_entropy(answers)[:, np.newaxis])))
+
+        predictions = np.vstack(predictions)
+        prediction_moments.update(predictions)
+        cost_moments.update(cost_model.expected_costs(predictions, uncertain=True))
 
-                answers = np.append(answers, entropy)
-                current_costs = np.vstack((current_costs, helper.get_each_cost(answers, uncertain=True)))
-                predictions = np.vstack((predictions, answers))
+        mean_entropy = prediction_moments.mean.copy()
+        mean_variance = prediction_moments.mean.copy()
+        variance = prediction_moments.variance(ddof=1)[:, :n_classes - 1]  # Remove entropy
 
-        drop_predictions = np.vstack((drop_predictions, predictions[np.newaxis, :, :]))
-        temp = np.delete(drop_predictions, n_classes - 1, 2) # Remove entropy
+        entropies = mean_entropy[:, n_classes - 1]
+        mean_entropy[:, n_classes - 1] = (entropies - entropies.min()) / (entropies.max() - entropies.min())
+        mean_variance[:, n_classes - 1] = variance.sum(axis=1)
 
-        costs = np.vstack((costs, current_costs[np.newaxis, :, :]))
-        costs_mean = np.mean(costs, axis=0)
+        if store is None:
+            store = prediction_store.PredictionStore(root_dir + f"{prefix}_forward_passes", len(mean_entropy),
+                                                     n_classes, filenames=filenames)
+        store.append(mean_entropy, mean_variance, cost_moments.mean)
 
-        mean_entropy = mean_variance = np.mean(drop_predictions, axis=0)
-        variance = np.var(temp, axis=0, ddof=1)
+    if swag is not None:
+        swag.set_weights(trained_weights)
+        swag.set_batch_norm_state(trained_batch_norms)
 
-        variance = variance.tolist()
-        mean_entropy = mean_entropy.tolist()
-        mean_variance = mean_variance.tolist()
-        costs_mean = costs_mean.tolist()
-        entropies = [c[n_classes - 1] for c in mean_entropy]
+    mean_entropy = prediction_moments.mean.copy()  # shape (n_samples, n_classes)
+    mean_variance = prediction_moments.mean.copy()  # shape (n_samples, n_classes)
+    costs_mean = cost_moments.mean.copy()
+    variance = prediction_moments.variance()[:, :n_classes - 1]  # shape (n_samples, n_classes)
 
-        min_entropy = min(entropies)
-        max_entropy = max(entropies)
+    entropies = mean_entropy[:, n_classes - 1]
+    mean_entropy[:, n_classes - 1] = (entropies - entropies.min()) / (entropies.max() - entropies.min())
+    mean_variance[:, n_classes - 1] = variance.sum(axis=1)
+    store.set_final(mean_entropy, mean_variance, costs_mean)
 
-        for c in range(0, len(entropies)):
-            entropies[c] = (entropies[c] - min_entropy) / (max_entropy - min_entropy)
+    mean_entropy = [helper.float_to_string(row) for row in mean_entropy.tolist()]
+    mean_variance = [helper.float_to_string(row) for row in mean_variance.tolist()]
+    costs_mean = [helper.float_to_string(row) for row in costs_mean.tolist()]
 
-        for c in range(0, len(mean_entropy)):
-            mean_entropy[c][n_classes - 1] = entropies[c]
-            mean_variance[c][n_classes - 1] = sum(variance[c])
+    if ISIC:
+        for i in range(0, len(mean_entropy)):
+            mean_entropy[i].insert(0, filenames[i][:-4])
 
-        for preds in mean_entropy:
-            for c in range(0, len(preds)):
-                preds[c] = '{:.17f}'.format(preds[c])
+    return mean_entropy, mean_variance, costs_mean
 
-        for preds in mean_variance:
-            for c in range(0, len(preds)):
-                preds[c] = '{:.17f}'.format(preds[c])
 
-        for cost in costs_mean:
-            for c in range(0, len(cost)):
-                cost[c] = '{:.17f}'.format(cost[c])
+def cascade_pred(data_set, forward_passes, network, n_classes, root_dir, device, BBB, ISIC, threshold=0.5,
+                 cost=False, features=False, sample_chunk=10):
+    """
+    Runs a single deterministic pass over every image, then only samples the images whose uncertainty is above
+    the threshold with MC dropout or BBB, reusing the backbone output from the first pass
+    :param data_set: data set to draw images and labels from
+    :param forward_passes: number of times to sample the escalated images
+    :param network: network to run predictions with
+    :param n_classes: number of expected output classes
+    :param root_dir: location to save the prediction store holding the final predictions, it has no forward passes
+    :param device: device to hold predictions on
+    :param BBB: whether to sample varational or approximate posterior
+    :param ISIC: whether or not to write predictions in the ISIC2019 requested style:
+    :param threshold: escalate images with a normalised entropy, or LEC if cost is True, above this
+    :param cost: escalate on the lowest expected cost rather than the normalised entropy
+    :param features: whether data_set holds cached backbone features rather than images
+    :param sample_chunk: most BBB weight samples to draw at once, unless the network uses local reparameterization
+    :return: predictions using entropy, predictions using variance and the cost of each classification, in the same
+    layout as monte_carlo
+    """
+    start_time = time.time()
+    filenames = []
+    soft_max = nn.Softmax(dim=1)
+    efficient_net_outputs = []
+    first_pass = []
 
-        if BBB:
-            helper.write_rows(mean_entropy, root_dir + f"entropy/BBB_forward_pass_{i}_entropy.csv")
-            helper.write_rows(mean_variance, root_dir + f"variance/BBB_forward_pass_{i}_variance.csv")
-            helper.write_rows(costs_mean, root_dir + f"costs/BBB_forward_pass_{i}_costs.csv")
-        else:
-            helper.write_rows(mean_entropy, root_dir + f"entropy/mc_forward_pass_{i}_entropy.csv")
-            helper.write_rows(mean_variance, root_dir + f"variance/mc_forward_pass_{i}_variance.csv")
-            helper.write_rows(costs_mean, root_dir + f"costs/mc_forward_pass_{i}_costs.csv")
+    network.eval()
 
-    mean_entropy = np.mean(drop_predictions, axis=0)  # shape (n_samples, n_classes)
-    mean_variance = np.mean(drop_predictions, axis=0)  # shape (n_samples, n_classes)
-    costs_mean = np.mean(costs, axis=0)
-    temp = np.delete(drop_predictions, n_classes - 1, 2)
-    variance = np.var(temp, axis=0)  # shape (n_samples, n_classes)
+    for i_batch, sample_batch in enumerate(tqdm(data_set)):
+        image_batch = sample_batch['image'].to(device)
+        filenames += list(sample_batch['filename'])
 
-    variance = variance.tolist()
-    mean_entropy = mean_entropy.tolist()
-    mean_variance = mean_variance.tolist()
-    entropies = [c[n_classes - 1] for c in mean_entropy]
+        with torch.no_grad():
+            if features:
+                efficient_net_output = image_batch
+            else:
+                efficient_net_output = network.extract_efficientNet(image_batch)
+            outputs = soft_max(network.mean_pass(efficient_net_output))
 
-    for c in range(0, len(entropies)):
-        entropies[c] = (entropies[c] - min(entropies)) / (max(entropies) - min(entropies))
+        efficient_net_outputs.append(efficient_net_output)
+        first_pass.append(outputs.cpu().numpy().astype(np.float64))
+
+    efficient_net_outputs = torch.cat(efficient_net_outputs)
+    probabilities = np.vstack(first_pass)
+    entropies = get_entropy(probabilities)
+    variances = np.zeros(len(probabilities))
+
+    if cost:
+        scores = cost_model.lowest_cost(probabilities)[1]
+    else:
+        scores = entropies / np.log2(n_classes)
+
+    escalated = np.nonzero(scores > threshold)[0]
+    batch_size = data_set.batch_size
+
+    # Without local reparameterization every BbB sample is a full weight matrix, so only draw a few at once
+    if BBB and not network.local_reparameterization:
+        sample_chunk = min(sample_chunk, forward_passes)
+    else:
+        sample_chunk = forward_passes
+
+    # Sample only the uncertain images, all forward passes of a batch are run together
+    for c in tqdm(range(0, len(escalated), batch_size)):
+        indexes = escalated[c: c + batch_size]
+        escalated_outputs = efficient_net_outputs[torch.from_numpy(indexes).to(device)]
+        with torch.no_grad():
+            outputs = torch.cat([network.pass_through_layers(escalated_outputs,
+                                                             samples=min(sample_chunk, forward_passes - s),
+                                                             dropout=not BBB, return_samples=True)[1]
+                                 for s in range(0, forward_passes, sample_chunk)])
+        samples = soft_max(outputs.reshape(-1, n_classes)).cpu().numpy().astype(np.float64)
+
+        sample_entropies = get_entropy(samples).reshape(forward_passes, len(indexes))
+        samples = samples.reshape(forward_passes, len(indexes), n_classes)
+
+        probabilities[indexes] = samples.mean(axis=0)
+        entropies[indexes] = sample_entropies.mean(axis=0)
+        variances[indexes] = samples.var(axis=0).sum(axis=1)
+
+    elapsed = time.time() - start_time
+    print(f"Escalated {len(escalated)} of {len(probabilities)} images "
+          f"({round(len(escalated) / len(probabilities) * 100, 2)}%)")
+    print(f"Throughput: {round(len(probabilities) / elapsed, 2)} images per second")
+
+    mean_entropy = np.hstack((probabilities, entropies[:, np.newaxis]))
+    costs_mean = cost_model.expected_costs(mean_entropy, uncertain=True)
+    mean_variance = np.hstack((probabilities, variances[:, np.newaxis]))
+    mean_entropy[:, -1] = (entropies - entropies.min()) / (entropies.max() - entropies.min())
+
+    prefix = "BBB" if BBB else "mc"
+    store = prediction_store.PredictionStore(root_dir + f"{prefix}_forward_passes", len(mean_entropy),
+                                             n_classes + 1, filenames=filenames)
+    store.set_final(mean_entropy, mean_variance, costs_mean)
+
+    mean_entropy = [helper.float_to_string(row) for row in mean_entropy.tolist()]
+    mean_variance = [helper.float_to_string(row) for row in mean_variance.tolist()]
+    costs_mean = [helper.float_to_string(row) for row in costs_mean.tolist()]
+
+    if ISIC:
+        for i in range(0, len(mean_entropy)):
+            mean_entropy[i].insert(0, filenames[i][:-4])
 
-    for c in range(0, len(mean_entropy)):
-        mean_entropy[c][n_classes - 1] = entropies[c]
-        mean_variance[c][n_classes - 1] = sum(variance[c])
+    return mean_entropy, mean_variance, costs_mean
 
-    for i in range(0, len(mean_entropy)):
 
-        for c in range(0, len(mean_entropy[i])):
-            mean_entropy[i][c] = '{:.17f}'.format(mean_entropy[i][c])
-        if ISIC:
+def approximate_softmax(mean, variance):
+    """
+    Approximates the expected softmax of gaussian logits by scaling each logit by its variance, as in the probit
+    approximation, and the variance of each probability with a first order expansion of the softmax
+    :param mean: (batch, classes) mean of each logit
+    :param variance: (batch, classes) variance of each logit
+    :return: the approximate probabilities and the variance of each
+    """
+    probabilities = torch.softmax(mean / torch.sqrt(1 + np.pi / 8 * variance), dim=1)
+
+    # d p_k / d z_j = p_k (delta_kj - p_j)
+    jacobian = torch.diag_embed(probabilities) - probabilities.unsqueeze(2) * probabilities.unsqueeze(1)
+    probability_variance = torch.bmm(jacobian ** 2, variance.unsqueeze(2)).squeeze(2)
+
+    return probabilities, probability_variance
+
+
+def moment_propagation(data_set, network, device, features=False):
+    """
+    Runs the moment propagation predictor over a data set, a single deterministic pass in place of the MC dropout
+    forward passes
+    :param data_set: data set to draw images and labels from
+    :param network: network to run predictions with
+    :param device: device to hold predictions on
+    :param features: whether data_set holds cached backbone features rather than images
+    :return: approximate probabilities, their variances, the filenames and the labels, False if there are none
+    """
+    probabilities = []
+    variances = []
+    filenames = []
+    labels = []
+
+    network.eval()
+
+    for i_batch, sample_batch in enumerate(tqdm(data_set)):
+        image_batch = sample_batch['image'].to(device)
+        filenames += list(sample_batch['filename'])
+        labels.append(sample_batch['label'])
+
+        with torch.no_grad():
+            if features:
+                efficient_net_output = image_batch
+            else:
+                efficient_net_output = network.extract_efficientNet(image_batch)
+            outputs, output_variances = approximate_softmax(*network.moment_pass(efficient_net_output))
+
+        probabilities.append(outputs.cpu().numpy().astype(np.float64))
+        variances.append(output_variances.cpu().numpy().astype(np.float64))
+
+    if torch.is_tensor(labels[0]):
+        labels = torch.cat(labels).numpy()
+    else:
+        labels = False
+
+    return np.vstack(probabilities), np.vstack(variances), filenames, labels
+
+
+def moment_pred(data_set, network, n_classes, device, ISIC, features=False):
+    """
+    Single pass MC dropout predictions made by propagating the moments of the dropout head analytically
+    :param data_set: data set to draw images and labels from
+    :param network: network to run predictions with
+    :param n_classes: number of expected output classes
+    :param device: device to hold predictions on
+    :param ISIC: whether or not to write predictions in the ISIC2019 requested style:
+    :param features: whether data_set holds cached backbone features rather than images
+    :return: predictions using entropy, predictions using variance and the cost of each classification, in the same
+    layout as monte_carlo
+    """
+    probabilities, variances, filenames = moment_propagation(data_set, network, device, features)[:3]
+    entropies = get_entropy(probabilities)
+
+    mean_entropy = np.hstack((probabilities, entropies[:, np.newaxis]))
+    costs_mean = cost_model.expected_costs(mean_entropy, uncertain=True)
+    mean_variance = np.hstack((probabilities, variances.sum(axis=1)[:, np.newaxis]))
+    mean_entropy[:, -1] = (entropies - entropies.min()) / (entropies.max() - entropies.min())
+
+    mean_entropy = [helper.float_to_string(row) for row in mean_entropy.tolist()]
+    mean_variance = [helper.float_to_string(row) for row in mean_variance.tolist()]
+    costs_mean = [helper.float_to_string(row) for row in costs_mean.tolist()]
+
+    if ISIC:
+        for i in range(0, len(mean_entropy)):
             mean_entropy[i].insert(0, filenames[i][:-4])
 
-    for preds in mean_variance:
-        for c in range(0, len(preds)):
-            preds[c] = '{:.17f}'.format(preds[c])
+    return mean_entropy, mean_variance, costs_mean
+
+
+def compare_moment_propagation(test_set, root_dir, network, num_samples, device, n_classes=8, forward_passes=100,
+                               features=False):
+    """
+    Compares the moment propagation predictor against sampled MC dropout on the risk coverage AUC of the entropy and
+    variance uncertainties, and on the time taken, then writes the results to root_dir/moment_comparison.csv
+    :param test_set: Pytorch data loader class with labels to test the network on
+    :param root_dir: where to save the report
+    :param network: network to run predictions with
+    :param num_samples: number of samples
+    :param device: device to hold predictions
+    :param n_classes: number of expected output classes
+    :param forward_passes: number of MC dropout forward passes
+    :param features: whether test_set holds cached backbone features rather than images
+    :return: rows of the report
+    """
+    start_time = time.time()
+    probabilities, variances, filenames, labels = moment_propagation(test_set, network, device, features)
+    moment_time = time.time() - start_time
+    entropies = get_entropy(probabilities)
+
+    start_time = time.time()
+    # Kept in its own prediction store, so the store of the main MC dropout predictions isn't overwritten
+    mc_entropy, mc_variance, mc_costs = monte_carlo(test_set, forward_passes, network, num_samples, n_classes,
+                                                    root_dir, device, False, False, features,
+                                                    prefix="moment_comparison_mc")
+    mc_time = time.time() - start_time
+    mc_entropy = np.array(mc_entropy, dtype=np.float64)
+    mc_variance = np.array(mc_variance, dtype=np.float64)
+
+    rows = [["method", "uncertainty", "accuracy", "AUC", "seconds"]]
+    results = [("moment", "entropy", probabilities, entropies, moment_time),
+               ("moment", "variance", probabilities, variances.sum(axis=1), moment_time),
+               ("mc", "entropy", mc_entropy[:, :-1], mc_entropy[:, -1], mc_time),
+               ("mc", "variance", mc_variance[:, :-1], mc_variance[:, -1], mc_time)]
+
+    for method, uncertainty, predictions, uncertainties, seconds in results:
+        accuracy = np.mean(np.argmax(predictions, axis=1) == labels)
+        AUC = coverage_curves.risk_coverage(predictions, labels, uncertainties)[2]
+        print(f"{method} {uncertainty} accuracy: {round(accuracy * 100, 2)}% AUC: {round(AUC, 4)} "
+              f"time: {round(seconds, 2)}s")
+        rows.append([method, uncertainty, str(accuracy), str(AUC), str(seconds)])
+
+    difference = np.abs(probabilities - mc_entropy[:, :-1]).mean()
+    print(f"Mean absolute difference between the probabilities: {difference}")
+    helper.write_rows(rows, root_dir + "moment_comparison.csv")
+
+    return rows
+
+
+def laplace_pred(data_set, laplace, device, ISIC, features=False):
+    """
+    Predictions from the probit approximated predictive distribution of a last layer Laplace approximation, a single
+    pass over the data with the same columns as softmax_pred
+    :param data_set: data set to draw images and labels from
+    :param laplace: fitted laplace.LastLayerLaplace
+    :param device: device to hold predictions on
+    :param ISIC: whether or not to write predictions in the ISIC2019 requested style:
+    :param features: whether data_set holds cached backbone features rather than images
+    :return: predictions using 1 - maximum probability, predictions using entropy and the cost of each classification
+    """
+    filenames = []
+    probabilities = []
+    covariance = laplace.posterior_covariance()
+
+    laplace.network.eval()
+
+    for i_batch, sample_batch in enumerate(tqdm(data_set)):
+        image_batch = sample_batch['image'].to(device)
+        filenames += list(sample_batch['filename'])
+
+        with torch.no_grad():
+            mean, variance = laplace.logit_moments(image_batch, features, covariance)
+            outputs = approximate_softmax(mean, variance)[0]
+
+        probabilities.append(outputs.cpu().numpy().astype(np.float64))
+
+    probabilities = np.vstack(probabilities)
+    entropies = get_entropy(np.hstack((probabilities, 1 - probabilities.max(axis=1)[:, np.newaxis])))
+    entropies = (entropies - entropies.min()) / (entropies.max() - entropies.min())
+
+    predictions = np.hstack((probabilities, 1 - probabilities.max(axis=1)[:, np.newaxis]))
+    predictions_e = np.hstack((probabilities, entropies[:, np.newaxis]))
+    costs = cost_model.expected_costs(predictions_e, uncertain=True)
+
+    predictions = [helper.float_to_string(row) for row in predictions.tolist()]
+    predictions_e = [helper.float_to_string(row) for row in predictions_e.tolist()]
+    costs = [helper.float_to_string(row) for row in costs.tolist()]
+
+    if ISIC:
+        for i in range(0, len(predictions)):
+            predictions[i].insert(0, filenames[i][:-4])
+
+    return predictions, predictions_e, costs
+
+
+def density_pred(data_set, network, density, n_classes, device, ISIC, features=False):
+    """
+    Single deterministic pass scoring each image by the negative log density of its backbone features alongside the
+    softmax response, in the same layout as softmax_pred
+    :param data_set: data set to draw images and labels from
+    :param network: network to run predictions with
+    :param density: fitted feature_density.FeatureDensity
+    :param n_classes: number of expected output classes
+    :param device: device to hold predictions on
+    :param ISIC: whether or not to write predictions in the ISIC2019 requested style:
+    :param features: whether data_set holds cached backbone features rather than images
+    :return: predictions using the normalised negative log density, predictions using entropy and the cost of each
+    classification, using the density as the uncertainty
+    """
+    filenames = []
+    probabilities = []
+    log_densities = []
+    soft_max = nn.Softmax(dim=1)
+
+    network.eval()
+
+    for i_batch, sample_batch in enumerate(tqdm(data_set)):
+        image_batch = sample_batch['image'].to(device)
+        filenames += list(sample_batch['filename'])
+
+        with torch.no_grad():
+            if features:
+                efficient_net_output = image_batch
+            else:
+                efficient_net_output = network.extract_efficientNet(image_batch)
+            outputs = soft_max(network.mean_pass(efficient_net_output))
+            log_density = density.log_density(efficient_net_output)
+
+        probabilities.append(outputs.cpu().numpy().astype(np.float64))
+        log_densities.append(log_density.cpu().numpy())
+
+    probabilities = np.vstack(probabilities)
+    uncertainties = -np.concatenate(log_densities)
+    uncertainties = (uncertainties - uncertainties.min()) / (uncertainties.max() - uncertainties.min())
+    entropies = get_entropy(np.hstack((probabilities, 1 - probabilities.max(axis=1)[:, np.newaxis])))
+    entropies = (entropies - entropies.min()) / (entropies.max() - entropies.min())
+
+    predictions = np.hstack((probabilities, uncertainties[:, np.newaxis]))
+    predictions_e = np.hstack((probabilities, entropies[:, np.newaxis]))
+    costs = cost_model.expected_costs(predictions, uncertain=True)
+
+    predictions = [helper.float_to_string(row) for row in predictions.tolist()]
+    predictions_e = [helper.float_to_string(row) for row in predictions_e.tolist()]
+    costs = [helper.float_to_string(row) for row in costs.tolist()]
+
+    if ISIC:
+        for i in range(0, len(predictions)):
+            predictions[i].insert(0, filenames[i][:-4])
+
+    return predictions, predictions_e, costs
+
+
+def student_pred(data_set, network, student, n_classes, device, ISIC, features=False):
+    """
+    Single pass predictions from a distilled StudentHead, in the same layout as monte_carlo so the student can be
+    compared against its teacher
+    :param data_set: data set to draw images and labels from
+    :param network: the teacher, whose backbone the student runs on
+    :param student: trained model.StudentHead
+    :param n_classes: number of expected output classes
+    :param device: device to hold predictions on
+    :param ISIC: whether or not to write predictions in the ISIC2019 requested style:
+    :param features: whether data_set holds cached backbone features rather than images
+    :return: predictions using entropy, predictions using variance and the cost of each classification
+    """
+    filenames = []
+    probabilities = []
+    uncertainties = []
 
-    for cost in costs_mean:
-        for c in range(0, len(cost)):
-            cost[c] = '{:.17f}'.format(cost[c])
+    network.eval()
+    student.eval()
+
+    for i_batch, sample_batch in enumerate(tqdm(data_set)):
+        image_batch = sample_batch['image'].to(device)
+        filenames += list(sample_batch['filename'])
+
+        with torch.no_grad():
+            if features:
+                efficient_net_output = image_batch.float()
+            else:
+                efficient_net_output = network.extract_efficientNet(image_batch)
+            outputs, uncertainty = student(efficient_net_output)
+
+        probabilities.append(torch.softmax(outputs, dim=1).cpu().numpy().astype(np.float64))
+        uncertainties.append(uncertainty.cpu().numpy().astype(np.float64))
+
+    probabilities = np.vstack(probabilities)
+    uncertainties = np.vstack(uncertainties)
+    entropies = uncertainties[:, 0]
+
+    mean_entropy = np.hstack((probabilities, entropies[:, np.newaxis]))
+    costs_mean = cost_model.expected_costs(mean_entropy, uncertain=True)
+    mean_variance = np.hstack((probabilities, uncertainties[:, 1:]))
+    mean_entropy[:, -1] = (entropies - entropies.min()) / (entropies.max() - entropies.min())
+
+    mean_entropy = [helper.float_to_string(row) for row in mean_entropy.tolist()]
+    mean_variance = [helper.float_to_string(row) for row in mean_variance.tolist()]
+    costs_mean = [helper.float_to_string(row) for row in costs_mean.tolist()]
+
+    if ISIC:
+        for i in range(0, len(mean_entropy)):
+            mean_entropy[i].insert(0, filenames[i][:-4])
 
     return mean_entropy, mean_variance, costs_mean
 
 
-def predict(test_set, root_dir, network, num_samples, device, n_classes=8, mc_dropout=False, BBB=False, forward_passes=100, softmax=False, ISIC=False):
+def selective_pred(data_set, network, n_classes, device, ISIC, features=False):
+    """
+    Single pass SelectiveNet predictions, using one minus the selection score as the uncertainty, in the same layout
+    as softmax_pred
+    :param data_set: data set to draw images and labels from
+    :param network: Classifier built with selective=True
+    :param n_classes: number of expected output classes
+    :param device: device to hold predictions on
+    :param ISIC: whether or not to write predictions in the ISIC2019 requested style:
+    :param features: whether data_set holds cached backbone features rather than images
+    :return: predictions using 1 - selection score, predictions using entropy and the cost of each classification,
+    using the selection score as the uncertainty
+    """
+    filenames = []
+    probabilities = []
+    selections = []
+    soft_max = nn.Softmax(dim=1)
+
+    network.eval()
+
+    for i_batch, sample_batch in enumerate(tqdm(data_set)):
+        image_batch = sample_batch['image'].to(device)
+        filenames += list(sample_batch['filename'])
+
+        with torch.no_grad():
+            outputs = soft_max(network(image_batch, dropout=False, features=features))
+
+        probabilities.append(outputs.cpu().numpy().astype(np.float64))
+        selections.append(network.selection.cpu().numpy().astype(np.float64))
+
+    probabilities = np.vstack(probabilities)
+    uncertainties = 1 - np.concatenate(selections)
+    entropies = get_entropy(np.hstack((probabilities, 1 - probabilities.max(axis=1)[:, np.newaxis])))
+    entropies = (entropies - entropies.min()) / (entropies.max() - entropies.min())
+
+    predictions = np.hstack((probabilities, uncertainties[:, np.newaxis]))
+    predictions_e = np.hstack((probabilities, entropies[:, np.newaxis]))
+    costs = cost_model.expected_costs(predictions, uncertain=True)
+
+    predictions = [helper.float_to_string(row) for row in predictions.tolist()]
+    predictions_e = [helper.float_to_string(row) for row in predictions_e.tolist()]
+    costs = [helper.float_to_string(row) for row in costs.tolist()]
+
+    if ISIC:
+        for i in range(0, len(predictions)):
+            predictions[i].insert(0, filenames[i][:-4])
+
+    return predictions, predictions_e, costs
+
+
+def predict(test_set, root_dir, network, num_samples, device, n_classes=8, mc_dropout=False, BBB=False, forward_passes=100, softmax=False, ISIC=False,
+            features=False, cascade=False, threshold=0.5, cascade_cost=False, moment=False,
+            laplace=None, density=None, student=None, selective=False, ensemble=False, swag=None,
+            swag_bn_set=None):
     """
     Manages the functions inside this class
     :param test_set: Pytorch data loader class to test the network on
@@ -235,6 +727,18 @@ def predict(test_set, root_dir, network, num_samples, device, n_classes=8, mc_dr
     :param forward_passes: number of samples from the varational posteriors
     :param softmax: whether to just return a basic softmax response
     :param ISIC: whether to predict on ISIC or not
+    :param features: whether test_set holds cached backbone features rather than images
+    :param cascade: only run the forward passes on images the softmax response is uncertain about
+    :param threshold: normalised entropy, or LEC if cascade_cost is True, above which images are sampled
+    :param cascade_cost: escalate images on their lowest expected cost rather than entropy
+    :param moment: replace the MC dropout forward passes with a single moment propagation pass
+    :param laplace: fitted laplace.LastLayerLaplace to predict with, in place of the softmax response
+    :param density: fitted feature_density.FeatureDensity, scores the softmax response by feature density
+    :param student: model.StudentHead distilled from network, replaces the MC Dropout or BBB forward passes
+    :param selective: predict with the SelectiveNet selection score as the uncertainty
+    :param ensemble: predict with every member of a BatchEnsemble network
+    :param swag: swag.SWAG posterior to sample forward_passes sets of weights from
+    :param swag_bn_set: training data to recompute the BatchNorm statistics over after each SWAG sample
     :return: returns the predictions generated by each of our methods
     """
 
@@ -242,16 +746,54 @@ def predict(test_set, root_dir, network, num_samples, device, n_classes=8, mc_dr
     # Make sure network is in eval mode
     network.eval()
 
-    if mc_dropout:
+    if student is not None:
+        predictions_e, predictions_v, costs = student_pred(test_set, network, student, n_classes, device, ISIC,
+                                                           features)
+        return predictions_e, predictions_v, costs
+
+    elif swag is not None:
+        predictions_e, predictions_v, costs = monte_carlo(test_set, forward_passes, network, num_samples, n_classes,
+                                                          root_dir, device, BBB, ISIC, features, swag=swag,
+                                                          bn_update_set=swag_bn_set)
+        return predictions_e, predictions_v, costs
+
+    elif ensemble:
         predictions_e, predictions_v, costs = monte_carlo(test_set, forward_passes, network, num_samples, n_classes,
-                                                          root_dir, device, BBB, ISIC)
+                                                          root_dir, device, BBB, ISIC, features, ensemble=True)
+        return predictions_e, predictions_v, costs
+
+    elif cascade and (mc_dropout or BBB):
+        predictions_e, predictions_v, costs = cascade_pred(test_set, forward_passes, network, n_classes, root_dir,
+                                                           device, BBB, ISIC, threshold, cascade_cost, features)
         return predictions_e, predictions_v, costs
 
+    elif mc_dropout and moment:
+        predictions_e, predictions_v, costs = moment_pred(test_set, network, n_classes, device, ISIC, features)
+        return predictions_e, predictions_v, costs
+
+    elif mc_dropout:
+        predictions_e, predictions_v, costs = monte_carlo(test_set, forward_passes, network, num_samples, n_classes,
+                                                          root_dir, device, BBB, ISIC, features)
+        return predictions_e, predictions_v, costs
+
+    elif laplace is not None:
+        predictions, predictions_e, costs = laplace_pred(test_set, laplace, device, ISIC, features)
+        return predictions, predictions_e, costs
+
+    elif density is not None:
+        predictions, predictions_e, costs = density_pred(test_set, network, density, n_classes, device, ISIC,
+                                                         features)
+        return predictions, predictions_e, costs
+
+    elif selective:
+        predictions, predictions_e, costs = selective_pred(test_set, network, n_classes, device, ISIC, features)
+        return predictions, predictions_e, costs
+
     elif softmax:
-        predictions, predictions_e, costs = softmax_pred(test_set, network, n_classes, num_samples, device, ISIC)
+        predictions, predictions_e, costs = softmax_pred(test_set, network, n_classes, device, ISIC, features)
         return predictions, predictions_e, costs
 
     elif BBB:
         predictions_e, predictions_v, costs = monte_carlo(test_set, forward_passes, network, num_samples, n_classes,
-                                                          root_dir, device, BBB, ISIC)
+                                                          root_dir, device, BBB, ISIC, features)
         return predictions_e, predictions_v, costs
\ No newline at end of file
@@ -2,7 +2,7 @@ import helper
 import torch
 import torch.optim as optimizer
 from torchvision import transforms
-from torch.utils.data import random_split, SubsetRandomSampler, Subset, WeightedRandomSampler
+from torch.utils.data import random_split, SubsetRandomSampler, Subset
 import numpy as np
 import torch.nn as nn
 from tqdm import tqdm
@@ -11,6 +11,12 @@ import os
 # Import other files
 import data_loading
 import data_plotting
+import distillation
+import features
+import feature_density
+import laplace
+import prediction_store
+import swag
 import testing
 import helper
 import model
@@ -45,6 +51,12 @@ train_data = data_loading.data_set("ISIC_2019_Training_Input", labels_path="Trai
 test_data = data_loading.data_set("ISIC_2019_Training_Input", labels_path="Training_meta_data/ISIC_2019_Training_GroundTruth.csv",  transforms=composed_test)
 ISIC_data = data_loading.data_set("ISIC_2019_Test_Input",  transforms=composed_test)
 
+def cascade_threshold():
+    """
+    :return: the threshold above which the cascade escalates images, in LEC when escalating on cost
+    """
+    return constants.CASCADE_COST_THRESHOLD if constants.CASCADE_COST else constants.CASCADE_THRESHOLD
+
 def setup():
 
     if constants.ENABLE_GPU:
@@ -52,6 +64,11 @@ def setup():
     else:
         constants.DEVICE = torch.device("cpu")
 
+    if constants.IMAGE_CACHE:
+        train_data.build_cache(constants.IMAGE_CACHE_DIR + "/training/", constants.IMAGE_CACHE_SIZE)
+        test_data.build_cache(constants.IMAGE_CACHE_DIR + "/training/", constants.IMAGE_CACHE_SIZE)
+        ISIC_data.build_cache(constants.IMAGE_CACHE_DIR + "/ISIC/", constants.IMAGE_CACHE_SIZE)
+
     weights = [3188, 8985, 2319, 602, 1862, 164, 170, 441]  # Distribution when using 70% of dataset
 
     # Calculate the weights for the sampler function and loss functions
@@ -74,7 +91,11 @@ def setup():
     class_weights = class_weights.to(constants.DEVICE)
     sampler_weights = sampler_weights.to(constants.DEVICE)
 
-    network = model.Classifier(constants.IMAGE_SIZE, 8, class_weights, constants.DEVICE, dropout=0.5, BBB=constants.BBB)
+    network = model.Classifier(constants.IMAGE_SIZE, 8, class_weights, constants.DEVICE, dropout=0.5, BBB=constants.BBB,
+                               local_reparameterization=constants.LOCAL_REPARAMETERIZATION,
+                               prior=constants.BBB_PRIOR, prior_sigma=constants.BBB_PRIOR_SIGMA,
+                               flipout=constants.FLIPOUT, selective=constants.SELECTIVE,
+                               ensemble_size=constants.ENSEMBLE_SIZE)
     network.to(constants.DEVICE)
 
     if constants.BBB:
@@ -94,12 +115,25 @@ def setup():
 
     if BBB:
         SAVE_DIR += f"/BBB_Classifier_{i}/"
+    elif constants.SELECTIVE:
+        SAVE_DIR += f"/SN_Classifier_{i}/"
+    elif constants.ENSEMBLE_SIZE > 1:
+        SAVE_DIR += f"/BE_Classifier_{i}/"
     elif TRAIN_MC_DROPOUT:
         SAVE_DIR += f"/MC_Classifier_{i}/"
     else:
         SAVE_DIR += f"/SM_Classifier_{i}/"
 
-    if LOAD:
+    if LOAD and not os.path.exists(SAVE_DIR + "model_parameters") and os.path.exists(SAVE_DIR + "training_state"):
+
+        # Stopped during the first epoch, so carry on from the mid-epoch state with the network built above
+        epochs = constants.BBB_WARM_START_EPOCHS if BBB and constants.BBB_WARM_START else None
+        if BBB and constants.BBB_WARM_START:
+            optim, scheduler = BBB_optim(step_size_up=int(555 * constants.BBB_WARM_START_EPOCHS / 2))
+        starting_epoch, val_losses, train_losses, val_accuracies, train_accuracies = train(
+            SAVE_DIR, 0, [], [], [], [], verbose=True, epochs=epochs, resume=True)
+
+    elif LOAD:
 
         network, optim, scheduler, starting_epoch, \
             val_losses, train_losses, val_accuracies, \
@@ -111,7 +145,21 @@ def setup():
                                                                                                train_losses,
                                                                                                val_accuracies,
                                                                                                train_accuracies,
-                                                                                               verbose=False)
+                                                                                               verbose=False,
+                                                                                               resume=True)
+
+    elif BBB and constants.BBB_WARM_START:
+
+        # Start from the softmax network trained with the same index and only fine-tune
+        network = helper.warm_start_BBB(ROOT_SAVE_DIR + f"/SM_Classifier_{i}/", 8, constants.IMAGE_SIZE,
+                                        constants.DEVICE, class_weights, sigma=constants.BBB_WARM_START_SIGMA,
+                                        local_reparameterization=constants.LOCAL_REPARAMETERIZATION,
+                                        prior=constants.BBB_PRIOR, prior_sigma=constants.BBB_PRIOR_SIGMA,
+                                        flipout=constants.FLIPOUT)
+        # A single learning rate cycle over the fine-tune, so it finishes back at the base learning rate
+        optim, scheduler = BBB_optim(step_size_up=int(555 * constants.BBB_WARM_START_EPOCHS / 2))
+        starting_epoch, val_losses, train_losses, val_accuracies, train_accuracies = train(
+            SAVE_DIR, 0, [], [], [], [], verbose=True, epochs=constants.BBB_WARM_START_EPOCHS)
 
     else:
 
@@ -122,6 +170,7 @@ def setup():
 
     network, optim, scheduler, starting_epoch, val_losses, train_losses, val_accuracies, train_accuracies = helper.load_net(
         SAVE_DIR, 8, constants.IMAGE_SIZE, constants.DEVICE, class_weights)
+    network.local_reparameterization = constants.LOCAL_REPARAMETERIZATION
 
     if not os.path.exists(SAVE_DIR + "entropy/"):
         os.mkdir(SAVE_DIR + "entropy/")
@@ -132,23 +181,24 @@ def setup():
             if ISIC_pred:
                 predictions_BBB_entropy, predictions_BBB_var, costs_BBB = testing.predict(ISIC_set, SAVE_DIR, network,
                                                                                           len(ISIC_data),
-                                                                                          constants.DEVICE, mc_dropout=True,
+                                                                                          constants.DEVICE, BBB=True,
                                                                                           forward_passes=FORWARD_PASSES,
-                                                                                          ISIC=True)
-                predictions_BBB_entropy.insert(0,
-                                               ["image", "MEL", "NV", "BCC", "AK", "BKL", "DF", "VASC", "SCC", "UNK"])
+                                                                                          cascade=constants.CASCADE,
+                                                                                          threshold=cascade_threshold(),
+                                                                                          cascade_cost=constants.CASCADE_COST,
+                                                                                          ISIC=True,
+                                                                                          features=constants.HEAD_ONLY)
             else:
 
                 predictions_BBB_entropy, predictions_BBB_var, costs_BBB = testing.predict(test_set, SAVE_DIR, network,
                                                                                           test_size, constants.DEVICE,
                                                                                           BBB=True,
-                                                                                          forward_passes=FORWARD_PASSES)
-            helper.write_rows(predictions_BBB_entropy, SAVE_DIR + "BBB_entropy_predictions.csv")
-            helper.write_rows(predictions_BBB_var, SAVE_DIR + "BBB_variance_predictions.csv")
-            helper.write_rows(costs_BBB, SAVE_DIR + "BBB_costs.csv")
-
-            costs_BBB = helper.read_rows(SAVE_DIR + "BBB_costs.csv")
-            predictions_BBB = helper.read_rows(SAVE_DIR + "BBB_entropy_predictions.csv")
+                                                                                          forward_passes=FORWARD_PASSES,
+                                                                                          cascade=constants.CASCADE,
+                                                                                          threshold=cascade_threshold(),
+                                                                                          cascade_cost=constants.CASCADE_COST,
+                                                                                          features=constants.HEAD_ONLY)
+            predictions_BBB, costs_BBB = read_sampled_predictions(SAVE_DIR, "BBB")
 
     if SOFTMAX:
 
@@ -156,12 +206,14 @@ def setup():
         if ISIC_pred:
             predictions_softmax, entropy_soft, costs_softmax = testing.predict(ISIC_set, SAVE_DIR, network,
                                                                                len(ISIC_data), constants.DEVICE,
-                                                                               softmax=True, ISIC=True)
+                                                                               softmax=True, ISIC=True,
+                                                                               features=constants.HEAD_ONLY)
             predictions_softmax.insert(0, ["image", "MEL", "NV", "BCC", "AK", "BKL", "DF", "VASC", "SCC", "UNK"])
         else:
             predictions_softmax, entropy_soft, costs_softmax = testing.predict(test_set, SAVE_DIR, network,
                                                                                test_size, constants.DEVICE,
-                                                                               softmax=True)
+                                                                               softmax=True,
+                                                                               features=constants.HEAD_ONLY)
         helper.write_rows(predictions_softmax, SAVE_DIR + "softmax_predictions.csv")
         helper.write_rows(entropy_soft, SAVE_DIR + "softmax_entropy.csv")
         helper.write_rows(costs_softmax, SAVE_DIR + "softmax_costs.csv")
@@ -169,32 +221,166 @@ def setup():
         predictions_softmax = helper.read_rows(SAVE_DIR + "softmax_predictions.csv")
         costs_sr = helper.read_rows(SAVE_DIR + "softmax_costs.csv")
 
+        if constants.LAPLACE:
+            last_layer_laplace = laplace.LastLayerLaplace(network, hessian=constants.LAPLACE_HESSIAN)
+            last_layer_laplace.fit(get_fit_set(), constants.DEVICE, features=constants.HEAD_ONLY)
+            last_layer_laplace.optimise_prior_precision(val_set, constants.DEVICE, features=constants.HEAD_ONLY)
+
+            if ISIC_pred:
+                predictions_laplace, entropy_laplace, costs_laplace = testing.predict(
+                    ISIC_set, SAVE_DIR, network, len(ISIC_data), constants.DEVICE, laplace=last_layer_laplace,
+                    ISIC=True, features=constants.HEAD_ONLY)
+                predictions_laplace.insert(0, ["image", "MEL", "NV", "BCC", "AK", "BKL", "DF", "VASC", "SCC", "UNK"])
+            else:
+                predictions_laplace, entropy_laplace, costs_laplace = testing.predict(
+                    test_set, SAVE_DIR, network, test_size, constants.DEVICE, laplace=last_layer_laplace,
+                    features=constants.HEAD_ONLY)
+            helper.write_rows(predictions_laplace, SAVE_DIR + "laplace_predictions.csv")
+            helper.write_rows(entropy_laplace, SAVE_DIR + "laplace_entropy.csv")
+            helper.write_rows(costs_laplace, SAVE_DIR + "laplace_costs.csv")
+
+        if constants.FEATURE_DENSITY:
+            density = feature_density.FeatureDensity(covariance=constants.DENSITY_COVARIANCE)
+            density.fit(get_fit_set(), network, constants.DEVICE, features=constants.HEAD_ONLY)
+
+            if ISIC_pred:
+                predictions_density, entropy_density, costs_density = testing.predict(
+                    ISIC_set, SAVE_DIR, network, len(ISIC_data), constants.DEVICE, density=density, ISIC=True,
+                    features=constants.HEAD_ONLY)
+                predictions_density.insert(0, ["image", "MEL", "NV", "BCC", "AK", "BKL", "DF", "VASC", "SCC", "UNK"])
+            else:
+                predictions_density, entropy_density, costs_density = testing.predict(
+                    test_set, SAVE_DIR, network, test_size, constants.DEVICE, density=density,
+                    features=constants.HEAD_ONLY)
+            helper.write_rows(predictions_density, SAVE_DIR + "density_predictions.csv")
+            helper.write_rows(entropy_density, SAVE_DIR + "density_entropy.csv")
+            helper.write_rows(costs_density, SAVE_DIR + "density_costs.csv")
+
         if ISIC_pred:
             predictions_mc_entropy, predictions_mc_var, costs_mc = testing.predict(ISIC_set, SAVE_DIR, network,
                                                                                    len(ISIC_data),
                                                                                    constants.DEVICE, mc_dropout=True,
                                                                                    forward_passes=FORWARD_PASSES,
-                                                                                   ISIC=True)
-            predictions_mc_entropy.insert(0, ["image", "MEL", "NV", "BCC", "AK", "BKL", "DF", "VASC", "SCC", "UNK"])
+                                                                                   cascade=constants.CASCADE,
+                                                                                   threshold=cascade_threshold(),
+                                                                                   cascade_cost=constants.CASCADE_COST,
+                                                                                   ISIC=True,
+                                                                                   features=constants.HEAD_ONLY)
         else:
             predictions_mc_entropy, predictions_mc_var, costs_mc = testing.predict(test_set, SAVE_DIR, network,
                                                                                    test_size,
                                                                                    constants.DEVICE, mc_dropout=True,
-                                                                                   forward_passes=FORWARD_PASSES)
-        helper.write_rows(predictions_mc_entropy, SAVE_DIR + "mc_entropy_predictions.csv")
-        helper.write_rows(predictions_mc_var, SAVE_DIR + "mc_variance_predictions.csv")
-        helper.write_rows(costs_mc, SAVE_DIR + "mc_costs.csv")
+                                                                                   forward_passes=FORWARD_PASSES,
+                                                                                   cascade=constants.CASCADE,
+                                                                                   threshold=cascade_threshold(),
+                                                                                   cascade_cost=constants.CASCADE_COST,
+                                                                                   features=constants.HEAD_ONLY)
+        predictions_mc, costs_mc = read_sampled_predictions(SAVE_DIR, "mc")
+
+        if constants.MOMENT_PROPAGATION:
+            if ISIC_pred:
+                predictions_moment_entropy, predictions_moment_var, costs_moment = testing.predict(
+                    ISIC_set, SAVE_DIR, network, len(ISIC_data), constants.DEVICE, mc_dropout=True, moment=True,
+                    ISIC=True, features=constants.HEAD_ONLY)
+                predictions_moment_entropy.insert(0, ["image", "MEL", "NV", "BCC", "AK", "BKL", "DF", "VASC", "SCC",
+                                                      "UNK"])
+            else:
+                predictions_moment_entropy, predictions_moment_var, costs_moment = testing.predict(
+                    test_set, SAVE_DIR, network, test_size, constants.DEVICE, mc_dropout=True, moment=True,
+                    features=constants.HEAD_ONLY)
+                testing.compare_moment_propagation(test_set, SAVE_DIR, network, test_size, constants.DEVICE,
+                                                   forward_passes=FORWARD_PASSES, features=constants.HEAD_ONLY)
+            helper.write_rows(predictions_moment_entropy, SAVE_DIR + "moment_entropy_predictions.csv")
+            helper.write_rows(predictions_moment_var, SAVE_DIR + "moment_variance_predictions.csv")
+            helper.write_rows(costs_moment, SAVE_DIR + "moment_costs.csv")
+
+    if constants.SELECTIVE:
+        if ISIC_pred:
+            predictions_selective, entropy_selective, costs_selective = testing.predict(
+                ISIC_set, SAVE_DIR, network, len(ISIC_data), constants.DEVICE, selective=True, ISIC=True,
+                features=constants.HEAD_ONLY)
+            predictions_selective.insert(0, ["image", "MEL", "NV", "BCC", "AK", "BKL", "DF", "VASC", "SCC", "UNK"])
+        else:
+            predictions_selective, entropy_selective, costs_selective = testing.predict(
+                test_set, SAVE_DIR, network, test_size, constants.DEVICE, selective=True,
+                features=constants.HEAD_ONLY)
+        helper.write_rows(predictions_selective, SAVE_DIR + "selective_predictions.csv")
+        helper.write_rows(entropy_selective, SAVE_DIR + "selective_entropy.csv")
+        helper.write_rows(costs_selective, SAVE_DIR + "selective_costs.csv")
+
+    if constants.ENSEMBLE_SIZE > 1:
+        if ISIC_pred:
+            predictions_ensemble_entropy, predictions_ensemble_var, costs_ensemble = testing.predict(
+                ISIC_set, SAVE_DIR, network, len(ISIC_data), constants.DEVICE, ensemble=True, ISIC=True,
+                features=constants.HEAD_ONLY)
+        else:
+            predictions_ensemble_entropy, predictions_ensemble_var, costs_ensemble = testing.predict(
+                test_set, SAVE_DIR, network, test_size, constants.DEVICE, ensemble=True,
+                features=constants.HEAD_ONLY)
+        predictions_ensemble, costs_ensemble = read_sampled_predictions(SAVE_DIR, "ensemble")
+
+    if constants.SWAG:
+        swag_posterior = swag.SWAG.load(SAVE_DIR + "swag.pt", network)
+        # BatchNorm statistics are recomputed over these after every weight sample
+        swag_bn_set = get_fit_set(constants.SWAG_BN_UPDATE_SIZE)
+
+        if ISIC_pred:
+            predictions_swag_entropy, predictions_swag_var, costs_swag = testing.predict(
+                ISIC_set, SAVE_DIR, network, len(ISIC_data), constants.DEVICE, swag=swag_posterior,
+                forward_passes=FORWARD_PASSES, ISIC=True, features=constants.HEAD_ONLY, swag_bn_set=swag_bn_set)
+        else:
+            predictions_swag_entropy, predictions_swag_var, costs_swag = testing.predict(
+                test_set, SAVE_DIR, network, test_size, constants.DEVICE, swag=swag_posterior,
+                forward_passes=FORWARD_PASSES, features=constants.HEAD_ONLY, swag_bn_set=swag_bn_set)
+        predictions_swag, costs_swag = read_sampled_predictions(SAVE_DIR, "swag")
+
+    if constants.DISTIL:
+        # Distil whichever of MC Dropout or BBB this network was trained for
+        prefix = "BBB" if constants.BBB else "mc"
+        student = distillation.distil(train_set, network, constants.DEVICE, forward_passes=FORWARD_PASSES,
+                                      BBB=constants.BBB, features=constants.HEAD_ONLY, epochs=constants.DISTIL_EPOCHS)
+        torch.save(student.state_dict(), SAVE_DIR + f"{prefix}_student.pt")
+
+        if ISIC_pred:
+            predictions_student_entropy, predictions_student_var, costs_student = testing.predict(
+                ISIC_set, SAVE_DIR, network, len(ISIC_data), constants.DEVICE, student=student, ISIC=True,
+                features=constants.HEAD_ONLY)
+            predictions_student_entropy.insert(0, ["image", "MEL", "NV", "BCC", "AK", "BKL", "DF", "VASC", "SCC",
+                                                   "UNK"])
+        else:
+            predictions_student_entropy, predictions_student_var, costs_student = testing.predict(
+                test_set, SAVE_DIR, network, test_size, constants.DEVICE, student=student,
+                features=constants.HEAD_ONLY)
+        helper.write_rows(predictions_student_entropy, SAVE_DIR + f"{prefix}_student_entropy_predictions.csv")
+        helper.write_rows(predictions_student_var, SAVE_DIR + f"{prefix}_student_variance_predictions.csv")
+        helper.write_rows(costs_student, SAVE_DIR + f"{prefix}_student_costs.csv")
 
-        predictions_mc = helper.read_rows(SAVE_DIR + "mc_entropy_predictions.csv")
-        costs_mc = helper.read_rows(SAVE_DIR + "mc_costs.csv")
 
+def read_sampled_predictions(root_dir, prefix):
+    """
+    Reads the final predictions of a forward pass method back from the prediction store testing.monte_carlo saved
+    them to, they are only written out as CSVs for an ISIC submission
+    :param root_dir: directory the model is saved in
+    :param prefix: mc, BBB, ensemble or swag
+    :return: the final predictions using entropy and the cost of each classification
+    """
+    store = prediction_store.PredictionStore(root_dir + f"{prefix}_forward_passes")
+    if ISIC_pred:
+        store.export_csv(root_dir, prefix, passes=False, ISIC=True)
+
+    return store.get_final("entropy").tolist(), store.get_final("costs").tolist()
 
-def BBB_optim():
+
+def BBB_optim(step_size_up=555 * 5):
+    """
+    :param step_size_up: number of batches in the rising half of each learning rate cycle
+    :return: the optimizer and CyclicLR scheduler for a BbB network
+    """
     # Set the learning rate to be higher for the Bayesian Layer
     BBB_weights = ['hidden_layer.weight_mu', 'hidden_layer.weight_rho', 'hidden_layer.bias_mu',
                    'hidden_layer.bias_rho',
                    'hidden_layer2.weight_mu', 'hidden_layer2.weight_rho', 'hidden_layer2.bias_mu',
-                   'hidden_layer2.bias_rho']
+                   'hidden_layer2.bias_rho', 'hidden_layer.prior_mu', 'hidden_layer.prior_log_sigma']
 
     BBB_parameters = list(
         map(lambda x: x[1], list(filter(lambda kv: kv[0] in BBB_weights, network.named_parameters()))))
@@ -207,17 +393,16 @@ def BBB_optim():
     ], lr=0.0001, momentum=0.9, weight_decay=0.00001)
 
     scheduler = optimizer.lr_scheduler.CyclicLR(optim, base_lr=[0.0001, 0.0001], max_lr=[0.1, 0.02],
-                                                step_size_up=(555 * 5), mode="triangular2")
+                                                step_size_up=step_size_up, mode="triangular2")
 
+    return optim, scheduler
 
-def get_data_sets(plot=False):
+
+def get_split_indexes():
     """
-    Splits the data sets into train, test and validation sets
-    :param plot: If true, plot some samples form each set
-    :return: the DataLoader objects, ready to be called from for each set
+    70% split to train set, use 2/3rds of the remaining data (20%) for the testing set and 10% for validation
+    :return: the indexes of the train, validation and test sets
     """
-
-    # 70% split to train set, use 2/3rds of the remaining data (20%) for the testing set and 10% for validation
     indices = list(range(len(train_data)))
     split_train = int(np.floor(0.7 * len(indices)))
     split_test = int(np.floor(0.66667 * (len(indices) - split_train)))
@@ -225,15 +410,73 @@ def get_data_sets(plot=False):
     temp_idx, train_idx = indices[split_train:], indices[:split_train]
     valid_idx, test_idx = temp_idx[split_test:], temp_idx[:split_test]
 
-    weighted_train_idx = []
+    return train_idx, valid_idx, test_idx
 
-    for c in range(0, len(train_idx)):
-        label = train_data.get_label(train_idx[c])
-        weighted_idx = sampler_weights[label]
-        weighted_train_idx.append(weighted_idx)
 
-    weighted_train_sampler = WeightedRandomSampler(weights=weighted_train_idx,
-                                                   num_samples=len(weighted_train_idx), replacement=True)
+def get_feature_sets(root_dir):
+    """
+    Runs the backbone once over each split and returns DataLoaders over the saved features, used to train and test
+    only the head. The training split uses the test transforms, as augmentation would need a new backbone pass
+    :param root_dir: Directory the model is saved in, features are saved under root_dir/features/
+    :return: the DataLoader objects for each set, in the same order as get_data_sets
+    """
+    train_idx, valid_idx, test_idx = get_split_indexes()
+
+    train_features = features.extract_features(Subset(test_data, train_idx), network, constants.DEVICE,
+                                               root_dir + "features/train/", dtype=constants.FEATURE_DTYPE)
+    valid_features = features.extract_features(Subset(test_data, valid_idx), network, constants.DEVICE,
+                                               root_dir + "features/valid/", dtype=constants.FEATURE_DTYPE)
+    test_features = features.extract_features(Subset(test_data, test_idx), network, constants.DEVICE,
+                                              root_dir + "features/test/", dtype=constants.FEATURE_DTYPE)
+    ISIC_features = features.extract_features(ISIC_data, network, constants.DEVICE,
+                                              root_dir + "features/ISIC/", dtype=constants.FEATURE_DTYPE)
+
+    train_labels = torch.from_numpy(train_features.labels)
+    weighted_train_sampler = data_loading.ResumableWeightedSampler(weights=sampler_weights.cpu()[train_labels],
+                                                                   num_samples=len(train_features))
+
+    training_set = torch.utils.data.DataLoader(train_features, batch_size=BATCH_SIZE, sampler=weighted_train_sampler)
+    valid_set = torch.utils.data.DataLoader(valid_features, batch_size=BATCH_SIZE, shuffle=True)
+    testing_set = torch.utils.data.DataLoader(test_features, batch_size=BATCH_SIZE, shuffle=False)
+    ISIC_set = torch.utils.data.DataLoader(ISIC_features, batch_size=BATCH_SIZE, shuffle=False)
+
+    return training_set, valid_set, testing_set, ISIC_set, len(test_idx), len(train_idx), len(valid_idx), test_idx
+
+
+def get_fit_set(size=None):
+    """
+    Unweighted pass over the training split with the test transforms, used to fit the post-hoc uncertainty methods
+    to the training data itself rather than the class balanced and augmented stream the network is trained on
+    :param size: number of training images to draw at random, every one if None
+    :return: DataLoader over the training split
+    """
+    if constants.HEAD_ONLY:
+        # The cached training features already use the test transforms
+        fit_data = train_set.dataset
+    else:
+        fit_data = Subset(test_data, get_split_indexes()[0])
+
+    if size is not None and size < len(fit_data):
+        fit_data = Subset(fit_data, np.random.RandomState(0).permutation(len(fit_data))[:size].tolist())
+
+    # A final batch of one would break the BatchNorm statistics in train mode
+    return torch.utils.data.DataLoader(fit_data, batch_size=BATCH_SIZE, shuffle=False, drop_last=size is not None)
+
+
+def get_data_sets(plot=False):
+    """
+    Splits the data sets into train, test and validation sets
+    :param plot: If true, plot some samples form each set
+    :return: the DataLoader objects, ready to be called from for each set
+    """
+
+    train_idx, valid_idx, test_idx = get_split_indexes()
+
+    train_labels = torch.from_numpy(train_data.get_labels(train_idx).astype(np.int64))
+    weighted_train_idx = sampler_weights.cpu()[train_labels]
+
+    weighted_train_sampler = data_loading.ResumableWeightedSampler(weights=weighted_train_idx,
+                                                                   num_samples=len(weighted_train_idx))
     valid_sampler = SubsetRandomSampler(valid_idx)
 
     # Don't shuffle the testing set for MC_DROPOUT
@@ -256,14 +499,20 @@ def get_data_sets(plot=False):
 
     return training_set, valid_set, testing_set, ISIC_set, len(test_idx), len(train_idx), len(valid_idx), test_idx
 
-    train_set, val_set, test_set, ISIC_set, test_size, train_size, val_size, test_indexes = get_data_sets(plot=True)
+    if constants.HEAD_ONLY:
+        train_set, val_set, test_set, ISIC_set, test_size, train_size, val_size, test_indexes = get_feature_sets(
+            SAVE_DIR)
+    else:
+        train_set, val_set, test_set, ISIC_set, test_size, train_size, val_size, test_indexes = get_data_sets(
+            plot=True)
 
     data_plot = data_plotting.DataPlotting(test_data, test_indexes, 12, 14)
     loss_function = nn.CrossEntropyLoss(weight=class_weights, reduction='mean')
     val_loss_function = nn.CrossEntropyLoss(weight=val_weights, reduction='mean')
 
 
-def train(root_dir, current_epoch, val_losses, train_losses, val_accuracy, train_accuracy, verbose=False):
+def train(root_dir, current_epoch, val_losses, train_losses, val_accuracy, train_accuracy, verbose=False, epochs=None,
+          resume=False):
     """
     Trains the network, saving the model with the best loss and the best accuracy as it goes.
     :param root_dir: Directory to save the model to
@@ -273,9 +522,14 @@ def train(root_dir, current_epoch, val_losses, train_losses, val_accuracy, train
     :param val_accuracy: The previous Accuracies on the Validation set
     :param train_accuracy: The previous Accuracies on the training set
     :param verbose: if True, dumps out extra information regarding what the neural network has been predicting on
+    :param epochs: number of epochs to train for, EPOCHS if not given
+    :param resume: carry on from the mid-epoch training state in root_dir, if it was saved during current_epoch
     :return: the train and val losses as well as the train and val accuracies
     """
 
+    if epochs is None:
+        epochs = EPOCHS
+
     intervals = []
 
     # Set the best accuracy and loss values if none have been passed in.
@@ -294,26 +548,63 @@ def train(root_dir, current_epoch, val_losses, train_losses, val_accuracy, train
 
     print("\nTraining Network...")
 
-    for epoch in range(current_epoch, EPOCHS + current_epoch):
+    training_state = helper.read_training_state(root_dir) if resume else None
+
+    # Only resume part way through the epoch the saved model finished on, an older state is out of date
+    if training_state is not None and training_state['epoch'] == current_epoch:
+        print(f"Resuming epoch {current_epoch + 1} from step {training_state['step']}")
+        network.load_state_dict(training_state['network'])
+        optim.load_state_dict(training_state['optimizer'])
+        scheduler.load_state_dict(training_state['lr_sched'])
+        train_set.sampler.load_state_dict(training_state['sampler'])
+    else:
+        training_state = None
+
+    if constants.SWAG:
+        # Collect the weights SWAG_SNAPSHOTS times a cycle over the last SWAG_CYCLES learning rate cycles
+        swag_posterior = swag.SWAG(network, max_rank=constants.SWAG_RANK, head_only=constants.SWAG_HEAD_ONLY)
+        if training_state is not None and 'swag' in training_state:
+            swag_posterior.load_state_dict(training_state['swag'])
+        swag_interval = max(scheduler.total_size // constants.SWAG_SNAPSHOTS, 1)
+        swag_start = scheduler.last_epoch + epochs * len(train_set) - constants.SWAG_CYCLES * scheduler.total_size
+
+    for epoch in range(current_epoch, epochs + current_epoch):
 
         # Make sure network is in train mode
         network.train()
 
-        losses = []
-        correct = 0
-        total = 0
-        incorrect = 0
-        correct_count = {'MEL': 0, 'NV': 0, 'BCC': 0, 'AK': 0, 'BKL': 0, 'DF': 0, 'VASC': 0, 'SCC': 0}
-        incorrect_count = {'MEL': 0, 'NV': 0, 'BCC': 0, 'AK': 0, 'BKL': 0, 'DF': 0, 'VASC': 0, 'SCC': 0}
+        # Kept on the device and only copied back once the epoch is done
+        metrics = helper.TrainingMetrics(device)
+        start_step = 0
 
-        print(f"\nEpoch {epoch + 1} of {EPOCHS + current_epoch}:")
+        print(f"\nEpoch {epoch + 1} of {epochs + current_epoch}:")
 
-        for i_batch, sample_batch in enumerate(tqdm(train_set)):
+        total_batches = len(train_set)
+        batches = iter(train_set)
+
+        if training_state is not None:
+            metrics.load_state_dict(training_state['metrics'])
+            start_step = training_state['step']
+            # Restored after making the iterator, as it draws a seed and in the run being resumed it was made before
+            # the state was saved
+            helper.set_rng_states(training_state['rng'])
+            training_state = None
+
+        for i_batch, sample_batch in enumerate(tqdm(batches, total=total_batches)):
             image_batch = sample_batch['image'].to(device)
             label_batch = sample_batch['label'].to(device)
 
-            outputs = network(image_batch, drop_samples=SAMPLES, dropout=True)
-            loss = loss_function(outputs, label_batch)
+            outputs = network(image_batch, samples=SAMPLES, dropout=True,
+                              features=constants.HEAD_ONLY)
+
+            if constants.SELECTIVE:
+                loss = network.selective_loss(outputs, label_batch, coverage=constants.SELECTIVE_COVERAGE)
+            elif constants.ENSEMBLE_SIZE > 1:
+                # Each member is trained on the whole batch
+                loss = loss_function(network.ensemble_outputs.reshape(-1, 8),
+                                     label_batch.repeat(constants.ENSEMBLE_SIZE))
+            else:
+                loss = loss_function(outputs, label_batch)
 
             if BBB:
                 loss += network.BBB_loss
@@ -324,28 +615,25 @@ def train(root_dir, current_epoch, val_losses, train_losses, val_accuracy, train
             scheduler.step()
             percentage = (i_batch / len(train_set)) * 100  # Used for Debugging
 
-            losses.append(loss.item())
-            index = 0
+            if constants.SWAG and scheduler.last_epoch >= swag_start and \
+                    (scheduler.last_epoch - swag_start) % swag_interval == 0:
+                swag_posterior.collect()
 
-            for output in outputs:
-                answer = torch.argmax(output)
-                real_answer = label_batch[index]
-                index += 1
+            metrics.update(outputs, label_batch, loss)
+            step = start_step + i_batch + 1
 
-                if answer == real_answer:
-                    label = LABELS[answer.item()]
-                    correct_count[label] += 1
-                    correct += 1
-                else:
-                    label = LABELS[answer.item()]
-                    incorrect_count[label] += 1
-                    incorrect += 1
-                total += 1
+            if constants.STEP_CHECKPOINT_INTERVAL and step % constants.STEP_CHECKPOINT_INTERVAL == 0:
+                sampler_state = train_set.sampler.state_dict((i_batch + 1) * train_set.batch_size)
+                helper.save_training_state(network, optim, scheduler, sampler_state, metrics, epoch, step, root_dir,
+                                           swag_posterior=swag_posterior if constants.SWAG else None)
 
             if percentage >= 1 and DEBUG:
                 print(loss)
                 break
 
+        results = metrics.results()
+        correct, incorrect, total = results['correct'], results['incorrect'], results['total']
+        correct_count, incorrect_count = results['correct_count'], results['incorrect_count']
         accuracy = (correct / total) * 100
 
         if (verbose):
@@ -363,9 +651,9 @@ def train(root_dir, current_epoch, val_losses, train_losses, val_accuracy, train
         print(f"Training Accuracy = {accuracy}%")
 
         intervals.append(epoch + 1)
-        train_losses.append(sum(losses) / len(losses))
+        train_losses.append(results['loss'])
         train_accuracy.append(accuracy)
-        print(f"Training loss: {sum(losses) / len(losses)}")
+        print(f"Training loss: {results['loss']}")
 
         accuracy, val_loss = test(val_set, verbose=verbose)
         val_losses.append(val_loss)
@@ -376,26 +664,28 @@ def train(root_dir, current_epoch, val_losses, train_losses, val_accuracy, train
 
         data_plot.plot_loss(root_dir, intervals, val_losses, train_losses)
         data_plot.plot_validation(root_dir, intervals, val_accuracy, train_accuracy)
-        helper.save_network(network, optim, scheduler, val_losses, train_losses, val_accuracy, train_accuracy, root_dir)
+
+        # One checkpoint an epoch, tagged if it's the best so far
+        tags = []
 
         if best_val < max(val_accuracy):
-            helper.save_network(network, optim, scheduler, val_losses, train_losses, val_accuracy, train_accuracy,
-                                root_dir)
+            tags.append("best_acc")
             best_val = max(val_accuracy)
-            data_plot.plot_loss(root_dir, intervals, val_losses, train_losses)
-            data_plot.plot_validation(root_dir, intervals, val_accuracy, train_accuracy)
 
         if best_loss > min(val_losses):
-            helper.save_network(network, optim, scheduler, val_losses, train_losses, val_accuracy, train_accuracy,
-                                root_dir)
+            tags.append("best_loss")
             best_loss = min(val_losses)
-            data_plot.plot_loss(root_dir, intervals, val_losses, train_losses)
-            data_plot.plot_validation(root_dir, intervals, val_accuracy, train_accuracy)
+
+        helper.save_network(network, optim, scheduler, val_losses, train_losses, val_accuracy, train_accuracy, root_dir,
+                            tags=tags)
 
     data_plot.plot_loss(root_dir, intervals, val_losses, train_losses)
     data_plot.plot_validation(root_dir, intervals, val_accuracy, train_accuracy)
     helper.save_network(network, optim, scheduler, val_losses, train_losses, val_accuracy, train_accuracy, root_dir)
 
+    if constants.SWAG:
+        swag_posterior.save(root_dir + "swag.pt")
+
     return intervals, val_losses, train_losses, val_accuracy, train_accuracy
 
 
@@ -411,12 +701,7 @@ def test(testing_set, verbose=False):
     # Make sure network is in eval mode
     network.eval()
 
-    correct = 0
-    total = 0
-    incorrect = 0
-    correct_count = {'MEL': 0, 'NV': 0, 'BCC': 0, 'AK': 0, 'BKL': 0, 'DF': 0, 'VASC': 0, 'SCC': 0}
-    incorrect_count = {'MEL': 0, 'NV': 0, 'BCC': 0, 'AK': 0, 'BKL': 0, 'DF': 0, 'VASC': 0, 'SCC': 0}
-    losses = []
+    metrics = helper.TrainingMetrics(device)
 
     print("\nTesting Data...")
 
@@ -425,35 +710,22 @@ def test(testing_set, verbose=False):
             image_batch = sample_batch['image'].to(device)
             label_batch = sample_batch['label'].to(device)
 
-            outputs = network(image_batch, drop_samples=SAMPLES, sample=True, dropout=TRAIN_MC_DROPOUT)
+            outputs = network(image_batch, samples=SAMPLES, sample=True, dropout=TRAIN_MC_DROPOUT,
+                              features=constants.HEAD_ONLY)
             loss = val_loss_function(outputs, label_batch)
 
             if BBB:
                 loss += network.BBB_loss
 
-            losses.append(loss.item())
-            index = 0
-            for output in outputs:
-
-                answer = torch.argmax(output)
-                real_answer = label_batch[index]
-                index += 1
-                if answer == real_answer:
-
-                    label = LABELS[answer.item()]
-                    correct_count[label] += 1
-                    correct += 1
-                else:
-
-                    label = LABELS[answer.item()]
-                    incorrect_count[label] += 1
-                    incorrect += 1
-                total += 1
+            metrics.update(outputs, label_batch, loss)
 
-            if total >= BATCH_SIZE * 2 and DEBUG:
+            if i_batch >= 1 and DEBUG:
                 break
 
-    average_loss = (sum(losses) / len(losses))
+    results = metrics.results()
+    correct, incorrect, total = results['correct'], results['incorrect'], results['total']
+    correct_count, incorrect_count = results['correct_count'], results['incorrect_count']
+    average_loss = results['loss']
     accuracy = (correct / total) * 100
 
     if (verbose):